@@ -0,0 +1,434 @@
+"""
+Measure the overhead of the instrumentation.
+
+Microbenchmarks time single calls of representative torch ops, with and without tracing, in a fresh
+process per tracing configuration (the tracer reads its settings when it is imported).
+Macrobenchmarks run the example pipelines on CPU through `mldaikon.collect_trace` with each tracing
+feature toggled, and measure the steps per second, the trace events per second and the trace bytes per step.
+
+Everything ends up in a JSON report (see `--output`), so that two reports can be compared to catch regressions.
+
+Usage:
+    python3 benchmark.py --micro
+    python3 benchmark.py --macro --workloads mnist --configs baseline api api_async
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+# collect_trace flags of each tracing configuration, "baseline" runs the pipeline without instrumentation
+CONFIGS: dict[str, list[str] | None] = {
+    "baseline": None,
+    "api": ["--disable_proxy_class"],
+    "api_proxy": [],
+    "api_arrow": ["--disable_proxy_class", "--trace-api-format", "arrow"],
+    "api_async": ["--disable_proxy_class", "--async-trace"],
+    "api_zstd": ["--disable_proxy_class", "--trace-compression", "zstd"],
+    "api_sampled": ["--disable_proxy_class", "--sampling-policy", "first_n_then_k"],
+    "api_stats": ["--disable_proxy_class", "--api-trace-mode", "stats"],
+    "api_monitoring": ["--disable_proxy_class", "--tracing-backend", "monitoring"],
+    "api_torch_ops": ["--disable_proxy_class", "--trace-torch-ops", "function"],
+}
+
+# configurations that only exist in a full pipeline run
+MACRO_ONLY_CONFIGS = ["baseline", "api_proxy"]
+
+# env vars the traced process reads for the collect_trace flags, used to set up the microbenchmarks
+FLAG_ENV_VARS = {
+    "--trace-api-format": "ML_DAIKON_TRACE_API_FORMAT",
+    "--trace-compression": "ML_DAIKON_TRACE_COMPRESSION",
+    "--async-trace": "ML_DAIKON_ASYNC_TRACE",
+    "--sampling-policy": "ML_DAIKON_SAMPLING_POLICY",
+    "--api-trace-mode": "ML_DAIKON_API_TRACE_MODE",
+    "--tracing-backend": "ML_DAIKON_TRACING_BACKEND",
+    "--trace-torch-ops": "ML_DAIKON_TRACE_TORCH_OPS",
+}
+
+# script, its arguments and a regex matching one line of output per training step
+WORKLOADS = {
+    "mnist": {
+        "script": "mnist.py",
+        "args": ["--epochs", "1", "--log-interval", "1", "--no-cuda", "--no-mps"],
+        "step_regex": r"Train Epoch: ",
+    },
+    "mnist_ml_daikon": {
+        "script": "example_pipelines/mnist_ml_daikon.py",
+        "args": ["--epochs", "1", "--log-interval", "1", "--no-cuda", "--no-mps"],
+        "step_regex": r"Train Epoch: ",
+    },
+    "bug_84911": {
+        "script": "example_pipelines/bug_84911_ml_daikon.py",
+        "args": [],
+        "step_regex": r"Epoch: \d+, Batch: ",
+    },
+}
+
+TRACE_FILE_REGEX = re.compile(
+    r"_mldaikon_(trace_API|trace_VAR)_.*\.(log|arrows|parquet|chunks)$"
+)
+
+
+def config_env(flags: list[str]) -> dict[str, str]:
+    env = {}
+    for i, flag in enumerate(flags):
+        if flag not in FLAG_ENV_VARS:
+            continue
+        if flag == "--async-trace":
+            env[FLAG_ENV_VARS[flag]] = "1"
+        else:
+            env[FLAG_ENV_VARS[flag]] = flags[i + 1]
+    return env
+
+
+def count_events(path: str) -> int:
+    if path.endswith(".log"):
+        with open(path, "rb") as f:
+            return sum(1 for _ in f)
+    if path.endswith(".chunks"):
+        from mldaikon.instrumentor.trace_writer import read_chunk_headers
+
+        return sum(chunk["num_events"] for chunk in read_chunk_headers(path)[1])
+
+    import polars as pl
+
+    if path.endswith(".parquet"):
+        return pl.read_parquet(path).height
+    return pl.read_ipc_stream(path).height
+
+
+def measure_trace_files(paths: list[str]) -> tuple[int, int]:
+    """Total size in bytes of the files written by a run and the number of trace events in them."""
+    num_bytes = 0
+    num_events = 0
+    for path in paths:
+        num_bytes += os.path.getsize(path)
+        if TRACE_FILE_REGEX.search(os.path.basename(path)):
+            num_events += count_events(path)
+    return num_bytes, num_events
+
+
+def list_files(directory: str) -> set[str]:
+    return {
+        os.path.join(root, name)
+        for root, _, names in os.walk(directory)
+        for name in names
+    }
+
+
+# Microbenchmarks
+
+
+def _time_calls(fn, args: tuple, iterations: int, repeat: int) -> float:
+    """Best average time of a call in ns over `repeat` runs of `iterations` calls."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter_ns()
+        for _ in range(iterations):
+            fn(*args)
+        best = min(best, (time.perf_counter_ns() - start) / iterations)
+    return best
+
+
+def micro_worker(iterations: int, repeat: int):
+    """Runs in the process of one configuration, prints the per-op timings as JSON."""
+    os.environ["MAIN_SCRIPT_NAME"] = "micro"
+    import torch
+    import torch.nn.functional as F
+
+    from mldaikon.instrumentor import tracer
+
+    a = torch.randn(16, 16)
+    b = torch.randn(16, 16)
+    linear = torch.nn.Linear(16, 16)
+    ops = {
+        "torch.add": (torch.add, (a, b)),
+        "torch.matmul": (torch.matmul, (a, b)),
+        "torch.nn.functional.linear": (F.linear, (a, linear.weight, linear.bias)),
+        "torch.nn.functional.relu": (F.relu, (a,)),  # Python function
+    }
+
+    baselines = {
+        name: _time_calls(fn, args, iterations, repeat)
+        for name, (fn, args) in ops.items()
+    }
+
+    # trace the ops the way the Instrumentor would
+    traced_ops = {}
+    for name, (fn, args) in ops.items():
+        if fn in tracer.torch_function_overridables:
+            traced_ops[name] = (fn, args)
+        elif (
+            tracer.monitoring_backend is not None
+            and tracer.monitoring_backend.add_function(
+                fn, tracer.get_function_id(tracer.get_qualified_function_name(fn))
+            )
+        ):
+            traced_ops[name] = (fn, args)
+        else:
+            traced_ops[name] = (tracer.wrapper(fn), args)
+    if tracer.monitoring_backend is not None:
+        tracer.monitoring_backend.start()
+    if tracer.torch_ops_mode is not None:
+        tracer.torch_ops_mode.start()
+
+    results = []
+    for name, (fn, args) in traced_ops.items():
+        traced = _time_calls(fn, args, iterations, repeat)
+        results.append(
+            {
+                "op": name,
+                "baseline_ns_per_call": baselines[name],
+                "traced_ns_per_call": traced,
+                "overhead_ns_per_call": traced - baselines[name],
+                "num_traced_calls": iterations * repeat,
+            }
+        )
+    print(json.dumps(results))
+
+
+def run_micro(configs: list[str], iterations: int, repeat: int) -> list[dict]:
+    results = []
+    for config in configs:
+        flags = CONFIGS[config]
+        assert flags is not None
+        with tempfile.TemporaryDirectory(prefix="mldaikon_micro_") as work_dir:
+            env = {**os.environ, **config_env(flags)}
+            env["PYTHONPATH"] = os.pathsep.join(
+                [os.path.dirname(os.path.abspath(__file__)), env.get("PYTHONPATH", "")]
+            )
+            process = subprocess.run(
+                [
+                    sys.executable,
+                    os.path.abspath(__file__),
+                    "--micro-worker",
+                    "--iterations",
+                    str(iterations),
+                    "--repeat",
+                    str(repeat),
+                ],
+                cwd=work_dir,
+                env=env,
+                capture_output=True,
+                text=True,
+            )
+            if process.returncode != 0:
+                print(f"Microbenchmark {config} failed:\n{process.stderr}")
+                continue
+            op_results = json.loads(process.stdout.strip().splitlines()[-1])
+            trace_bytes, num_events = measure_trace_files(sorted(list_files(work_dir)))
+        num_calls = sum(r["num_traced_calls"] for r in op_results)
+        for r in op_results:
+            r["config"] = config
+            print(
+                f"[micro] {config:<16} {r['op']:<28} baseline {r['baseline_ns_per_call']:>9.0f} ns"
+                f"  traced {r['traced_ns_per_call']:>9.0f} ns  overhead {r['overhead_ns_per_call']:>9.0f} ns"
+            )
+        results.extend(op_results)
+        results.append(
+            {
+                "config": config,
+                "op": "all",
+                "trace_bytes_per_call": trace_bytes / num_calls,
+                "events_per_call": num_events / num_calls,
+            }
+        )
+    return results
+
+
+# Macrobenchmarks
+
+
+def run_macro(
+    workloads: list[str], configs: list[str], work_dir: str, keep_traces: bool
+) -> list[dict]:
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    results = []
+    baseline_times: dict[str, float] = {}
+    for workload in workloads:
+        spec = WORKLOADS[workload]
+        script = os.path.join(repo_dir, spec["script"])
+        # every workload runs in its own directory (the datasets are downloaded once),
+        # the files created by a run are its traces
+        run_dir = os.path.join(work_dir, workload)
+        os.makedirs(run_dir, exist_ok=True)
+        for config in configs:
+            flags = CONFIGS[config]
+            if flags is None:
+                cmd = [sys.executable, "-u", script, *spec["args"]]
+            else:
+                # collect_trace runs the instrumented script through a shell script to pass its arguments
+                sh_script = os.path.join(run_dir, f"run_{workload}.sh")
+                with open(sh_script, "w") as f:
+                    f.write(
+                        " ".join([sys.executable, "-u", script, *spec["args"]]) + "\n"
+                    )
+                cmd = [
+                    sys.executable,
+                    "-m",
+                    "mldaikon.collect_trace",
+                    "-p",
+                    script,
+                    "-s",
+                    sh_script,
+                    "-r",
+                    *flags,
+                ]
+
+            files_before = list_files(run_dir)
+            start = time.perf_counter()
+            process = subprocess.run(
+                cmd,
+                cwd=run_dir,
+                capture_output=True,
+                text=True,
+                env={**os.environ, "PYTHONPATH": repo_dir},
+            )
+            wall_time = time.perf_counter() - start
+            new_files = sorted(
+                path
+                for path in list_files(run_dir) - files_before
+                if "_mldaikon_" in os.path.basename(path)
+            )
+            trace_bytes, num_events = measure_trace_files(new_files)
+            steps = len(re.findall(spec["step_regex"], process.stdout))
+            if not keep_traces:
+                for path in new_files:
+                    os.remove(path)
+
+            failed = process.returncode != 0
+            result = {
+                "workload": workload,
+                "config": config,
+                "return_code": process.returncode,
+                "failed": failed,
+                "wall_time_s": wall_time,
+            }
+            results.append(result)
+            if failed:
+                # a run that crashed part way says nothing about the overhead, it is kept out of the numbers
+                print(
+                    f"[macro] {workload:<16} {config:<16} FAILED rc={process.returncode} {wall_time:8.1f} s"
+                )
+                print(process.stdout[-2000:], process.stderr[-2000:])
+                continue
+
+            if config == "baseline":
+                baseline_times[workload] = wall_time
+            result.update(
+                {
+                    "steps": steps,
+                    "steps_per_s": steps / wall_time,
+                    "events": num_events,
+                    "events_per_s": num_events / wall_time,
+                    "trace_bytes": trace_bytes,
+                    "trace_bytes_per_step": trace_bytes / steps if steps else None,
+                    "slowdown": (
+                        wall_time / baseline_times[workload]
+                        if workload in baseline_times
+                        else None
+                    ),
+                }
+            )
+            print(
+                f"[macro] {workload:<16} {config:<16} rc={process.returncode} {wall_time:8.1f} s"
+                f"  {result['steps_per_s']:8.2f} steps/s  {result['events_per_s']:10.0f} events/s"
+                f"  {trace_bytes / max(steps, 1):12.0f} bytes/step"
+            )
+    return results
+
+
+def environment_info() -> dict:
+    import torch
+
+    return {
+        "time": datetime.datetime.now().isoformat(),
+        "python": sys.version,
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Instrumentation overhead benchmarks")
+    parser.add_argument("--micro", action="store_true", help="Run the microbenchmarks")
+    parser.add_argument("--macro", action="store_true", help="Run the macrobenchmarks")
+    parser.add_argument(
+        "--configs",
+        nargs="*",
+        choices=list(CONFIGS),
+        default=list(CONFIGS),
+        help="Tracing configurations to benchmark",
+    )
+    parser.add_argument(
+        "--workloads",
+        nargs="*",
+        choices=list(WORKLOADS),
+        default=list(WORKLOADS),
+        help="Pipelines to run in the macrobenchmarks",
+    )
+    parser.add_argument(
+        "--iterations", type=int, default=10000, help="Calls per microbenchmark run"
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="Runs per microbenchmark, the best one is kept",
+    )
+    parser.add_argument(
+        "--work-dir",
+        type=str,
+        default="benchmark_runs",
+        help="Directory the macrobenchmarks run in (datasets are downloaded there)",
+    )
+    parser.add_argument(
+        "--keep-traces",
+        action="store_true",
+        help="Keep the traces of the macrobenchmarks",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="benchmark_report.json",
+        help="Path of the JSON report",
+    )
+    parser.add_argument("--micro-worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.micro_worker:
+        micro_worker(args.iterations, args.repeat)
+        return
+
+    if not args.micro and not args.macro:
+        args.micro = args.macro = True
+
+    report: dict = {"environment": environment_info()}
+    if args.micro:
+        report["micro"] = run_micro(
+            [c for c in args.configs if c not in MACRO_ONLY_CONFIGS],
+            args.iterations,
+            args.repeat,
+        )
+    if args.macro:
+        work_dir = os.path.abspath(args.work_dir)
+        os.makedirs(work_dir, exist_ok=True)
+        report["macro"] = run_macro(
+            args.workloads, args.configs, work_dir, args.keep_traces
+        )
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Benchmark report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
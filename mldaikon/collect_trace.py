@@ -1,8 +1,12 @@
 import argparse
+import json
 import logging
+import os
+import tempfile
 
 import mldaikon.config.config as config
 import mldaikon.instrumentor as instrumentor
+import mldaikon.instrumentor.collector as collector
 import mldaikon.runner as runner
 
 if __name__ == "__main__":
@@ -67,23 +71,263 @@ if __name__ == "__main__":
         help="Disable proxy class for tracing",
     )
 
+    parser.add_argument(
+        "--trace-api-format",
+        choices=["json", "arrow", "parquet"],
+        default=config.TRACE_API_FORMAT,
+        help="""Format of the API trace. "json" writes the NDJSON log (useful for debugging),
+        "arrow" and "parquet" buffer events in columns and write them in blocks (requires pyarrow).""",
+    )
+    parser.add_argument(
+        "--trace-compression",
+        choices=["none", "zstd", "lz4"],
+        default=config.TRACE_COMPRESSION,
+        help="""Write the NDJSON traces as independently compressed chunks (requires zstandard or lz4),
+        read_trace_file can decompress them in parallel and skip the chunks outside a time or step range.""",
+    )
+    parser.add_argument(
+        "--rotate-max-bytes",
+        type=int,
+        default=config.ROTATE_MAX_BYTES,
+        help="Start a new trace segment once the current one reaches this many bytes (0: no size rotation)",
+    )
+    parser.add_argument(
+        "--rotate-every-steps",
+        type=int,
+        default=config.ROTATE_EVERY_STEPS,
+        help="Start a new trace segment for every window of this many training steps (0: no step rotation)",
+    )
+    parser.add_argument(
+        "--enable-plan-cache",
+        action="store_true",
+        help="""Apply the instrumentation plan cached by a previous run with the same torch / Python version,
+        loaded code and config instead of walking the instrumented modules on every launch.""",
+    )
+    parser.add_argument(
+        "--import-instrumentation",
+        choices=["hook", "ast"],
+        default=config.IMPORT_INSTRUMENTATION,
+        help=""""hook" instruments the modules whenever they are imported, including by other libraries and
+        in every traced process, "ast" only instruments the imports written in the main script.""",
+    )
+    parser.add_argument(
+        "--instrumentation-include",
+        nargs="*",
+        default=config.INSTRUMENTATION_INCLUDE,
+        help="""Only instrument the functions whose qualified name matches one of these rules: a prefix
+        ("torch.nn.functional"), a glob ("torch.optim.*.step") or a regex prefixed with "re:".""",
+    )
+    parser.add_argument(
+        "--instrumentation-exclude",
+        nargs="*",
+        default=config.INSTRUMENTATION_EXCLUDE,
+        help="Do not instrument the functions, modules and classes matching these rules (same syntax as --instrumentation-include)",
+    )
+    parser.add_argument(
+        "--verbose-instrumentation",
+        action="store_true",
+        default=config.INSTRUMENTATION_VERBOSE,
+        help="Log every attribute visited by the instrumentor, not only the startup report",
+    )
+    parser.add_argument(
+        "--instrumentation-profile",
+        action="store_true",
+        default=config.INSTRUMENTATION_PROFILE,
+        help="""Profiling run: record the calls and the wrapper overhead of every instrumented function, to build
+        an exclusion list with `python -m mldaikon.instrumentor.overhead_profile`""",
+    )
+    parser.add_argument(
+        "--instrumentation-exclude-file",
+        type=str,
+        default=config.INSTRUMENTATION_EXCLUDE_FILE,
+        help="Exclusion list built from a profiling run, its rules are added to the exclude rules",
+    )
+    parser.add_argument(
+        "--instrumentation-mode",
+        choices=["eager", "lazy"],
+        default=config.INSTRUMENTATION_MODE,
+        help=""""eager" wraps every function of the instrumented modules at startup, "lazy" wraps the
+        attributes of a module when they are first looked up on it.""",
+    )
+    parser.add_argument(
+        "--trace-collector",
+        action="store_true",
+        default=config.TRACE_COLLECTOR,
+        help="""Send the traces of all the processes (DataLoader workers, DDP ranks) to a local collector
+        that writes one time-merged columnar store per run, tagged with rank and worker ID (requires pyarrow).""",
+    )
+    parser.add_argument(
+        "--tracing-windows",
+        type=str,
+        default=config.TRACING_WINDOWS,
+        help="""Only trace the calls made in these steps, a comma-separated list of step ranges like
+        "1000-1010,2000,3000-" ("" starts with tracing off, for programs using tracing_window).""",
+    )
+    parser.add_argument(
+        "--tracing-window-signal",
+        type=str,
+        default=config.TRACING_WINDOW_SIGNAL,
+        help="""Signal turning tracing on / off at runtime, e.g. SIGUSR2. No handler is installed by default,
+        as the program may use the signal itself.""",
+    )
+    parser.add_argument(
+        "--flight-recorder",
+        action="store_true",
+        default=config.FLIGHT_RECORDER,
+        help="""Keep the events of the last steps in memory and only write them when a trigger fires
+        (an exception raised by a traced API, a NaN in an observed variable, SIGUSR1 or a callback).""",
+    )
+    parser.add_argument(
+        "--flight-recorder-steps",
+        type=int,
+        default=config.FLIGHT_RECORDER_STEPS,
+        help="Number of steps kept in memory by the flight recorder",
+    )
+    parser.add_argument(
+        "--flight-recorder-triggers",
+        type=str,
+        default=",".join(config.FLIGHT_RECORDER_TRIGGERS),
+        help="Comma-separated triggers of the flight recorder, among exception, nan, signal and callback",
+    )
+    parser.add_argument(
+        "--async-trace",
+        action="store_true",
+        help="Write traces from a background thread, the training thread only enqueues the events",
+    )
+    parser.add_argument(
+        "--async-overflow-policy",
+        choices=["block", "drop", "sample"],
+        default=config.ASYNC_OVERFLOW_POLICY,
+        help="What to do with new events when the async trace buffer is full",
+    )
+    parser.add_argument(
+        "--sampling-policy",
+        choices=["all", "first_n_then_k", "step_window", "reservoir"],
+        default=config.SAMPLING_POLICY,
+        help="""Which API calls are traced, decided for every call by its own API.
+        The exact number of calls per API is still recorded.""",
+    )
+    parser.add_argument(
+        "--sampling-keep-nested",
+        action="store_true",
+        help="""Trace every call made inside a call traced by the sampling policy, so that the parent of
+        every traced call is traced too.""",
+    )
+    parser.add_argument(
+        "--call-depth-mode",
+        choices=["all", "max_depth", "outermost"],
+        default=config.CALL_DEPTH_MODE,
+        help="""Which calls made inside other traced calls are traced: "all" of them, the ones up to
+        --max-call-depth ("max_depth") or none ("outermost"). The calls not traced are still counted.""",
+    )
+    parser.add_argument(
+        "--max-call-depth",
+        type=int,
+        default=config.MAX_CALL_DEPTH,
+        help="Depth of the deepest traced calls with --call-depth-mode max_depth, 0 being the outermost calls",
+    )
+    parser.add_argument(
+        "--api-trace-mode",
+        choices=["events", "stats"],
+        default=config.API_TRACE_MODE,
+        help=""""events" traces every API call, "stats" only dumps per-API call counts and
+        duration histograms (per parent API and step), see read_api_stats.""",
+    )
+    parser.add_argument(
+        "--tracing-backend",
+        choices=["wrapper", "monitoring"],
+        default=config.TRACING_BACKEND,
+        help=""""wrapper" replaces the instrumented functions with wrappers, "monitoring" leaves Python
+        functions in place and traces them with sys.monitoring (Python 3.12+, sys.setprofile before).""",
+    )
+    parser.add_argument(
+        "--trace-torch-ops",
+        choices=["off", "function", "dispatch"],
+        default=config.TRACE_TORCH_OPS,
+        help="""Trace C-implemented torch ops (e.g. Tensor.add_) with their tensor shapes, dtypes and devices
+        through a TorchFunctionMode ("function") or a TorchDispatchMode ("dispatch", ATen ops).""",
+    )
+
     args = parser.parse_args()
     config.INCLUDED_WRAP_LIST = args.wrapped_modules
     config.proxy_log_dir = args.tracer_log_dir
 
+    # tracer settings are passed to the traced program through the environment
+    os.environ["ML_DAIKON_TRACE_API_FORMAT"] = args.trace_api_format
+    os.environ["ML_DAIKON_TRACE_COMPRESSION"] = args.trace_compression
+    os.environ["ML_DAIKON_ROTATE_MAX_BYTES"] = str(args.rotate_max_bytes)
+    os.environ["ML_DAIKON_ROTATE_EVERY_STEPS"] = str(args.rotate_every_steps)
+    if args.enable_plan_cache or config.INSTRUMENTATION_PLAN_CACHE:
+        os.environ["ML_DAIKON_PLAN_CACHE"] = "1"
+    os.environ["ML_DAIKON_INSTRUMENTATION_INCLUDE"] = json.dumps(
+        args.instrumentation_include
+    )
+    os.environ["ML_DAIKON_INSTRUMENTATION_EXCLUDE"] = json.dumps(
+        args.instrumentation_exclude
+    )
+    os.environ["ML_DAIKON_INSTRUMENTATION_MODE"] = args.instrumentation_mode
+    if args.verbose_instrumentation:
+        os.environ["ML_DAIKON_INSTRUMENTATION_VERBOSE"] = "1"
+    if args.instrumentation_profile:
+        os.environ["ML_DAIKON_INSTRUMENTATION_PROFILE"] = "1"
+    if args.instrumentation_exclude_file is not None:
+        os.environ["ML_DAIKON_INSTRUMENTATION_EXCLUDE_FILE"] = os.path.abspath(
+            args.instrumentation_exclude_file
+        )
+    if args.tracing_windows is not None:
+        os.environ["ML_DAIKON_TRACING_WINDOWS"] = args.tracing_windows
+    if args.tracing_window_signal is not None:
+        os.environ["ML_DAIKON_TRACING_WINDOW_SIGNAL"] = args.tracing_window_signal
+    if args.flight_recorder:
+        os.environ["ML_DAIKON_FLIGHT_RECORDER"] = "1"
+    os.environ["ML_DAIKON_FLIGHT_RECORDER_STEPS"] = str(args.flight_recorder_steps)
+    os.environ["ML_DAIKON_FLIGHT_RECORDER_TRIGGERS"] = args.flight_recorder_triggers
+    if args.async_trace:
+        os.environ["ML_DAIKON_ASYNC_TRACE"] = "1"
+    os.environ["ML_DAIKON_ASYNC_OVERFLOW_POLICY"] = args.async_overflow_policy
+    os.environ["ML_DAIKON_SAMPLING_POLICY"] = args.sampling_policy
+    if args.sampling_keep_nested or config.SAMPLING_KEEP_NESTED:
+        os.environ["ML_DAIKON_SAMPLING_KEEP_NESTED"] = "1"
+    os.environ["ML_DAIKON_CALL_DEPTH_MODE"] = args.call_depth_mode
+    os.environ["ML_DAIKON_MAX_CALL_DEPTH"] = str(args.max_call_depth)
+    os.environ["ML_DAIKON_API_TRACE_MODE"] = args.api_trace_mode
+    os.environ["ML_DAIKON_TRACING_BACKEND"] = args.tracing_backend
+    os.environ["ML_DAIKON_TRACE_TORCH_OPS"] = args.trace_torch_ops
+
     # set up logging
     logging.basicConfig(level=logging.INFO)
 
     # call into the instrumentor
     source_code = instrumentor.instrument_file(
-        args.pyscript, args.modules_to_instrument, args.disable_proxy_class
+        args.pyscript,
+        args.modules_to_instrument,
+        args.disable_proxy_class,
+        args.import_instrumentation,
     )
 
+    collector_process = None
+    if args.trace_collector and not args.only_instrument:
+        collector_socket = os.path.join(
+            tempfile.gettempdir(), f"mldaikon_collector_{os.getpid()}.sock"
+        )
+        collector_process = collector.start_collector(
+            collector_socket,
+            "parquet" if args.trace_api_format == "json" else args.trace_api_format,
+            config.COLUMNAR_BLOCK_SIZE,
+            config.COLLECTOR_MAX_PENDING,
+            config.COLLECTOR_WATERMARK_TIMEOUT,
+        )
+        os.environ["ML_DAIKON_COLLECTOR_SOCKET"] = collector_socket
+
     # call into the program runner
     program_runner = runner.ProgramRunner(
         source_code, args.pyscript, args.shscript, dry_run=args.only_instrument
     )
-    program_output, return_code = program_runner.run()
+    try:
+        program_output, return_code = program_runner.run()
+    finally:
+        if collector_process is not None:
+            collector.stop_collector(collector_process)
 
     # dump the log
     with open("program_output.txt", "w") as f:
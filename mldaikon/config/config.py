@@ -1,4 +1,149 @@
+import os
+
 TMP_FILE_PREFIX = "_ml_daikon_"
 MODULES_TO_INSTRUMENT = ["torch"]
 INCLUDED_WRAP_LIST = ["Net", "DataParallel"]  # FIXME: Net & DataParallel seem ad-hoc
 proxy_log_dir = "proxy_log.log"  # FIXME: ad-hoc
+
+# format of the API trace: "json" (NDJSON log, for debugging), "arrow" (Arrow IPC stream) or "parquet"
+# can be overridden in the traced process with the ML_DAIKON_TRACE_API_FORMAT env var
+TRACE_API_FORMAT = "json"
+COLUMNAR_BLOCK_SIZE = 8192  # number of events buffered before a block is flushed
+
+# compression of the NDJSON traces: "none" (plain log), "zstd" or "lz4" (independently compressed chunks)
+# can be overridden in the traced process with the ML_DAIKON_TRACE_COMPRESSION env var
+TRACE_COMPRESSION = "none"
+COMPRESSED_CHUNK_SIZE = 4096  # number of events per compressed chunk
+
+# rotation of the trace files into segments listed in the run manifest, 0 disables a criterion
+# can be overridden in the traced process with ML_DAIKON_ROTATE_MAX_BYTES / ML_DAIKON_ROTATE_EVERY_STEPS
+ROTATE_MAX_BYTES = 0  # start a new segment once the current one reaches this size
+ROTATE_EVERY_STEPS = (
+    0  # start a new segment for every window of this many training steps
+)
+
+# central trace collector: the traced processes send their events over a Unix socket to one collector process
+# that writes a single time-merged columnar store per run (see mldaikon.instrumentor.collector)
+TRACE_COLLECTOR = False
+COLLECTOR_BATCH_SIZE = 1024  # events per batch sent to the collector
+COLLECTOR_FLUSH_INTERVAL = (
+    1.0  # seconds after which a partial batch is sent with the next event
+)
+# events the collector holds back to merge them by time before writing the oldest ones anyway
+COLLECTOR_MAX_PENDING = 1000000
+# seconds after which a connection that sent nothing no longer holds the merge of the collector back
+COLLECTOR_WATERMARK_TIMEOUT = 5.0
+
+# "hook" instruments the modules to instrument whenever they are imported, by any code of the traced processes
+# (see mldaikon/instrumentor/import_hook.py), "ast" only instruments the imports written in the main script
+IMPORT_INSTRUMENTATION = "hook"
+
+# include / exclude rules narrowing what the instrumentor wraps, matched against qualified names such as
+# "torch.nn.functional.relu": a prefix ("torch.fx"), a glob ("torch.optim.*.step") or a regex ("re:...").
+# A function is wrapped if no exclude rule matches it and, when there are include rules, one of them does
+# (see mldaikon/instrumentor/rules.py). Can be overridden with ML_DAIKON_INSTRUMENTATION_INCLUDE / _EXCLUDE
+# (JSON lists of rules)
+INSTRUMENTATION_INCLUDE: list[str] = []
+INSTRUMENTATION_EXCLUDE = [
+    "torch.fx",
+    "torch.jit",
+    "torch._jit",
+    "torch._C",
+    "torch._sources",  # FIXME: cannot handle this module, instrumenting it will lead to exceptions: TypeError: module, class, method, function, traceback, frame, or code object was expected, got builtin_function_or_method
+]
+
+# "eager" walks the instrumented modules at startup, "lazy" instruments the attributes of a module the first
+# time they are looked up, can be overridden with ML_DAIKON_INSTRUMENTATION_MODE
+INSTRUMENTATION_MODE = "eager"
+
+# the instrumentation log only gets a line per attribute visited by the instrumentor in the verbose mode (turned on
+# with ML_DAIKON_INSTRUMENTATION_VERBOSE=1), every process writes a startup report instead
+# (`{script}_mldaikon_instrumentation_report_{time}_{pid}.json`) with the modules / classes that took the most time
+INSTRUMENTATION_VERBOSE = False
+INSTRUMENTATION_REPORT_MAX_OWNERS = (
+    100  # modules / classes listed in the report, 0 lists all of them
+)
+
+# profile-guided instrumentation (see mldaikon/instrumentor/overhead_profile.py): a profiling run
+# (ML_DAIKON_INSTRUMENTATION_PROFILE=1) records the calls and the wrapper overhead of every instrumented function,
+# the functions with the highest overhead are then excluded until the rest fits in INSTRUMENTATION_OVERHEAD_BUDGET
+# (a fraction of the run time), and the resulting file is loaded with INSTRUMENTATION_EXCLUDE_FILE
+# (ML_DAIKON_INSTRUMENTATION_EXCLUDE_FILE), its rules are added to the exclude rules
+INSTRUMENTATION_PROFILE = False
+INSTRUMENTATION_OVERHEAD_BUDGET = 0.1
+INSTRUMENTATION_EXCLUDE_FILE: str | None = None
+
+# the result of walking the instrumented modules (the functions to patch) is cached per torch version, Python
+# version, loaded code and instrumentation config, later runs only apply it. Enabled with ML_DAIKON_PLAN_CACHE=1,
+# the directory can be overridden with ML_DAIKON_PLAN_CACHE_DIR
+INSTRUMENTATION_PLAN_CACHE = False
+INSTRUMENTATION_PLAN_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "mldaikon", "plans"
+)
+
+# exception events: arguments are described by bounded-size descriptors (tensors by dtype, shape and device),
+# the message is truncated, and the traceback is stored once per process in a table keyed by its hash
+ARG_DESCRIPTOR_MAX_LENGTH = 100  # max length of the repr of a str / number argument
+EXCEPTION_MESSAGE_MAX_LENGTH = 1000
+
+# tracing windows (see mldaikon/instrumentor/windows.py): None traces every call, otherwise calls are only traced in
+# the windows, a comma-separated list of step ranges like "1000-1010,2000,3000-" ("" starts with tracing off, for
+# programs using `tracing_window`). Can be overridden with ML_DAIKON_TRACING_WINDOWS
+TRACING_WINDOWS: str | None = None
+# signal turning tracing on / off at runtime (e.g. "SIGUSR2"), None (default) does not install a handler since the
+# program may use the signal itself. Can be overridden with ML_DAIKON_TRACING_WINDOW_SIGNAL
+TRACING_WINDOW_SIGNAL: str | None = None
+
+# flight-recorder mode: the API and variable events of the last FLIGHT_RECORDER_STEPS steps are kept in memory
+# (compressed) and only written when a trigger fires: "exception" (raised by a traced API), "nan" (in a variable
+# observed by StateVarObserver), "signal" (FLIGHT_RECORDER_SIGNAL) or "callback" (add_flight_recorder_trigger).
+# Turned on with ML_DAIKON_FLIGHT_RECORDER=1, ML_DAIKON_FLIGHT_RECORDER_STEPS / _TRIGGERS (comma separated)
+FLIGHT_RECORDER = False
+FLIGHT_RECORDER_STEPS = 10
+FLIGHT_RECORDER_TRIGGERS = ["exception", "nan", "signal", "callback"]
+FLIGHT_RECORDER_SIGNAL = "SIGUSR1"
+FLIGHT_RECORDER_MAX_BYTES = (
+    256 * 1024 * 1024
+)  # the oldest events are dropped beyond this compressed size
+FLIGHT_RECORDER_CHUNK_SIZE = 4096  # events compressed together
+
+# asynchronous trace emission, can be turned on in the traced process with ML_DAIKON_ASYNC_TRACE=1
+ASYNC_TRACE = False
+ASYNC_RING_CAPACITY = 65536  # max number of events waiting for the writer thread
+ASYNC_OVERFLOW_POLICY = "block"  # "block", "drop" or "sample" when the ring is full
+# with the "sample" policy, keep one in this many events on overflow
+ASYNC_SAMPLE_EVERY = 10
+# seconds between two drains of the ring by the writer thread
+ASYNC_FLUSH_INTERVAL = 0.05
+
+# sampling of API calls: "all", "first_n_then_k", "step_window" or "reservoir"
+# can be overridden in the traced process with the ML_DAIKON_SAMPLING_POLICY env var
+SAMPLING_POLICY = "all"
+SAMPLING_FIRST_N = 100  # "first_n_then_k": calls traced before sampling, "step_window": calls traced per step
+# "first_n_then_k": trace one in this many calls after the first N
+SAMPLING_EVERY_K = 100
+SAMPLING_RESERVOIR_SIZE = 20  # "reservoir": calls kept per API per step
+# the policy decides for every call by its own API, at every depth. With this, the calls made inside a traced
+# call are traced as well instead, so that every traced call has its traced parent (ML_DAIKON_SAMPLING_KEEP_NESTED)
+SAMPLING_KEEP_NESTED = False
+
+# which API calls are traced by their depth among the active traced calls: "all", "max_depth" (the calls up to
+# MAX_CALL_DEPTH, the outermost calls being at depth 0) or "outermost" (only the outermost calls). The deeper
+# calls are only counted (see call_counts), in the "events" API trace mode.
+# can be overridden in the traced process with the ML_DAIKON_CALL_DEPTH_MODE / _MAX_CALL_DEPTH env vars
+CALL_DEPTH_MODE = "all"
+MAX_CALL_DEPTH = 1
+
+# "events" traces every API call, "stats" only keeps per-(API, parent, step) counters and duration histograms
+# can be overridden in the traced process with the ML_DAIKON_API_TRACE_MODE env var
+API_TRACE_MODE = "events"
+# seconds between two dumps of the statistics in the "stats" mode
+STATS_DUMP_INTERVAL = 60.0
+
+# how the API calls are traced: "wrapper" (replace the functions with wrappers) or "monitoring"
+# (sys.monitoring on Python 3.12+, sys.setprofile before), can be overridden with ML_DAIKON_TRACING_BACKEND
+TRACING_BACKEND = "wrapper"
+
+# C-implemented torch ops (e.g. Tensor.add_) that cannot be wrapped: "off", "function" (TorchFunctionMode,
+# Python API names) or "dispatch" (TorchDispatchMode, ATen ops), can be overridden with ML_DAIKON_TRACE_TORCH_OPS
+TRACE_TORCH_OPS = "off"
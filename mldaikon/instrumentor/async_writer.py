@@ -0,0 +1,122 @@
+"""
+Asynchronous trace emission.
+
+The training thread only pushes a small (write_fn, trace, level) tuple into a bounded ring buffer.
+A background writer thread drains the ring and does the serialization and file I/O by calling write_fn.
+"""
+
+import collections
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES = ["block", "drop", "sample"]
+
+
+class AsyncTraceWriter:
+    """Bounded ring buffer drained by a daemon writer thread.
+
+    When the ring is full, the overflow policy decides what happens to a new event:
+        - "block": the producer waits until the writer thread has made room.
+        - "drop": the event is dropped and counted in `num_dropped`.
+        - "sample": only one in `sample_every` events is kept (and waits for room like "block"),
+            the rest are dropped and counted.
+
+    `flush` drains the ring in the calling thread, so events are never reordered: both the writer
+    thread and `flush` only write while holding `_drain_lock`.
+    """
+
+    def __init__(
+        self,
+        capacity: int,
+        overflow_policy: str,
+        sample_every: int,
+        flush_interval: float,
+    ):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(
+                f"Unsupported overflow policy: {overflow_policy}, expected one of {OVERFLOW_POLICIES}"
+            )
+        self.capacity = capacity
+        self.overflow_policy = overflow_policy
+        self.sample_every = max(1, sample_every)
+        self.flush_interval = flush_interval
+
+        self.num_dropped = 0
+        self._num_overflowed = 0
+
+        self._ring: collections.deque = collections.deque()
+        self._drain_lock = threading.Lock()
+        self._room = threading.Condition()
+        self._wakeup = threading.Event()
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._run, name="mldaikon-trace-writer", daemon=True
+        )
+        self._thread.start()
+
+    def push(self, item: tuple):
+        ring = self._ring
+        if len(ring) >= self.capacity:
+            if self.overflow_policy == "drop":
+                self.num_dropped += 1
+                return
+            if self.overflow_policy == "sample":
+                self._num_overflowed += 1
+                if self._num_overflowed % self.sample_every != 0:
+                    self.num_dropped += 1
+                    return
+            self._wakeup.set()
+            with self._room:
+                while len(ring) >= self.capacity and self._running:
+                    self._room.wait(self.flush_interval)
+        ring.append(item)
+        if len(ring) >= self.capacity // 2:
+            self._wakeup.set()
+
+    def _drain(self):
+        ring = self._ring
+        with self._drain_lock:
+            while ring:
+                write_fn, trace, level = ring.popleft()
+                try:
+                    write_fn(trace, level)
+                except Exception as e:
+                    logger.error(f"Failed to write trace event: {e}")
+        with self._room:
+            self._room.notify_all()
+
+    def _run(self):
+        while self._running:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self._drain()
+
+    def wake(self):
+        """Have the writer thread drain the ring now instead of at its next flush interval, without waiting."""
+        self._wakeup.set()
+
+    def flush(self):
+        """Write out all pending events in the calling thread."""
+        self._drain()
+
+    def close(self):
+        if not self._running:
+            return
+        self._running = False
+        self._wakeup.set()
+        self._thread.join()
+        self._drain()
+        if self.num_dropped > 0:
+            logger.warning(
+                f"Async trace writer dropped {self.num_dropped} events due to the '{self.overflow_policy}' overflow policy."
+            )
+
+    def before_fork(self):
+        """Flush and hold the drain lock so that the forked child never sees a half-written event."""
+        self.flush()
+        self._drain_lock.acquire()
+
+    def after_fork_in_parent(self):
+        self._drain_lock.release()
@@ -0,0 +1,429 @@
+"""
+Central trace collector for multi-process runs (DataLoader workers, DDP ranks).
+
+Without the collector every traced process writes its own trace files. With it, the processes of a run
+send their API and variable events in batches over a Unix domain socket to a single local collector
+process, which writes one columnar store (Arrow IPC or Parquet) per trace kind for the whole run:
+`{file_base}_collected_{part}.parquet`, where file_base is the trace file base of the first process
+that connected. Every event is tagged with the `rank` (RANK env var, None outside of torch.distributed)
+and the `worker_id` (DataLoader worker, None in the main process) of the process that recorded it.
+
+The collector merges the events by time: every connection has a watermark (the latest event time it
+has sent), and only the events that are not newer than the watermark of all the open connections are
+written. A process connects when it writes its first event and sends that event right away, so a new
+connection only holds the merge back briefly. A connection that has sent nothing for `watermark_timeout`
+seconds (e.g. an idle DataLoader worker) is left out of the merge until it sends again, and at most
+`max_pending` events are held back in any case, the older ones are then written even if a late event may
+still come. `read_trace_file` sorts the events anyway, the merge keeps the store (and the time range of
+its row groups) mostly in order.
+
+Only the events go through the collector. The side files of a process (function symbol table, context
+changes, clock anchors, instrumentation log and report) are small, keyed by its process_id, and partly
+written before its first event or after its sinks are closed, so every process keeps writing them next to
+its trace file base, where `read_trace_file` finds them from the path of the collected store.
+
+Wire format: frames of a little-endian u32 payload length followed by the payload, which is a JSON
+header line ({"kind", "file_base", "process_id", "rank", "worker_id"}) followed by one JSON line per
+event.
+"""
+
+import argparse
+import heapq
+import json
+import logging
+import os
+import selectors
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+import typing
+
+from mldaikon.config.config import (
+    COLLECTOR_MAX_PENDING,
+    COLLECTOR_WATERMARK_TIMEOUT,
+    COLUMNAR_BLOCK_SIZE,
+)
+from mldaikon.instrumentor.trace_writer import ColumnarTraceWriter
+
+logger = logging.getLogger(__name__)
+
+_FRAME_HEADER = struct.Struct("<I")
+
+
+def _get_rank() -> int | None:
+    rank = os.environ.get("RANK")
+    return int(rank) if rank is not None and rank.isdigit() else None
+
+
+def _get_worker_id() -> int | None:
+    # torch is only looked up, the collector does not need to import it. The worker info is read directly:
+    # get_worker_info() may be instrumented, and calling it from the sink would record (and write) an event.
+    worker = sys.modules.get("torch.utils.data._utils.worker")
+    worker_info = getattr(worker, "_worker_info", None)
+    return None if worker_info is None else worker_info.id
+
+
+class CollectorTraceSink:
+    """Sends the events of one trace kind of this process to the collector, in batches.
+
+    The first event is sent right away, then a batch is sent once it holds `batch_size` events or when
+    an event is written `flush_interval` seconds after the previous send. The rank is looked up once, the
+    worker_id on every event until it is known, as a DataLoader worker only gets its worker info after it
+    started tracing (the info is gone again when the worker loop ends).
+
+    Events recorded by a thread while it is writing to the sink (by traced code called from the sink) are
+    dropped instead of reentering it. If the collector goes away, the events are written to the local
+    NDJSON trace file of the process (`{file_base}.log`) instead.
+    """
+
+    def __init__(
+        self,
+        socket_path: str,
+        kind: str,
+        file_base: str,
+        batch_size: int,
+        flush_interval: float,
+    ):
+        self.kind = kind
+        self.file_base = os.path.abspath(file_base)
+        self.batch_size = batch_size
+        self.flush_interval_ns = int(flush_interval * 1e9)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(socket_path)
+        self._lines: list[str] = []
+        self._num_bytes = 0
+        self._lock = threading.Lock()
+        self._next_send_ns = 0
+        self._rank = _get_rank()
+        self._worker_id: int | None = None
+        # whether the current thread is writing to the sink
+        self._local = threading.local()
+        self._fallback_file: typing.TextIO | None = None
+        self.closed = False
+
+    def _send(self):
+        header = {
+            "kind": self.kind,
+            "file_base": self.file_base,
+            "process_id": os.getpid(),
+            "rank": self._rank,
+            "worker_id": self._worker_id,
+        }
+        payload = "\n".join([json.dumps(header)] + self._lines).encode()
+        try:
+            self._socket.sendall(_FRAME_HEADER.pack(len(payload)) + payload)
+        except OSError as e:
+            self._fall_back(e)
+            return
+        self._num_bytes += len(payload)
+        self._lines = []
+        self._next_send_ns = time.monotonic_ns() + self.flush_interval_ns
+
+    def _fall_back(self, error: OSError):
+        """Write the pending and the next events to the local trace file, the collector is gone."""
+        path = f"{self.file_base}.log"
+        logger.warning(
+            f"Lost the connection to the trace collector ({error}), writing the {self.kind} trace of process {os.getpid()} to {path}."
+        )
+        self._socket.close()
+        self._fallback_file = open(path, "a")
+        self._write_fallback(self._lines)
+        self._lines = []
+
+    def _write_fallback(self, lines: list[str]):
+        assert self._fallback_file is not None
+        for line in lines:
+            self._fallback_file.write(line + "\n")
+        self._fallback_file.flush()
+
+    def write(self, trace: dict):
+        local = self._local
+        if getattr(local, "writing", False):
+            return
+        line = json.dumps(trace)
+        if self._worker_id is None:
+            self._worker_id = _get_worker_id()
+        local.writing = True
+        try:
+            with self._lock:
+                if self.closed:
+                    return
+                if self._fallback_file is not None:
+                    self._write_fallback([line])
+                    return
+                self._lines.append(line)
+                if (
+                    len(self._lines) >= self.batch_size
+                    or time.monotonic_ns() >= self._next_send_ns
+                ):
+                    self._send()
+        finally:
+            local.writing = False
+
+    def flush(self):
+        self._local.writing = True
+        try:
+            with self._lock:
+                if self._lines and not self.closed and self._fallback_file is None:
+                    self._send()
+        finally:
+            self._local.writing = False
+
+    def close(self):
+        self._local.writing = True
+        try:
+            with self._lock:
+                if self.closed:
+                    return
+                try:
+                    if self._lines and self._fallback_file is None:
+                        self._send()
+                finally:
+                    if self._fallback_file is not None:
+                        self._fallback_file.close()
+                    else:
+                        self._socket.close()
+                    self.closed = True
+        finally:
+            self._local.writing = False
+
+    def paths(self) -> list[str]:
+        # the events end up in the store of the collector, or in the local file after losing it
+        return [] if self._fallback_file is None else [f"{self.file_base}.log"]
+
+    def num_bytes(self) -> int:
+        return self._num_bytes
+
+
+class _Connection:
+    def __init__(self, sock: socket.socket):
+        self.socket = sock
+        self.buffer = bytearray()
+        self.watermark: int | None = None
+        self.last_received_ns = time.monotonic_ns()
+
+
+class TraceCollector:
+    """Receives the events of all the traced processes of a run and writes them, merged by time, to one
+    columnar store per trace kind."""
+
+    def __init__(
+        self,
+        socket_path: str,
+        fmt: str,
+        block_size: int,
+        max_pending: int,
+        watermark_timeout: float,
+    ):
+        self.socket_path = socket_path
+        self.fmt = fmt
+        self.block_size = block_size
+        self.max_pending = max_pending
+        self.watermark_timeout_ns = int(watermark_timeout * 1e9)
+        self.writers: dict[str, ColumnarTraceWriter] = {}
+        self._pending: dict[str, list] = {}
+        self._num_pending = 0
+        self._order = 0  # tie breaker, keeps the arrival order of events with the same time and seq
+        self._connections: dict[int, _Connection] = {}
+        self._selector = selectors.DefaultSelector()
+        self._stopped = False
+
+    def stop(self, *args):
+        self._stopped = True
+
+    def serve(self):
+        """Accept connections and collect their events until `stop` is called (or SIGTERM / SIGINT)."""
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        server.listen()
+        server.setblocking(False)
+        self._selector.register(server, selectors.EVENT_READ)
+        try:
+            while not self._stopped:
+                for key, _ in self._selector.select(timeout=0.2):
+                    if key.fileobj is server:
+                        self._accept(server)
+                    else:
+                        self._read(self._connections[key.fd])
+                if self._num_pending:
+                    # the watermarks of silent connections expire without new data
+                    self._merge()
+            # read what the processes sent before they were stopped
+            ready = True
+            while ready:
+                ready = False
+                for key, _ in self._selector.select(timeout=0):
+                    if key.fileobj is not server:
+                        self._read(self._connections[key.fd])
+                        ready = True
+        finally:
+            self._selector.close()
+            server.close()
+            os.unlink(self.socket_path)
+            self.close()
+
+    def _accept(self, server: socket.socket):
+        sock, _ = server.accept()
+        sock.setblocking(False)
+        self._connections[sock.fileno()] = _Connection(sock)
+        self._selector.register(sock, selectors.EVENT_READ)
+
+    def _read(self, conn: _Connection):
+        try:
+            data = conn.socket.recv(1 << 20)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        conn.last_received_ns = time.monotonic_ns()
+        if not data:
+            self._selector.unregister(conn.socket)
+            del self._connections[conn.socket.fileno()]
+            conn.socket.close()
+            self._merge()
+            return
+
+        buffer = conn.buffer
+        buffer += data
+        offset = 0
+        while len(buffer) - offset >= _FRAME_HEADER.size:
+            (length,) = _FRAME_HEADER.unpack_from(buffer, offset)
+            end = offset + _FRAME_HEADER.size + length
+            if end > len(buffer):
+                break
+            self._add_frame(conn, bytes(buffer[offset + _FRAME_HEADER.size : end]))
+            offset = end
+        del buffer[:offset]
+        self._merge()
+
+    def _add_frame(self, conn: _Connection, payload: bytes):
+        lines = payload.split(b"\n")
+        header = json.loads(lines[0])
+        kind = header["kind"]
+        if kind not in self.writers:
+            self.writers[kind] = ColumnarTraceWriter(
+                f"{header['file_base']}_collected", self.fmt, self.block_size
+            )
+            self._pending[kind] = []
+        pending = self._pending[kind]
+        watermark = conn.watermark or 0
+        for line in lines[1:]:
+            trace = json.loads(line)
+            trace.setdefault("process_id", header["process_id"])
+            trace["rank"] = header["rank"]
+            trace["worker_id"] = header["worker_id"]
+            t = trace.get("time") or 0
+            if t > watermark:
+                watermark = t
+            self._order += 1
+            heapq.heappush(pending, (t, trace.get("seq") or 0, self._order, trace))
+        self._num_pending += len(lines) - 1
+        conn.watermark = watermark
+
+    def _merge(self, write_all: bool = False):
+        """Write the pending events that no open connection can precede anymore."""
+        # silent connections are left out until they send again, their late events are written out of order
+        expired_ns = time.monotonic_ns() - self.watermark_timeout_ns
+        watermarks = [
+            conn.watermark
+            for conn in self._connections.values()
+            if conn.last_received_ns > expired_ns
+        ]
+        if write_all or not watermarks:
+            watermark = None
+        elif None in watermarks:
+            # a new connection has not sent its first event yet
+            watermark = -1
+        else:
+            watermark = min(watermarks)
+        for kind, pending in self._pending.items():
+            writer = self.writers[kind]
+            while pending and (
+                watermark is None
+                or pending[0][0] <= watermark
+                or self._num_pending > self.max_pending
+            ):
+                writer.write(heapq.heappop(pending)[3])
+                self._num_pending -= 1
+
+    def close(self):
+        self._merge(write_all=True)
+        for kind, writer in self.writers.items():
+            writer.close()
+            logger.info(f"Collected {kind} trace written to {writer.paths()}")
+
+
+def start_collector(
+    socket_path: str,
+    fmt: str,
+    block_size: int,
+    max_pending: int,
+    watermark_timeout: float,
+) -> subprocess.Popen:
+    """Start the collector in a new process, returns once it accepts connections."""
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "mldaikon.instrumentor.collector",
+            "--socket",
+            socket_path,
+            "--format",
+            fmt,
+            "--block-size",
+            str(block_size),
+            "--max-pending",
+            str(max_pending),
+            "--watermark-timeout",
+            str(watermark_timeout),
+        ]
+    )
+    deadline = time.monotonic() + 30
+    while not os.path.exists(socket_path):
+        if process.poll() is not None:
+            raise RuntimeError(
+                f"The trace collector exited with code {process.returncode}"
+            )
+        if time.monotonic() > deadline:
+            process.kill()
+            raise TimeoutError("The trace collector did not start within 30s")
+        time.sleep(0.05)
+    return process
+
+
+def stop_collector(process: subprocess.Popen):
+    """Let the collector write the events it received and wait for it to exit."""
+    process.send_signal(signal.SIGTERM)
+    process.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Collect the traces of all the processes of a run into one columnar store"
+    )
+    parser.add_argument("--socket", type=str, required=True)
+    parser.add_argument("--format", choices=["arrow", "parquet"], default="parquet")
+    parser.add_argument("--block-size", type=int, default=COLUMNAR_BLOCK_SIZE)
+    parser.add_argument("--max-pending", type=int, default=COLLECTOR_MAX_PENDING)
+    parser.add_argument(
+        "--watermark-timeout", type=float, default=COLLECTOR_WATERMARK_TIMEOUT
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    collector = TraceCollector(
+        args.socket,
+        args.format,
+        args.block_size,
+        args.max_pending,
+        args.watermark_timeout,
+    )
+    signal.signal(signal.SIGTERM, collector.stop)
+    signal.signal(signal.SIGINT, collector.stop)
+    collector.serve()
@@ -0,0 +1,85 @@
+"""
+Flight-recorder mode of the tracer.
+
+Instead of being written, the API and variable events are kept in memory for the last `num_steps`
+training steps. The events of a step are encoded as JSON lines and compressed (zlib) in chunks of
+`chunk_size` events, the chunks of the oldest step are dropped when a new step starts, and the oldest
+chunks are dropped when the ring holds more than `max_bytes`. Nothing is written until a trigger fires
+(an exception, a NaN in an observed variable, a signal or a user callback), then the events in the ring
+are written to the trace files as usual and the ring starts over.
+"""
+
+import collections
+import json
+import threading
+import zlib
+
+
+class FlightRecorder:
+    def __init__(self, num_steps: int, max_bytes: int, chunk_size: int):
+        self.num_steps = max(1, num_steps)
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        # (step, kind, compressed JSON lines, number of events), oldest first
+        self._chunks: collections.deque[tuple] = collections.deque()
+        self._num_bytes = 0
+        # the steps in the ring, oldest first
+        self._steps: collections.deque = collections.deque()
+        # JSON lines of the chunks being filled, per kind
+        self._lines: dict[str, list[str]] = {}
+        self._lock = threading.Lock()
+        # events dropped to stay within max_bytes, before the end of their step range
+        self.num_dropped = 0
+        # set by a signal handler, the trigger fires with the next event / step
+        self.pending_trigger: str | None = None
+
+    def _seal(self, kind: str):
+        lines = self._lines.pop(kind, None)
+        if not lines:
+            return
+        data = zlib.compress("\n".join(lines).encode(), 1)
+        self._chunks.append((self._steps[-1], kind, data, len(lines)))
+        self._num_bytes += len(data)
+        while self._num_bytes > self.max_bytes and len(self._chunks) > 1:
+            self.num_dropped += self._drop_oldest_chunk()
+
+    def _drop_oldest_chunk(self) -> int:
+        _, _, data, count = self._chunks.popleft()
+        self._num_bytes -= len(data)
+        return count
+
+    def record(self, kind: str, trace: dict, step):
+        line = json.dumps(trace)
+        with self._lock:
+            if not self._steps or step != self._steps[-1]:
+                for pending_kind in list(self._lines):
+                    self._seal(pending_kind)
+                self._steps.append(step)
+                if len(self._steps) > self.num_steps:
+                    oldest = self._steps.popleft()
+                    while self._chunks and self._chunks[0][0] == oldest:
+                        self._drop_oldest_chunk()
+            lines = self._lines.setdefault(kind, [])
+            lines.append(line)
+            if len(lines) >= self.chunk_size:
+                self._seal(kind)
+
+    def steps(self) -> list:
+        with self._lock:
+            return list(self._steps)
+
+    def drain(self) -> list[tuple[str, dict]]:
+        """Take all the events out of the ring, as (kind, event) in recording order per kind."""
+        with self._lock:
+            for kind in list(self._lines):
+                self._seal(kind)
+            chunks = self._chunks
+            self._chunks = collections.deque()
+            self._num_bytes = 0
+        events = []
+        for _, kind, data, _ in chunks:
+            events.extend(
+                (kind, json.loads(line))
+                for line in zlib.decompress(data).decode().split("\n")
+            )
+        return events
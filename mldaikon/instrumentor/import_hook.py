@@ -0,0 +1,129 @@
+"""
+Instrumentation of the modules to instrument as they are imported, by any code of the process.
+
+Rewriting the imports of the main script only instruments the modules the script imports itself, the
+modules imported indirectly (e.g. by megatron or deepspeed, or lazily by torch) are missed or instrumented
+late. `install_import_hook` puts a finder in front of `sys.meta_path` that wraps the loader of every module
+to instrument, the loader instruments the module right after it is executed.
+
+A submodule imported while one of its parent packages is still being executed is left to the parent: the
+parent is instrumented once it is executed, and its walk covers the submodule. Modules already imported when
+the hook is installed are instrumented by `install_import_hook`. Every module is walked once, the hook and
+the Instrumentor calls of the program share the registry of instrumented modules of the tracer.
+
+The hook lives in the memory of the process, forked children inherit it and spawned children (which run the
+main script again) install it again with the instrumented main script.
+"""
+
+import importlib.abc
+import sys
+import types
+
+from mldaikon.instrumentor.tracer import (
+    Instrumentor,
+    get_instrumentation_logger_for_process,
+    instrumentation_rules,
+)
+
+
+def _matches(name: str, prefixes: list[str]) -> bool:
+    return any(name == prefix or name.startswith(prefix + ".") for prefix in prefixes)
+
+
+class _TracingLoader(importlib.abc.Loader):
+    """Executes the module with the original loader, then instruments it."""
+
+    def __init__(self, loader, finder: "TracerImportFinder"):
+        self.loader = loader
+        self.finder = finder
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module: types.ModuleType):
+        name = module.__name__
+        self.finder.executing.add(name)
+        try:
+            self.loader.exec_module(module)
+        finally:
+            self.finder.executing.discard(name)
+        self.finder.instrument(module)
+
+    def __getattr__(self, name):
+        # get_source, get_resource_reader, is_package, ... of the original loader
+        return getattr(self.loader, name)
+
+
+class TracerImportFinder(importlib.abc.MetaPathFinder):
+    def __init__(self, modules_to_instrument: list[str]):
+        self.modules_to_instrument = list(modules_to_instrument)
+        # modules to instrument that are being executed
+        self.executing: set[str] = set()
+
+    def should_instrument(self, name: str) -> bool:
+        return _matches(
+            name, self.modules_to_instrument
+        ) and instrumentation_rules.should_visit(name)
+
+    def find_spec(self, fullname, path, target=None):
+        if not self.should_instrument(fullname):
+            return None
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        # namespace packages have no loader, they have no code to instrument either
+        if spec.loader is not None and hasattr(spec.loader, "exec_module"):
+            spec.loader = _TracingLoader(spec.loader, self)
+        return spec
+
+    def instrument(self, module: types.ModuleType):
+        parts = module.__name__.split(".")
+        for i in range(1, len(parts)):
+            if ".".join(parts[:i]) in self.executing:
+                return
+        get_instrumentation_logger_for_process().debug(
+            f"Instrumenting {module.__name__} on import"
+        )
+        Instrumentor(module).instrument()
+
+
+import_hook: TracerImportFinder | None = None
+
+
+def install_import_hook(modules_to_instrument: list[str]) -> TracerImportFinder:
+    """Instrument the modules (and their submodules) already imported and the ones imported from now on."""
+    global import_hook
+    if import_hook is None:
+        import_hook = TracerImportFinder(modules_to_instrument)
+        sys.meta_path.insert(0, import_hook)
+    else:
+        import_hook.modules_to_instrument.extend(
+            name
+            for name in modules_to_instrument
+            if name not in import_hook.modules_to_instrument
+        )
+
+    # only the outermost imported modules, their walk covers their imported submodules
+    roots: list[str] = []
+    for name in sorted(sys.modules):
+        module = sys.modules[name]
+        if (
+            isinstance(module, types.ModuleType)
+            and import_hook.should_instrument(name)
+            and not _matches(name, roots)
+        ):
+            roots.append(name)
+            import_hook.instrument(module)
+    return import_hook
+
+
+def uninstall_import_hook():
+    global import_hook
+    if import_hook is not None:
+        sys.meta_path.remove(import_hook)
+        import_hook = None
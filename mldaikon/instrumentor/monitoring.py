@@ -0,0 +1,221 @@
+"""
+Tracing backend based on interpreter events instead of wrapper functions.
+
+The instrumented functions are left in place: their code objects are registered with a func_id, and the
+interpreter reports the start and the end of their calls. On Python 3.12+ this uses PEP 669
+`sys.monitoring`, with the start / return events only enabled on the registered code objects. Older
+versions fall back to `sys.setprofile` (and `threading.setprofile` for new threads), where every Python
+call goes through the profile function and is filtered by its code object.
+
+The calls are recorded through the same `begin_call` / `end_call` as the wrapper backend, so both produce
+the same API trace.
+
+Limitations:
+    - Only Python functions can be registered, builtins (C functions) have no code object.
+    - Generator and coroutine functions are not registered (their frames are suspended and resumed),
+        they stay with the wrapper backend.
+    - With the `sys.setprofile` fallback an exception unwinding a call cannot be told apart from a
+        return, so it is recorded as a regular post event.
+"""
+
+import logging
+import sys
+import threading
+import types
+
+logger = logging.getLogger(__name__)
+
+TRACING_BACKENDS = ["wrapper", "monitoring"]
+
+_CO_SUSPENDABLE = (
+    0x20  # CO_GENERATOR
+    | 0x80  # CO_COROUTINE
+    | 0x100  # CO_ITERABLE_COROUTINE
+    | 0x200  # CO_ASYNC_GENERATOR
+)
+
+HAS_SYS_MONITORING = hasattr(sys, "monitoring")
+
+
+class MonitoringBackend:
+    """Maps the code objects of the instrumented functions to their func_ids and records their calls.
+
+    args:
+        begin_call: Callable[[int], Any]
+            Called with the func_id when a call starts, returns the state passed to `end_call`.
+        end_call: Callable[[Any, BaseException | None, tuple, dict | None], None]
+            Called when the call returns (exception None) or is unwound by an exception.
+
+    On Python 3.12+, the profiler tool ID of sys.monitoring is claimed right away, a ValueError is raised if
+    another tool (e.g. a profiler) holds it.
+    """
+
+    def __init__(self, begin_call, end_call):
+        self.begin_call = begin_call
+        self.end_call = end_call
+        self.code_ids: dict[types.CodeType, int] = {}
+        self.started = False
+        self._stacks = threading.local()
+        self._has_tool_id = False
+        if HAS_SYS_MONITORING:
+            self._claim_tool_id()
+
+    def get_stack(self) -> list:
+        """Per-thread stack of the `begin_call` states of the active calls."""
+        try:
+            return self._stacks.stack
+        except AttributeError:
+            self._stacks.stack = []
+            return self._stacks.stack
+
+    def reset_stacks(self):
+        """Forget the active calls of every thread, e.g. the calls of the parent in a forked child."""
+        self._stacks = threading.local()
+
+    def add_function(self, func, func_id: int) -> bool:
+        """Register a function, returns False if it cannot be traced by this backend."""
+        if not isinstance(func, types.FunctionType):
+            return False
+        code = func.__code__
+        if code.co_flags & _CO_SUSPENDABLE:
+            return False
+        if code in self.code_ids:
+            # functions sharing a code object are reported under the first registered name
+            return True
+        self.code_ids[code] = func_id
+        if self.started and HAS_SYS_MONITORING:
+            self._set_local_events(code)
+        return True
+
+    def start(self):
+        if self.started:
+            return
+        if HAS_SYS_MONITORING:
+            if not self._has_tool_id:
+                # freed by a previous `stop`
+                try:
+                    self._claim_tool_id()
+                except ValueError as e:
+                    logger.warning(
+                        f"Cannot use sys.monitoring ({e}), the calls of the functions registered with it are not traced."
+                    )
+                    return
+            self.started = True
+            self._start_sys_monitoring()
+        else:
+            self.started = True
+            sys.setprofile(self._profile)
+            threading.setprofile(self._profile)
+
+    def stop(self):
+        """Stop recording calls and release the sys.monitoring tool ID."""
+        if not self.started:
+            if self._has_tool_id:
+                sys.monitoring.free_tool_id(sys.monitoring.PROFILER_ID)
+                self._has_tool_id = False
+            return
+        self.started = False
+        if HAS_SYS_MONITORING:
+            tool_id = sys.monitoring.PROFILER_ID
+            sys.monitoring.set_events(tool_id, sys.monitoring.events.NO_EVENTS)
+            for code in self.code_ids:
+                sys.monitoring.set_local_events(
+                    tool_id, code, sys.monitoring.events.NO_EVENTS
+                )
+            for event in (
+                sys.monitoring.events.PY_START,
+                sys.monitoring.events.PY_RETURN,
+                sys.monitoring.events.PY_UNWIND,
+            ):
+                sys.monitoring.register_callback(tool_id, event, None)
+            sys.monitoring.free_tool_id(tool_id)
+            self._has_tool_id = False
+        else:
+            sys.setprofile(None)
+            threading.setprofile(None)  # type: ignore
+
+    # sys.monitoring (Python 3.12+)
+
+    def _claim_tool_id(self):
+        # raises a ValueError if the tool ID is in use
+        sys.monitoring.use_tool_id(sys.monitoring.PROFILER_ID, "mldaikon")
+        self._has_tool_id = True
+
+    def _start_sys_monitoring(self):
+        monitoring = sys.monitoring
+        tool_id = monitoring.PROFILER_ID
+        monitoring.register_callback(
+            tool_id, monitoring.events.PY_START, self._on_py_start
+        )
+        monitoring.register_callback(
+            tool_id, monitoring.events.PY_RETURN, self._on_py_return
+        )
+        monitoring.register_callback(
+            tool_id, monitoring.events.PY_UNWIND, self._on_py_unwind
+        )
+        # PY_UNWIND can only be enabled globally, the callback filters it by code object
+        monitoring.set_events(tool_id, monitoring.events.PY_UNWIND)
+        for code in self.code_ids:
+            self._set_local_events(code)
+
+    def _set_local_events(self, code: types.CodeType):
+        events = sys.monitoring.events
+        sys.monitoring.set_local_events(
+            sys.monitoring.PROFILER_ID, code, events.PY_START | events.PY_RETURN
+        )
+
+    def _on_py_start(self, code, instruction_offset):
+        func_id = self.code_ids.get(code)
+        if func_id is not None:
+            self.get_stack().append(self.begin_call(func_id))
+
+    def _on_py_return(self, code, instruction_offset, retval):
+        if code in self.code_ids:
+            stack = self.get_stack()
+            if stack:
+                self.end_call(stack.pop())
+
+    def _on_py_unwind(self, code, instruction_offset, exception):
+        if code in self.code_ids:
+            stack = self.get_stack()
+            if stack:
+                # the frame being unwound is the innermost frame running the code object, the callback is
+                # not given the frame itself
+                frame = sys._getframe(1)
+                while frame is not None and frame.f_code is not code:
+                    frame = frame.f_back
+                args = () if frame is None else _get_args(frame, code)
+                self.end_call(stack.pop(), exception, args, None)
+
+    # sys.setprofile fallback
+
+    def _profile(self, frame, event, arg):
+        if event == "call":
+            func_id = self.code_ids.get(frame.f_code)
+            if func_id is not None:
+                self.get_stack().append(self.begin_call(func_id))
+        elif event == "return":
+            if frame.f_code in self.code_ids:
+                stack = self.get_stack()
+                if stack:
+                    self.end_call(stack.pop())
+
+
+def _get_args(frame, code: types.CodeType) -> tuple:
+    """Current values of the arguments of a frame (they may have been reassigned by the function)."""
+    num_args = code.co_argcount + code.co_kwonlyargcount
+    f_locals = frame.f_locals
+    return tuple(
+        f_locals[name] for name in code.co_varnames[:num_args] if name in f_locals
+    )
+
+
+def make_monitoring_backend(begin_call, end_call) -> MonitoringBackend | None:
+    """Create the monitoring backend, None (the wrapper backend is used instead) if it cannot be used."""
+    try:
+        return MonitoringBackend(begin_call, end_call)
+    except ValueError as e:
+        logger.warning(
+            f"Cannot use sys.monitoring ({e}), falling back to the wrapper tracing backend."
+        )
+        return None
@@ -0,0 +1,162 @@
+"""
+Profile-guided instrumentation: find the functions whose wrappers cost the most and exclude them.
+
+Some instrumented functions (tiny helpers of torch.nn.modules.module, torch._utils, ...) are called orders of
+magnitude more often than the APIs invariants are about, and most of the tracing overhead goes into them.
+The workflow has two passes:
+    1. a short profiling run (INSTRUMENTATION_PROFILE / ML_DAIKON_INSTRUMENTATION_PROFILE=1) in the tracing
+       mode of the real runs: every process counts the calls of every wrapped function and measures the time
+       spent in its wrapper, outside of the function itself (recording the events included), and writes them
+       to `{script}_mldaikon_instrumentation_profile_{time}_{pid}.json` at exit.
+    2. `python -m mldaikon.instrumentor.overhead_profile <profiles> --output exclude.json` (--budget) sums
+       the profiles up and excludes the functions with the highest overhead until the overhead of the others
+       fits in the budget (INSTRUMENTATION_OVERHEAD_BUDGET), a fraction of the run time without the tracing
+       overhead. The output is loaded by later runs with INSTRUMENTATION_EXCLUDE_FILE
+       (ML_DAIKON_INSTRUMENTATION_EXCLUDE_FILE).
+
+Functions are grouped by their traced name (`module.function`), a group holds the qualified names the
+instrumentor wrapped under it (e.g. the `forward` of every class of torch.nn.modules.linear), all of which are
+excluded together with exact rules.
+"""
+
+import argparse
+import glob
+import json
+import re
+import time
+
+from mldaikon.config.config import INSTRUMENTATION_OVERHEAD_BUDGET
+
+
+class InstrumentationProfile:
+    def __init__(self):
+        self.start_ns = time.perf_counter_ns()
+        # func_id -> [number of calls, time spent in the wrapper]
+        self.functions: dict[int, list[int]] = {}
+
+    def record(self, func_id: int, overhead_ns: int):
+        # not locked, a call lost to a race between threads does not matter for the profile
+        entry = self.functions.get(func_id)
+        if entry is None:
+            entry = self.functions[func_id] = [0, 0]
+        entry[0] += 1
+        entry[1] += overhead_ns
+
+    def to_dict(
+        self, function_names: list[str], function_rule_names: dict[int, set[str]]
+    ) -> dict:
+        """`function_rule_names` maps a func_id to the qualified names of the functions wrapped under it, the
+        names the instrumentation rules match them by."""
+        return {
+            "wall_ns": time.perf_counter_ns() - self.start_ns,
+            "functions": [
+                {
+                    "function": function_names[func_id],
+                    "names": sorted(function_rule_names.get(func_id, [])),
+                    "num_calls": num_calls,
+                    "overhead_ns": overhead_ns,
+                }
+                for func_id, (num_calls, overhead_ns) in self.functions.items()
+            ],
+        }
+
+
+def build_exclusion_list(profiles: list[dict], budget: float) -> dict:
+    """Exclude the functions with the highest wrapper overhead until the overhead left is at most `budget`
+    times the run time without it (summed over the processes of the profiles)."""
+    functions: dict[str, dict] = {}
+    wall_ns = 0
+    for profile in profiles:
+        wall_ns += profile["wall_ns"]
+        for record in profile["functions"]:
+            entry = functions.setdefault(
+                record["function"],
+                {
+                    "function": record["function"],
+                    "names": set(),
+                    "num_calls": 0,
+                    "overhead_ns": 0,
+                },
+            )
+            entry["names"].update(record["names"])
+            entry["num_calls"] += record["num_calls"]
+            entry["overhead_ns"] += record["overhead_ns"]
+
+    overhead_ns = sum(entry["overhead_ns"] for entry in functions.values())
+    baseline_ns = max(wall_ns - overhead_ns, 0)
+    allowed_ns = budget * baseline_ns
+
+    excluded = []
+    remaining_ns = overhead_ns
+    for entry in sorted(
+        functions.values(), key=lambda entry: entry["overhead_ns"], reverse=True
+    ):
+        if remaining_ns <= allowed_ns:
+            break
+        if not entry["names"]:
+            # not wrapped by the instrumentor (e.g. traced by a torch op mode), cannot be excluded
+            continue
+        remaining_ns -= entry["overhead_ns"]
+        excluded.append(entry)
+
+    return {
+        "budget": budget,
+        "baseline_ms": round(baseline_ns / 1e6, 3),
+        "overhead_ms": round(overhead_ns / 1e6, 3),
+        "remaining_overhead_ms": round(remaining_ns / 1e6, 3),
+        "excluded": [
+            {
+                "function": entry["function"],
+                "num_calls": entry["num_calls"],
+                "overhead_ms": round(entry["overhead_ns"] / 1e6, 3),
+            }
+            for entry in excluded
+        ],
+        # exact rules, a prefix rule for "torch.nn.Module.to" would exclude "torch.nn.Module.to_empty" as well
+        "exclude": [
+            f"re:{re.escape(name)}$"
+            for entry in excluded
+            for name in sorted(entry["names"])
+        ],
+    }
+
+
+def load_exclusion_list(path: str) -> list[str]:
+    """The exclude rules of a file written by `build_exclusion_list` (or a plain JSON list of rules)."""
+    with open(path, "r") as f:
+        exclusions = json.load(f)
+    if isinstance(exclusions, dict):
+        exclusions = exclusions["exclude"]
+    return exclusions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build the exclusion list of the functions with the highest tracing overhead from instrumentation profiles"
+    )
+    parser.add_argument(
+        "profiles",
+        nargs="+",
+        help="The profiles of a profiling run, *_mldaikon_instrumentation_profile_*.json (globs are expanded)",
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=INSTRUMENTATION_OVERHEAD_BUDGET,
+        help="Tracing overhead allowed, as a fraction of the run time without it",
+    )
+    parser.add_argument("--output", type=str, required=True)
+    args = parser.parse_args()
+
+    profiles = []
+    for pattern in args.profiles:
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            with open(path, "r") as f:
+                profiles.append(json.load(f))
+    exclusions = build_exclusion_list(profiles, args.budget)
+    with open(args.output, "w") as f:
+        json.dump(exclusions, f, indent=2)
+    print(
+        f"Excluded {len(exclusions['excluded'])} functions, estimated tracing overhead {exclusions['overhead_ms']} ms -> "
+        f"{exclusions['remaining_overhead_ms']} ms for {exclusions['baseline_ms']} ms of run time"
+    )
@@ -0,0 +1,111 @@
+"""
+Persistent cache of instrumentation plans.
+
+Walking `dir()` of every submodule and class of torch takes seconds, and it is repeated by every launch and
+every spawned process (e.g. DataLoader workers with the "spawn" start method). The walk is deterministic for
+a given torch version, Python version, instrumentation config and set of loaded modules of the target's
+package (with their code), so the first run records its result, the plan, and the later runs only apply it.
+
+A plan lists the owners (modules and classes) the walk visited and the functions it patched, as
+(owner path, attribute name, kind) where the owner path is the dotted attribute path from the instrumented
+target to the owner ("" for the target itself) and kind is how the function is traced ("wrapper" or
+"monitoring"). The walk does not enter the owners instrumented before by another target, their paths are
+listed in the plan too, and the plan only applies if they are instrumented already. Plans are stored as
+`plan_{hash of the key}.json` files in the cache directory.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sys
+import tempfile
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# bump when the format of the plans or the way they are recorded changes
+PLAN_FORMAT_VERSION = 2
+
+
+def code_fingerprint(target_name: str) -> str:
+    """Hash of the loaded modules of the package of the target: their names, and the paths, modification
+    times and sizes of their files. The walk only reaches loaded modules, and their code decides what it finds.
+    """
+    package = target_name.split(".")[0]
+    prefix = f"{package}."
+    digest = hashlib.sha256()
+    for name, module in sorted(list(sys.modules.items()), key=lambda item: item[0]):
+        if module is None or not (name == package or name.startswith(prefix)):
+            continue
+        digest.update(name.encode())
+        path = getattr(module, "__file__", None)
+        if path is None:
+            continue
+        try:
+            stat = os.stat(path)
+        except (OSError, TypeError):
+            continue
+        digest.update(f"{path}:{stat.st_mtime_ns}:{stat.st_size}".encode())
+    return digest.hexdigest()
+
+
+def plan_cache_key(target_name: str, config: dict) -> dict:
+    """Everything the result of the walk depends on, the config must only hold JSON values."""
+    return {
+        "format": PLAN_FORMAT_VERSION,
+        "python": sys.version,
+        "torch": torch.__version__,
+        "target": target_name,
+        "code": code_fingerprint(target_name),
+        "config": config,
+    }
+
+
+def _plan_path(cache_dir: str, key: dict) -> str:
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+    return os.path.join(cache_dir, f"plan_{digest[:16]}.json")
+
+
+def load_plan(cache_dir: str, key: dict) -> dict | None:
+    """The plan recorded for the key, None if there is none (or it cannot be read)."""
+    path = _plan_path(cache_dir, key)
+    try:
+        with open(path, "r") as f:
+            plan = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Cannot read the instrumentation plan {path}: {e}")
+        return None
+    if plan.get("key") != key:
+        return None
+    return plan
+
+
+def save_plan(
+    cache_dir: str,
+    key: dict,
+    owners: list[str],
+    functions: list[tuple[str, str, str]],
+    instrumented_before: list[str],
+):
+    """Store a plan, atomically as concurrent processes may record the same plan."""
+    path = _plan_path(cache_dir, key)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(
+                {
+                    "key": key,
+                    "owners": owners,
+                    "functions": functions,
+                    "instrumented_before": instrumented_before,
+                },
+                f,
+            )
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"Cannot write the instrumentation plan {path}: {e}")
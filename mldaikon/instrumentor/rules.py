@@ -0,0 +1,137 @@
+"""
+Include / exclude rules selecting what the instrumentor wraps, matched against qualified names
+(`typename`, e.g. "torch.nn.functional.relu" or "torch.optim.sgd.SGD.step").
+
+A rule is one of:
+    - a prefix ("torch.fx"): matches every name starting with it, like the former `modules_to_skip`.
+    - a glob ("torch.optim.*.step", with `*`, `?` or `[...]`): matches the whole name, `*` also matches dots.
+    - a regex prefixed with "re:" ("re:torch\\.nn\\..*_fn$"): matches from the start of the name.
+
+A function is instrumented if no exclude rule matches its name and, when there are include rules, one of
+them matches it. A module or class is walked if no exclude rule matches it and, when there are include
+rules, it may hold an included function: an include rule matches it, or its name is a prefix of an include
+prefix (or of the literal part of an include glob). Include regexes cannot be analyzed, with one of them
+every module and class that is not excluded is walked.
+
+The prefixes are compiled into a character trie, so checking a name costs at most its length whatever the
+number of rules, and the globs and regexes of a kind into a single regex. Decisions are memoized per name.
+"""
+
+import fnmatch
+import re
+
+_GLOB_CHARS = re.compile(r"[*?\[]")
+
+
+class _TrieNode:
+    __slots__ = ["children", "terminal", "has_terminal_below"]
+
+    def __init__(self):
+        self.children: dict[str, _TrieNode] = {}
+        self.terminal = False  # a prefix ends here
+        self.has_terminal_below = False
+
+
+class _PrefixTrie:
+    def __init__(self, prefixes: list[str]):
+        self.root = _TrieNode()
+        for prefix in prefixes:
+            node = self.root
+            for char in prefix:
+                node.has_terminal_below = True
+                node = node.children.setdefault(char, _TrieNode())
+            node.terminal = True
+
+    def match(self, name: str) -> bool:
+        """Whether a prefix of the trie is a prefix of the name."""
+        node = self.root
+        if node.terminal:
+            return True
+        for char in name:
+            node = node.children.get(char)
+            if node is None:
+                return False
+            if node.terminal:
+                return True
+        return False
+
+    def is_prefix_of_entry(self, name: str) -> bool:
+        """Whether the name is a (strict) prefix of a prefix of the trie."""
+        node = self.root
+        for char in name:
+            node = node.children.get(char)
+            if node is None:
+                return False
+        return node.has_terminal_below
+
+
+class _CompiledRules:
+    def __init__(self, rules: list[str]):
+        self.rules = rules
+        prefixes = []
+        patterns = []
+        # literal part of the globs, the names that may hold a match of a glob start with it (or are part of it)
+        self.glob_prefixes: list[str] = []
+        self.has_regex = False
+        for rule in rules:
+            if rule.startswith("re:"):
+                patterns.append(f"(?:{rule[3:]})")
+                self.has_regex = True
+                continue
+            glob_char = _GLOB_CHARS.search(rule)
+            if glob_char is None:
+                prefixes.append(rule)
+            else:
+                patterns.append(f"(?:{fnmatch.translate(rule)})")
+                self.glob_prefixes.append(rule[: glob_char.start()])
+        self.trie = _PrefixTrie(prefixes)
+        self.pattern = re.compile("|".join(patterns)) if patterns else None
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    def match(self, name: str) -> bool:
+        return self.trie.match(name) or (
+            self.pattern is not None and self.pattern.match(name) is not None
+        )
+
+    def may_match_inside(self, name: str) -> bool:
+        """Whether a name inside the module / class `name` may match."""
+        if self.has_regex:
+            return True
+        if self.trie.is_prefix_of_entry(name + "."):
+            return True
+        return any(
+            prefix.startswith(name) or name.startswith(prefix)
+            for prefix in self.glob_prefixes
+        )
+
+
+class InstrumentationRules:
+    def __init__(self, include: list[str], exclude: list[str]):
+        self.include = list(include)
+        self.exclude = list(exclude)
+        self._include = _CompiledRules(self.include)
+        self._exclude = _CompiledRules(self.exclude)
+        self._functions: dict[str, bool] = {}
+        self._containers: dict[str, bool] = {}
+
+    def should_instrument(self, name: str) -> bool:
+        """Whether the function with this qualified name is instrumented."""
+        decision = self._functions.get(name)
+        if decision is None:
+            decision = self._functions[name] = not self._exclude.match(name) and (
+                not self._include or self._include.match(name)
+            )
+        return decision
+
+    def should_visit(self, name: str) -> bool:
+        """Whether the module / class with this qualified name is walked."""
+        decision = self._containers.get(name)
+        if decision is None:
+            decision = self._containers[name] = not self._exclude.match(name) and (
+                not self._include
+                or self._include.match(name)
+                or self._include.may_match_inside(name)
+            )
+        return decision
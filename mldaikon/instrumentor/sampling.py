@@ -0,0 +1,166 @@
+"""
+Per-API sampling policies for the function call tracer.
+
+The policy decides for every call by its own API, at every depth, so a nested call can be traced while the
+call it is made from is not (its parent_call_id is then missing from the trace). With SAMPLING_KEEP_NESTED,
+a decision is only made for the calls that are not inside a traced call instead: once a call is traced,
+everything it calls is traced as well, so that the containment between traced calls stays exact.
+Every call is counted no matter the decision, the exact per-API counts are dumped at exit so that the
+analysis can compare them with the number of calls that made it into the trace.
+"""
+
+import random
+import threading
+
+SAMPLING_POLICIES = ["all", "first_n_then_k", "step_window", "reservoir"]
+
+
+class SamplingPolicy:
+    """Base policy, traces everything."""
+
+    # set when buffered events are waiting to be written with `flush`
+    has_pending = False
+
+    def __init__(self):
+        self.num_calls: dict[int, int] = {}
+
+    def sample(self, func_id: int, inherited: bool, step) -> bool | list:
+        """Count the call and decide whether it is traced.
+
+        args:
+            func_id: int
+                The ID of the called function.
+            inherited: bool
+                Whether the call is inside a traced call whose nested calls are kept, in which case it is
+                always traced.
+            step:
+                The current training step (meta_vars["step"]), None if unknown.
+
+        returns:
+            False if the call is not traced, True if its events are written right away, or a list that
+            the events of the call (and of the calls it makes) should be buffered into.
+        """
+        self.num_calls[func_id] = self.num_calls.get(func_id, 0) + 1
+        return inherited or self._decide(func_id, step)
+
+    def _decide(self, func_id: int, step) -> bool:
+        return True
+
+    def flush(self, write_fn, final: bool = False):
+        """Write out buffered events with write_fn(trace, level), `final` also writes the ones that
+        could still change (e.g. the reservoirs of the current step)."""
+        pass
+
+
+class FirstNThenEveryKPolicy(SamplingPolicy):
+    """Trace the first `first_n` calls of every API, then one in every `every_k` calls."""
+
+    def __init__(self, first_n: int, every_k: int):
+        super().__init__()
+        self.first_n = first_n
+        self.every_k = max(1, every_k)
+        self._num_decided: dict[int, int] = {}
+
+    def _decide(self, func_id: int, step) -> bool:
+        n = self._num_decided.get(func_id, 0)
+        self._num_decided[func_id] = n + 1
+        return n < self.first_n or (n - self.first_n) % self.every_k == 0
+
+
+class StepWindowPolicy(SamplingPolicy):
+    """Trace the first `first_n` calls of every API in each training step."""
+
+    def __init__(self, first_n: int):
+        super().__init__()
+        self.first_n = first_n
+        self._step = None
+        self._num_decided: dict[int, int] = {}
+
+    def _decide(self, func_id: int, step) -> bool:
+        if step != self._step:
+            self._step = step
+            self._num_decided = {}
+        n = self._num_decided.get(func_id, 0)
+        self._num_decided[func_id] = n + 1
+        return n < self.first_n
+
+
+class ReservoirPolicy(SamplingPolicy):
+    """Keep a uniform random sample of `size` calls of every API in each training step.
+
+    The events of the sampled calls are buffered and only written when the step changes (or at exit),
+    as a call in the reservoir can still be evicted by a later one. A call that is still running when its
+    step is flushed only gets the events recorded so far.
+    """
+
+    def __init__(self, size: int):
+        super().__init__()
+        self.size = size
+        self._step = None
+        self._num_decided: dict[int, int] = {}
+        self._reservoirs: dict[int, list[list]] = {}
+        self._lock = threading.Lock()
+        self._pending: list[list] = []
+
+    def sample(self, func_id: int, inherited: bool, step) -> bool | list:
+        self.num_calls[func_id] = self.num_calls.get(func_id, 0) + 1
+        if inherited:
+            return True
+
+        with self._lock:
+            if step != self._step:
+                self._step = step
+                self._pending.extend(
+                    buffer
+                    for reservoir in self._reservoirs.values()
+                    for buffer in reservoir
+                )
+                self._reservoirs = {}
+                self._num_decided = {}
+                self.has_pending = len(self._pending) > 0
+
+            n = self._num_decided.get(func_id, 0) + 1
+            self._num_decided[func_id] = n
+            reservoir = self._reservoirs.setdefault(func_id, [])
+            buffer: list = []
+            if len(reservoir) < self.size:
+                reservoir.append(buffer)
+            else:
+                j = random.randrange(n)
+                if j >= self.size:
+                    return False
+                reservoir[j] = buffer
+        return buffer
+
+    def flush(self, write_fn, final: bool = False):
+        with self._lock:
+            buffers = self._pending
+            self._pending = []
+            self.has_pending = False
+            if final:
+                buffers.extend(
+                    buffer
+                    for reservoir in self._reservoirs.values()
+                    for buffer in reservoir
+                )
+                self._reservoirs = {}
+        for buffer in buffers:
+            for trace, level in buffer:
+                write_fn(trace, level)
+
+
+def make_sampling_policy(
+    name: str, first_n: int, every_k: int, reservoir_size: int
+) -> SamplingPolicy | None:
+    """Create the sampling policy by name, "all" means no sampling (None)."""
+    if name == "all":
+        return None
+    if name == "first_n_then_k":
+        return FirstNThenEveryKPolicy(first_n, every_k)
+    if name == "step_window":
+        return StepWindowPolicy(first_n)
+    if name == "reservoir":
+        return ReservoirPolicy(reservoir_size)
+    raise ValueError(
+        f"Unsupported sampling policy: {name}, expected one of {SAMPLING_POLICIES}"
+    )
@@ -1,7 +1,7 @@
 import ast
 import logging
 
-from mldaikon.config.config import MODULES_TO_INSTRUMENT
+from mldaikon.config.config import IMPORT_INSTRUMENTATION, MODULES_TO_INSTRUMENT
 
 logger = logging.getLogger(__name__)
 
@@ -87,23 +87,47 @@ def instrument_source(source: str, modules_to_instrument: list[str]) -> str:
 
 
 def instrument_file(
-    path: str, modules_to_instrument: list[str], disable_proxy_class
+    path: str,
+    modules_to_instrument: list[str],
+    disable_proxy_class,
+    import_instrumentation: str = IMPORT_INSTRUMENTATION,
 ) -> str:
     """
     Instruments the given file and returns the instrumented source code.
+
+    With import_instrumentation "hook", the source is not rewritten: an import hook installed at the top of
+    the file instruments the modules whenever they are imported. With "ast", the imports of the file are
+    followed by Instrumentor calls.
     """
 
     with open(path, "r") as file:
         source = file.read()
 
-    # instrument APIs
-    instrumented_source = instrument_source(source, modules_to_instrument)
-
     logging_code = """
 import os
 os.environ['MAIN_SCRIPT_NAME'] = os.path.basename(__file__).split(".")[0]    
 """
 
+    # instrument APIs
+    if import_instrumentation == "hook":
+        if modules_to_instrument is None:
+            modules_to_instrument = MODULES_TO_INSTRUMENT
+        if not modules_to_instrument:
+            logger.warning(
+                "modules_to_instrument is empty, not instrumenting any module."
+            )
+        instrumented_source = source
+        logging_code += f"""
+from mldaikon.instrumentor.import_hook import install_import_hook
+install_import_hook({list(modules_to_instrument)!r})
+"""
+    elif import_instrumentation == "ast":
+        instrumented_source = instrument_source(source, modules_to_instrument)
+    else:
+        raise ValueError(
+            f"Unsupported import instrumentation: {import_instrumentation}, expected one of ['hook', 'ast']"
+        )
+
     if not disable_proxy_class:
         # find the main() function
         main_func = None
@@ -168,6 +192,12 @@ if __name__ == "__main__":
         action="store_true",
         help="Disable the proxy class",
     )
+    parser.add_argument(
+        "--import-instrumentation",
+        choices=["hook", "ast"],
+        default=IMPORT_INSTRUMENTATION,
+        help="Instrument the modules with an import hook or by rewriting the imports of the file",
+    )
 
     args = parser.parse_args()
 
@@ -178,6 +208,9 @@ if __name__ == "__main__":
 
     # instrument the source file
     instrumented_source = instrument_file(
-        args.path, args.modules_to_instrument, args.disable_proxy_class
+        args.path,
+        args.modules_to_instrument,
+        args.disable_proxy_class,
+        args.import_instrumentation,
     )[0]
     print(instrumented_source)
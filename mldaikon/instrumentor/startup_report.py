@@ -0,0 +1,96 @@
+"""
+Startup report of the instrumentor.
+
+The instrumentation log only gets one line per attribute in the verbose mode (INSTRUMENTATION_VERBOSE).
+Instead, the instrumentor records in every process:
+    - the instrumented targets: how they were instrumented ("walk", "plan", "lazy" or "already_instrumented"),
+      wall time and number of functions wrapped.
+    - every module and class it visited: wall time including ("total_ms") and excluding ("self_ms") the
+      modules and classes visited from it, attributes scanned and functions wrapped. Lazily instrumented
+      modules count the attributes looked up so far, their time is not measured.
+    - the number of skipped attributes per reason.
+
+The report is one JSON object per process, `{script}_mldaikon_instrumentation_report_{time}_{pid}.json`,
+written once at exit. Owners are listed as rows of `owner_columns`, the ones with the highest total time first.
+"""
+
+import time
+
+OWNER_COLUMNS = ["name", "kind", "total_ms", "self_ms", "attributes", "wrapped"]
+
+
+class InstrumentationReport:
+    def __init__(self):
+        self.targets: list[dict] = []
+        # owner name -> [kind, total_ns, self_ns, attributes, wrapped]
+        self.owners: dict[str, list] = {}
+        self.skipped: dict[str, int] = {}
+        # owners being walked: [name, start_ns, time spent in the owners walked from it]
+        self._stack: list[list] = []
+
+    def add_owner(self, name: str, kind: str):
+        if name not in self.owners:
+            self.owners[name] = [kind, 0, 0, 0, 0]
+
+    def begin_owner(self, name: str, kind: str):
+        self.add_owner(name, kind)
+        self._stack.append([name, time.perf_counter_ns(), 0])
+
+    def end_owner(self):
+        name, start_ns, child_ns = self._stack.pop()
+        total_ns = time.perf_counter_ns() - start_ns
+        entry = self.owners[name]
+        entry[1] += total_ns
+        entry[2] += total_ns - child_ns
+        if self._stack:
+            self._stack[-1][2] += total_ns
+
+    def record(self, owner: str, outcome: str):
+        """Count an attribute of the owner, outcome is "wrapped", "visited" (a module / class walked in turn)
+        or the reason it was skipped."""
+        entry = self.owners.get(owner)
+        if entry is None:
+            entry = self.owners[owner] = ["unknown", 0, 0, 0, 0]
+        entry[3] += 1
+        if outcome == "wrapped":
+            entry[4] += 1
+        elif outcome != "visited":
+            self.skipped[outcome] = self.skipped.get(outcome, 0) + 1
+
+    def add_target(self, name: str, method: str, wrapped: int, duration_ns: int):
+        self.targets.append(
+            {
+                "target": name,
+                "method": method,
+                "ms": round(duration_ns / 1e6, 3),
+                "wrapped": wrapped,
+            }
+        )
+
+    def to_dict(self, max_owners: int = 0) -> dict:
+        """The report, with the `max_owners` owners with the highest total time (all of them if 0)."""
+        owners = sorted(self.owners.items(), key=lambda item: item[1][1], reverse=True)
+        if max_owners > 0:
+            owners = owners[:max_owners]
+        return {
+            "total_ms": round(sum(target["ms"] for target in self.targets), 3),
+            "targets": self.targets,
+            "owners_visited": len(self.owners),
+            "attributes_scanned": sum(entry[3] for entry in self.owners.values()),
+            "functions_wrapped": sum(entry[4] for entry in self.owners.values()),
+            "skipped": dict(
+                sorted(self.skipped.items(), key=lambda item: item[1], reverse=True)
+            ),
+            "owner_columns": OWNER_COLUMNS,
+            "owners": [
+                [
+                    name,
+                    kind,
+                    round(total_ns / 1e6, 3),
+                    round(self_ns / 1e6, 3),
+                    attributes,
+                    wrapped,
+                ]
+                for name, (kind, total_ns, self_ns, attributes, wrapped) in owners
+            ],
+        }
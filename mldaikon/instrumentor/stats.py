@@ -0,0 +1,81 @@
+"""
+Aggregated statistics mode of the function call tracer.
+
+Instead of writing a pre and a post event per call, the wrapper only updates in-memory counters keyed by
+(function, parent function, step): number of calls, number of exceptions, total / min / max duration
+and a histogram of durations in power-of-two nanosecond buckets. The counters accumulated since the last
+dump are written out periodically and at exit, so the size of the output grows with the number of
+distinct APIs (and steps), not with the number of calls.
+"""
+
+import threading
+import time
+
+
+class APIStatsCollector:
+    def __init__(self, dump_interval: float):
+        self.dump_interval_ns = int(dump_interval * 1e9)
+        self.next_dump_ns = time.perf_counter_ns() + self.dump_interval_ns
+        self._stats: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+        self._stacks = threading.local()
+
+    def get_stack(self) -> list[int]:
+        """Per-thread stack of the function IDs of the active calls."""
+        try:
+            return self._stacks.stack
+        except AttributeError:
+            self._stacks.stack = []
+            return self._stacks.stack
+
+    def record(
+        self, func_id: int, parent_func_id, step, duration_ns: int, failed: bool
+    ):
+        key = (func_id, parent_func_id, step)
+        # bucket i counts the durations in [2^(i-1), 2^i) ns
+        bucket = duration_ns.bit_length()
+        with self._lock:
+            entry = self._stats.get(key)
+            if entry is None:
+                # [num_calls, num_exceptions, total_ns, min_ns, max_ns, histogram]
+                entry = self._stats[key] = [0, 0, 0, duration_ns, duration_ns, []]
+            entry[0] += 1
+            if failed:
+                entry[1] += 1
+            entry[2] += duration_ns
+            if duration_ns < entry[3]:
+                entry[3] = duration_ns
+            if duration_ns > entry[4]:
+                entry[4] = duration_ns
+            histogram = entry[5]
+            if bucket >= len(histogram):
+                histogram.extend([0] * (bucket + 1 - len(histogram)))
+            histogram[bucket] += 1
+
+    def pop_stats(self) -> list[dict]:
+        """Return the counters accumulated since the last call and reset them."""
+        with self._lock:
+            stats = self._stats
+            self._stats = {}
+            self.next_dump_ns = time.perf_counter_ns() + self.dump_interval_ns
+        return [
+            {
+                "function_id": func_id,
+                "parent_function_id": parent_func_id,
+                "step": step,
+                "num_calls": num_calls,
+                "num_exceptions": num_exceptions,
+                "total_ns": total_ns,
+                "min_ns": min_ns,
+                "max_ns": max_ns,
+                "histogram": histogram,
+            }
+            for (func_id, parent_func_id, step), (
+                num_calls,
+                num_exceptions,
+                total_ns,
+                min_ns,
+                max_ns,
+                histogram,
+            ) in stats.items()
+        ]
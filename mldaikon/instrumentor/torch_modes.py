@@ -0,0 +1,134 @@
+"""
+Tracing of C-implemented torch ops through torch's mode dispatch.
+
+Attributes implemented in C (e.g. `Tensor.add_`) are not in the `__dict__` of their module / class, so
+the instrumentor cannot wrap them. Instead, a mode pushed on torch's mode stack sees every op once:
+    - "function": a TorchFunctionMode, ops are named like the Python API (`torch.Tensor.add_`).
+        Python functions are left to the other backends, and tensor attribute accesses are not recorded.
+        Ops called from inside a Python function that dispatches through `__torch_function__`
+        (e.g. `torch.nn.functional.relu`) are not seen, as torch disables the mode while handling it.
+    - "dispatch": a TorchDispatchMode, ops are the ATen operators below autograd (`aten.add_.Tensor`),
+        so every op is seen, including the ones issued by Python functions and by backward.
+
+The ops are recorded through the same `begin_call` / `end_call` as the other backends, and the pre event
+of an op carries a summary of its tensor arguments ("tensors": ["torch.float32[4, 3]@cpu", ...]).
+Modes are per thread, the mode is only active in the thread (and the forked children of the thread)
+that started it.
+"""
+
+import abc
+import types
+
+import torch
+from torch.overrides import TorchFunctionMode, resolve_name
+from torch.utils._python_dispatch import TorchDispatchMode
+
+TORCH_OPS_MODES = ["off", "function", "dispatch"]
+
+# `types` is shadowed by the argument of __torch_function__
+_FunctionType = types.FunctionType
+_MethodWrapperType = types.MethodWrapperType
+
+
+def summarize_tensor(tensor: torch.Tensor) -> str:
+    return f"{tensor.dtype}{list(tensor.shape)}@{tensor.device}"
+
+
+def summarize_tensors(args: tuple, kwargs: dict | None) -> list[str]:
+    """dtype, shape and device of the tensor arguments (including the ones in lists / tuples) of an op."""
+    summaries = []
+    values = list(args)
+    if kwargs:
+        values.extend(kwargs.values())
+    for value in values:
+        if isinstance(value, torch.Tensor):
+            summaries.append(summarize_tensor(value))
+        elif isinstance(value, (list, tuple)):
+            summaries.extend(
+                summarize_tensor(v) for v in value if isinstance(v, torch.Tensor)
+            )
+    return summaries
+
+
+class _OpTracer(abc.ABC):
+    """Records an op call with begin_call / end_call, caching the func_id of every op object."""
+
+    def __init__(self, begin_call, end_call, get_function_id):
+        super().__init__()
+        self.begin_call = begin_call
+        self.end_call = end_call
+        self.get_function_id = get_function_id
+        self.func_ids: dict = {}
+        self.started = False
+
+    @abc.abstractmethod
+    def _get_op_name(self, func) -> str:
+        """The traced name of an op."""
+
+    def _trace_op(self, func, args, kwargs):
+        func_id = self.func_ids.get(func)
+        if func_id is None:
+            func_id = self.func_ids[func] = self.get_function_id(
+                self._get_op_name(func)
+            )
+        call = self.begin_call(func_id, (args, kwargs))
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            self.end_call(call, e, args, kwargs)
+            raise
+        self.end_call(call)
+        return result
+
+    def start(self):
+        """Push the mode on the mode stack of the calling thread, it stays there until `stop`."""
+        if not self.started:
+            self.__enter__()  # type: ignore
+            self.started = True
+
+    def stop(self):
+        if self.started:
+            self.started = False
+            self.__exit__(None, None, None)  # type: ignore
+
+
+class FunctionOpTracingMode(_OpTracer, TorchFunctionMode):
+    def _get_op_name(self, func) -> str:
+        try:
+            name = resolve_name(func)
+        except Exception:
+            name = None
+        if name is None:
+            name = f"{getattr(func, '__module__', None) or 'unknown'}.{getattr(func, '__qualname__', func)}"
+        return name
+
+    def __torch_function__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        # Python functions are traced by the wrapper / monitoring backend, the getters and setters of
+        # tensor attributes (method-wrappers, created on every access) are not traced
+        if type(func) is _FunctionType or type(func) is _MethodWrapperType:
+            return func(*args, **kwargs)
+        return self._trace_op(func, args, kwargs)
+
+
+class DispatchOpTracingMode(_OpTracer, TorchDispatchMode):
+    def _get_op_name(self, func) -> str:
+        return str(func)
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        return self._trace_op(func, args, kwargs or {})
+
+
+def make_torch_ops_mode(
+    name: str, begin_call, end_call, get_function_id
+) -> _OpTracer | None:
+    """Create the op tracing mode by name, "off" means no mode (None)."""
+    if name == "off":
+        return None
+    if name == "function":
+        return FunctionOpTracingMode(begin_call, end_call, get_function_id)
+    if name == "dispatch":
+        return DispatchOpTracingMode(begin_call, end_call, get_function_id)
+    raise ValueError(
+        f"Unsupported torch ops tracing mode: {name}, expected one of {TORCH_OPS_MODES}"
+    )
@@ -0,0 +1,605 @@
+"""
+Trace sinks: NDJSON, columnar and compressed.
+
+The default sink, `NDJSONTraceWriter`, writes one JSON line per event. The columnar sinks buffer the events
+per process in typed column arrays and flush them in blocks to Arrow IPC (stream format) or Parquet files
+that `read_trace_file` can load directly. A Parquet file is only readable once its footer is written, so the
+open part of a Parquet trace is written as an Arrow IPC stream and converted when the part is closed.
+
+The NDJSON traces can also be written as a sequence of independently compressed (zstd or lz4) chunks,
+each with a small header, so that a reader can decompress them in parallel and skip the chunks a
+query does not need.
+
+Every sink writes one segment of a trace, `SegmentedTraceWriter` rotates the segments by size or by
+training step and lists them in the manifest of the run.
+"""
+
+import array
+import json
+import logging
+import os
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+COLUMNAR_FORMATS = {
+    "arrow": ".arrows",
+    "parquet": ".parquet",
+}
+
+
+def flatten_trace(trace: dict, prefix: str = ""):
+    """Flatten nested dicts (e.g. meta_vars) into dotted column names, the same naming `unnest_all` uses."""
+    for key, value in trace.items():
+        if isinstance(value, dict):
+            yield from flatten_trace(value, f"{prefix}{key}.")
+        else:
+            yield f"{prefix}{key}", value
+
+
+def _new_column(value, num_rows: int) -> array.array | list:
+    if num_rows == 0:
+        if type(value) is int:
+            return array.array("q")
+        if type(value) is float:
+            return array.array("d")
+    return [None] * num_rows
+
+
+class ColumnarTraceWriter:
+    """Buffers trace events in typed columns and appends them block by block to a columnar file.
+
+    Columns holding only ints or floats are kept in `array.array` buffers; anything else (strings,
+    lists, missing values) falls back to a plain list. Once a column is seen it stays in the schema
+    and rows that do not carry it are filled with nulls. If a flushed block does not fit the schema
+    of the open file (new column, incompatible type), the file is closed and a new part is started.
+
+    The open part is always an Arrow IPC stream (`{file_base}_{part}.arrows`), readable up to its last
+    block if the process dies. With the parquet format it is converted to `{file_base}_{part}.parquet`
+    when it is closed.
+    """
+
+    def __init__(self, file_base: str, fmt: str, block_size: int):
+        if fmt not in COLUMNAR_FORMATS:
+            raise ValueError(
+                f"Unsupported columnar trace format: {fmt}, expected one of {list(COLUMNAR_FORMATS)}"
+            )
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError as e:
+            raise ImportError(
+                f"pyarrow is required for the '{fmt}' trace format, install it with `pip install pyarrow` or use the 'json' trace format."
+            ) from e
+
+        self.file_base = file_base
+        self.fmt = fmt
+        self.block_size = block_size
+
+        self._columns: dict[str, array.array | list] = {}
+        self._num_rows = 0
+
+        self._part = 0
+        self._file_writer = None
+        self._schema = None
+        self.closed = False
+
+    def _part_path(self, part: int) -> str:
+        return f"{self.file_base}_{part}{COLUMNAR_FORMATS[self.fmt]}"
+
+    def _stream_path(self, part: int) -> str:
+        return f"{self.file_base}_{part}{COLUMNAR_FORMATS['arrow']}"
+
+    def write(self, trace: dict):
+        columns = self._columns
+        num_rows = self._num_rows
+        num_seen = 0
+        for name, value in flatten_trace(trace):
+            num_seen += 1
+            col = columns.get(name)
+            if col is None:
+                col = columns[name] = _new_column(value, num_rows)
+            if isinstance(col, array.array):
+                if (col.typecode == "q" and type(value) is int) or (
+                    col.typecode == "d" and type(value) is float
+                ):
+                    try:
+                        col.append(value)
+                        continue
+                    except OverflowError:
+                        pass
+                col = columns[name] = col.tolist()
+            col.append(value)
+
+        if num_seen != len(columns):
+            # fill the columns that this event does not carry with nulls
+            for name, col in columns.items():
+                if len(col) == num_rows:
+                    if isinstance(col, array.array):
+                        col = columns[name] = col.tolist()
+                    col.append(None)
+
+        self._num_rows = num_rows + 1
+        if self._num_rows >= self.block_size:
+            self.flush()
+
+    def _to_table(self):
+        import pyarrow as pa
+
+        arrays = []
+        for name, col in self._columns.items():
+            known_type = (
+                self._schema.field(name).type
+                if self._schema is not None and name in self._schema.names
+                else None
+            )
+            try:
+                arr = pa.array(col)
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                # mixed value types in one column, keep them as strings
+                logger.warning(
+                    f"Column {name} of {self.file_base} has mixed types, storing it as strings."
+                )
+                arrays.append(
+                    pa.array([None if v is None else str(v) for v in col], pa.string())
+                )
+                continue
+            if known_type is not None and arr.type != known_type:
+                # a safe cast, pa.array(col, type=...) would truncate floats into an int column
+                try:
+                    arr = arr.cast(known_type)
+                except (
+                    pa.ArrowInvalid,
+                    pa.ArrowTypeError,
+                    pa.ArrowNotImplementedError,
+                ):
+                    # does not fit the schema of the open file, a new part is started
+                    pass
+            arrays.append(arr)
+        return pa.Table.from_arrays(arrays, names=list(self._columns))
+
+    def _open(self, schema):
+        import pyarrow as pa
+
+        self._file_writer = pa.ipc.new_stream(self._stream_path(self._part), schema)
+        self._schema = schema
+
+    def _convert_to_parquet(self, part: int):
+        """Rewrite the closed stream of a part as Parquet, one row group per block."""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        stream_path = self._stream_path(part)
+        path = self._part_path(part)
+        with pa.ipc.open_stream(stream_path) as reader:
+            with pq.ParquetWriter(f"{path}.tmp", reader.schema) as writer:
+                for batch in reader:
+                    writer.write_batch(batch)
+        # the stream is only removed once the parquet file is complete, a reader prefers the parquet file
+        os.replace(f"{path}.tmp", path)
+        os.remove(stream_path)
+
+    def _close_file(self):
+        if self._file_writer is not None:
+            self._file_writer.close()
+            self._file_writer = None
+            if self.fmt == "parquet":
+                self._convert_to_parquet(self._part)
+            self._part += 1
+
+    def flush(self):
+        if self._num_rows == 0 or self.closed:
+            return
+        table = self._to_table()
+        if self._schema is not None and not table.schema.equals(self._schema):
+            logger.debug(
+                f"Trace schema changed, starting a new part for {self.file_base}"
+            )
+            self._close_file()
+        if self._file_writer is None:
+            self._open(table.schema)
+        self._file_writer.write_table(table)
+
+        # keep the schema, reset the buffers
+        self._columns = {
+            name: (array.array(col.typecode) if isinstance(col, array.array) else [])
+            for name, col in self._columns.items()
+        }
+        self._num_rows = 0
+
+    def close(self):
+        if self.closed:
+            return
+        self.flush()
+        self._close_file()
+        self.closed = True
+
+    def paths(self) -> list[str]:
+        """The closed parts, and the stream of the open part (not created before its first block)."""
+        paths = [self._part_path(part) for part in range(self._part)]
+        if not self.closed:
+            paths.append(self._stream_path(self._part))
+        return paths
+
+    def num_bytes(self) -> int:
+        return sum(
+            os.path.getsize(path) for path in self.paths() if os.path.exists(path)
+        )
+
+
+class NDJSONTraceWriter:
+    """Plain NDJSON trace log, flushed after every event like the logging handlers it replaces."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "w")
+        self._num_bytes = 0
+        self._lock = threading.Lock()
+        self.closed = False
+
+    def write(self, trace: dict):
+        line = json.dumps(trace) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            self._num_bytes += len(line)
+
+    def close(self):
+        with self._lock:
+            if not self.closed:
+                self._file.close()
+                self.closed = True
+
+    def paths(self) -> list[str]:
+        return [self.path]
+
+    def num_bytes(self) -> int:
+        return self._num_bytes
+
+
+CHUNK_CODECS = {"zstd": 1, "lz4": 2}
+CHUNKED_TRACE_EXT = ".chunks"
+
+# file header: magic, format version, codec
+_FILE_HEADER = struct.Struct("<4sBB")
+_MAGIC = b"MDTC"
+_FORMAT_VERSION = 1
+# chunk header: compressed size, uncompressed size, number of events, min / max time, min / max step
+_CHUNK_HEADER = struct.Struct("<IIIqqqq")
+_NO_STEP = -(2**63)  # the step range of the chunk is unknown
+
+
+def _get_codec(codec: str):
+    """(compress, decompress) functions of a codec, the codec libraries are optional dependencies."""
+    try:
+        if codec == "zstd":
+            import zstandard
+
+            return (
+                zstandard.ZstdCompressor(level=3).compress,
+                zstandard.ZstdDecompressor().decompress,
+            )
+        if codec == "lz4":
+            import lz4.frame
+
+            return lz4.frame.compress, lz4.frame.decompress
+    except ImportError as e:
+        package = "zstandard" if codec == "zstd" else "lz4"
+        raise ImportError(
+            f"{package} is required for the '{codec}' trace compression, install it with `pip install {package}`."
+        ) from e
+    raise ValueError(
+        f"Unsupported trace compression: {codec}, expected one of {list(CHUNK_CODECS)}"
+    )
+
+
+class ChunkedTraceWriter:
+    """Writes NDJSON events as independently compressed chunks of `chunk_size` events.
+
+    Each chunk starts with a header holding its sizes, number of events, time range and step range.
+    `step_range` maps the (min, max) context_version of the events of a chunk to the (min, max) step they
+    were recorded in, or None if it is not known.
+    """
+
+    def __init__(self, path: str, codec: str, chunk_size: int, step_range=None):
+        self._compress, _ = _get_codec(codec)
+        self.path = path
+        self.chunk_size = chunk_size
+        self.step_range = step_range
+        self._file = open(path, "wb")
+        self._file.write(
+            _FILE_HEADER.pack(_MAGIC, _FORMAT_VERSION, CHUNK_CODECS[codec])
+        )
+        self._num_bytes = _FILE_HEADER.size
+        self._lock = threading.Lock()
+        self._reset()
+        self.closed = False
+
+    def _reset(self):
+        self._lines: list[str] = []
+        self._min_time: int | None = None
+        self._max_time: int | None = None
+        self._min_version: int | None = None
+        self._max_version: int | None = None
+
+    def write(self, trace: dict):
+        line = json.dumps(trace)
+        t = trace.get("time")
+        version = trace.get("context_version")
+        with self._lock:
+            self._lines.append(line)
+            if isinstance(t, int):
+                if self._min_time is None or t < self._min_time:
+                    self._min_time = t
+                if self._max_time is None or t > self._max_time:
+                    self._max_time = t
+            if isinstance(version, int):
+                if self._min_version is None or version < self._min_version:
+                    self._min_version = version
+                if self._max_version is None or version > self._max_version:
+                    self._max_version = version
+            if len(self._lines) >= self.chunk_size:
+                self._flush()
+
+    def _flush(self):
+        if not self._lines or self.closed:
+            return
+        raw = ("\n".join(self._lines) + "\n").encode()
+        data = self._compress(raw)
+        steps = None
+        if self.step_range is not None and self._min_version is not None:
+            steps = self.step_range(self._min_version, self._max_version)
+        min_step, max_step = steps if steps is not None else (_NO_STEP, _NO_STEP)
+        self._file.write(
+            _CHUNK_HEADER.pack(
+                len(data),
+                len(raw),
+                len(self._lines),
+                self._min_time if self._min_time is not None else 0,
+                self._max_time if self._max_time is not None else 0,
+                min_step,
+                max_step,
+            )
+        )
+        self._file.write(data)
+        self._file.flush()
+        self._num_bytes += _CHUNK_HEADER.size + len(data)
+        self._reset()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self._flush()
+            self._file.close()
+            self.closed = True
+
+    def paths(self) -> list[str]:
+        return [self.path]
+
+    def num_bytes(self) -> int:
+        return self._num_bytes
+
+
+def read_chunk_headers(path: str) -> tuple[str, list[dict]]:
+    """Codec and headers (with the offset of their data) of the chunks of a chunked trace file.
+
+    A truncated last chunk (e.g. the process was killed while writing it) is ignored.
+    """
+    chunks = []
+    with open(path, "rb") as f:
+        file_size = os.fstat(f.fileno()).st_size
+        magic, version, codec_id = _FILE_HEADER.unpack(f.read(_FILE_HEADER.size))
+        if magic != _MAGIC or version != _FORMAT_VERSION:
+            raise ValueError(f"{path} is not a chunked trace file")
+        codec = {v: k for k, v in CHUNK_CODECS.items()}[codec_id]
+        offset = _FILE_HEADER.size
+        while True:
+            header = f.read(_CHUNK_HEADER.size)
+            if len(header) < _CHUNK_HEADER.size:
+                break
+            size, raw_size, num_events, min_time, max_time, min_step, max_step = (
+                _CHUNK_HEADER.unpack(header)
+            )
+            offset += _CHUNK_HEADER.size
+            if offset + size > file_size:
+                break
+            f.seek(offset + size)
+            chunks.append(
+                {
+                    "offset": offset,
+                    "size": size,
+                    "raw_size": raw_size,
+                    "num_events": num_events,
+                    "time_range": (min_time, max_time),
+                    "step_range": (
+                        None if min_step == _NO_STEP else (min_step, max_step)
+                    ),
+                }
+            )
+            offset += size
+    return codec, chunks
+
+
+def _overlaps(chunk_range: tuple | None, query_range: tuple | None) -> bool:
+    if chunk_range is None or query_range is None:
+        return True
+    low, high = query_range
+    return (high is None or chunk_range[0] <= high) and (
+        low is None or chunk_range[1] >= low
+    )
+
+
+def read_chunked_trace(
+    path: str,
+    time_range: tuple | None = None,
+    step_range: tuple | None = None,
+    max_workers: int | None = None,
+) -> bytes:
+    """Decompress the chunks of a chunked trace file in parallel and return their NDJSON content.
+
+    Chunks whose time or step range does not overlap the given (inclusive, None for unbounded) ranges are
+    skipped without being read, the events of the chunks kept still have to be filtered by the caller.
+    """
+    codec, chunks = read_chunk_headers(path)
+    chunks = [
+        c
+        for c in chunks
+        if _overlaps(c["time_range"], time_range)
+        and _overlaps(c["step_range"], step_range)
+    ]
+    _, decompress = _get_codec(codec)
+
+    def read_chunk(chunk: dict) -> bytes:
+        with open(path, "rb") as f:
+            f.seek(chunk["offset"])
+            return decompress(f.read(chunk["size"]))
+
+    # both codecs release the GIL while decompressing
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return b"".join(executor.map(read_chunk, chunks))
+
+
+# the size of the current segment is only checked every this many events
+_ROTATION_CHECK_EVERY = 256
+
+
+class SegmentedTraceWriter:
+    """Writes a trace as a sequence of segments and records them in the run manifest.
+
+    A new segment is started when the current one reaches `max_bytes`, or when the step of an event falls
+    into another window of `step_interval` steps than the first step of the segment (0 disables either).
+    The first segment is written to `{file_base}{ext}`, the next ones to `{file_base}_seg{n}{ext}`.
+
+    args:
+        make_writer: Callable[[str], sink]
+            Opens a sink (NDJSONTraceWriter, ChunkedTraceWriter, ColumnarTraceWriter) for a segment,
+            given the segment's file base (without extension).
+        step_of: Callable[[int], int | None]
+            Step in which an event of the given context_version was recorded, None if not known.
+        manifest_path: str
+            NDJSON manifest of the run, shared by all processes. A line with `complete: false` is appended
+            when a segment is opened, so that the segment of a process that dies is still listed, and a
+            line with its counts and ranges when it is closed.
+    """
+
+    def __init__(
+        self,
+        file_base: str,
+        make_writer,
+        kind: str,
+        max_bytes: int,
+        step_interval: int,
+        step_of,
+        manifest_path: str,
+    ):
+        self.file_base = file_base
+        self.make_writer = make_writer
+        self.kind = kind
+        self.max_bytes = max_bytes
+        self.step_interval = step_interval
+        self.step_of = step_of
+        self.manifest_path = manifest_path
+        self.segment = 0
+        self._writer = None
+        self._lock = threading.Lock()
+        self.closed = False
+
+    def _open_segment(self):
+        base = (
+            self.file_base
+            if self.segment == 0
+            else f"{self.file_base}_seg{self.segment}"
+        )
+        self._writer = self.make_writer(base)
+        self._num_events = 0
+        self._time_range: list | None = None
+        self._step_range: list | None = None
+        self._step_window = None
+        self._append_to_manifest(
+            {
+                "kind": self.kind,
+                "process_id": os.getpid(),
+                "segment": self.segment,
+                "paths": [os.path.basename(path) for path in self._writer.paths()],
+                "complete": False,
+            }
+        )
+
+    def _close_segment(self):
+        writer = self._writer
+        if writer is None:
+            return
+        writer.close()
+        self._writer = None
+        self._append_to_manifest(
+            {
+                "kind": self.kind,
+                "process_id": os.getpid(),
+                "segment": self.segment,
+                "paths": [os.path.basename(path) for path in writer.paths()],
+                "complete": True,
+                "num_events": self._num_events,
+                "num_bytes": writer.num_bytes(),
+                "time_range": self._time_range,
+                "step_range": self._step_range,
+            }
+        )
+        self.segment += 1
+
+    def _append_to_manifest(self, record: dict):
+        # a single small append per line, safe to share between processes
+        with open(self.manifest_path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def write(self, trace: dict):
+        t = trace.get("time")
+        version = trace.get("context_version")
+        step = self.step_of(version) if type(version) is int else None
+        with self._lock:
+            if self.closed:
+                return
+            if self._writer is None:
+                self._open_segment()
+            elif (
+                self.step_interval > 0
+                and type(step) is int
+                and self._step_window is not None
+                and step // self.step_interval != self._step_window
+            ) or (
+                self.max_bytes > 0
+                and self._num_events % _ROTATION_CHECK_EVERY == 0
+                and self._writer.num_bytes() >= self.max_bytes
+            ):
+                self._close_segment()
+                self._open_segment()
+
+            self._writer.write(trace)
+            self._num_events += 1
+            if type(t) is int:
+                if self._time_range is None:
+                    self._time_range = [t, t]
+                elif t < self._time_range[0]:
+                    self._time_range[0] = t
+                elif t > self._time_range[1]:
+                    self._time_range[1] = t
+            if type(step) is int:
+                if self._step_range is None:
+                    self._step_range = [step, step]
+                    if self.step_interval > 0:
+                        self._step_window = step // self.step_interval
+                elif step < self._step_range[0]:
+                    self._step_range[0] = step
+                elif step > self._step_range[1]:
+                    self._step_range[1] = step
+
+    def close(self):
+        with self._lock:
+            if not self.closed:
+                self._close_segment()
+                self.closed = True
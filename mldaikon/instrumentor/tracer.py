@@ -1,172 +1,1376 @@
+import atexit
+import bisect
+import contextlib
 import datetime
 import functools
+import hashlib
 import inspect
+import itertools
 import json
 import logging
+import multiprocessing.util
 import os
-import random
+import signal
+import sys
 import threading
+import time
 import traceback
 import types
+import typing
 
 import torch
 import torch.utils
 
 import mldaikon.proxy_wrapper.proxy as ProxyWrapper
-from mldaikon.config.config import INCLUDED_WRAP_LIST, proxy_log_dir
+from mldaikon.config.config import (
+    API_TRACE_MODE,
+    ARG_DESCRIPTOR_MAX_LENGTH,
+    ASYNC_FLUSH_INTERVAL,
+    ASYNC_OVERFLOW_POLICY,
+    ASYNC_RING_CAPACITY,
+    ASYNC_SAMPLE_EVERY,
+    ASYNC_TRACE,
+    CALL_DEPTH_MODE,
+    COLLECTOR_BATCH_SIZE,
+    COLLECTOR_FLUSH_INTERVAL,
+    COLUMNAR_BLOCK_SIZE,
+    COMPRESSED_CHUNK_SIZE,
+    EXCEPTION_MESSAGE_MAX_LENGTH,
+    FLIGHT_RECORDER,
+    FLIGHT_RECORDER_CHUNK_SIZE,
+    FLIGHT_RECORDER_MAX_BYTES,
+    FLIGHT_RECORDER_SIGNAL,
+    FLIGHT_RECORDER_STEPS,
+    FLIGHT_RECORDER_TRIGGERS,
+    INCLUDED_WRAP_LIST,
+    INSTRUMENTATION_EXCLUDE,
+    INSTRUMENTATION_EXCLUDE_FILE,
+    INSTRUMENTATION_INCLUDE,
+    INSTRUMENTATION_MODE,
+    INSTRUMENTATION_PLAN_CACHE,
+    INSTRUMENTATION_PLAN_CACHE_DIR,
+    INSTRUMENTATION_PROFILE,
+    INSTRUMENTATION_REPORT_MAX_OWNERS,
+    INSTRUMENTATION_VERBOSE,
+    MAX_CALL_DEPTH,
+    ROTATE_EVERY_STEPS,
+    ROTATE_MAX_BYTES,
+    SAMPLING_EVERY_K,
+    SAMPLING_FIRST_N,
+    SAMPLING_KEEP_NESTED,
+    SAMPLING_POLICY,
+    SAMPLING_RESERVOIR_SIZE,
+    STATS_DUMP_INTERVAL,
+    TRACE_API_FORMAT,
+    TRACE_COMPRESSION,
+    TRACE_TORCH_OPS,
+    TRACING_BACKEND,
+    TRACING_WINDOW_SIGNAL,
+    TRACING_WINDOWS,
+    proxy_log_dir,
+)
+from mldaikon.instrumentor.async_writer import AsyncTraceWriter
+from mldaikon.instrumentor.collector import CollectorTraceSink
+from mldaikon.instrumentor.flight_recorder import FlightRecorder
+from mldaikon.instrumentor.monitoring import (
+    MonitoringBackend,
+    make_monitoring_backend,
+)
+from mldaikon.instrumentor.overhead_profile import (
+    InstrumentationProfile,
+    load_exclusion_list,
+)
+from mldaikon.instrumentor.plan_cache import load_plan, plan_cache_key, save_plan
+from mldaikon.instrumentor.rules import InstrumentationRules
+from mldaikon.instrumentor.sampling import SamplingPolicy, make_sampling_policy
+from mldaikon.instrumentor.startup_report import InstrumentationReport
+from mldaikon.instrumentor.stats import APIStatsCollector
+from mldaikon.instrumentor.torch_modes import (
+    make_torch_ops_mode,
+    summarize_tensor,
+    summarize_tensors,
+)
+from mldaikon.instrumentor.trace_writer import (
+    CHUNKED_TRACE_EXT,
+    ChunkedTraceWriter,
+    ColumnarTraceWriter,
+    NDJSONTraceWriter,
+    SegmentedTraceWriter,
+)
+from mldaikon.instrumentor.windows import (
+    TracingSchedule,
+    TracingWindow,
+    parse_windows,
+)
 from mldaikon.utils import typename
 
 EXP_START_TIME = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
 
-meta_vars: dict[str, object] = {}
+# "events" writes a pre and a post event per call, "stats" only keeps aggregated per-API statistics
+api_trace_mode = os.getenv("ML_DAIKON_API_TRACE_MODE", API_TRACE_MODE)
+# "json" keeps the NDJSON debug log, "arrow" / "parquet" use the columnar writer
+trace_API_format = os.getenv("ML_DAIKON_TRACE_API_FORMAT", TRACE_API_FORMAT)
+# "none" writes the NDJSON traces as plain logs, "zstd" / "lz4" as compressed chunks
+trace_compression = os.getenv("ML_DAIKON_TRACE_COMPRESSION", TRACE_COMPRESSION)
+# a new trace segment is started every this many bytes / steps, 0 disables the rotation
+rotate_max_bytes = int(os.getenv("ML_DAIKON_ROTATE_MAX_BYTES", ROTATE_MAX_BYTES))
+rotate_every_steps = int(os.getenv("ML_DAIKON_ROTATE_EVERY_STEPS", ROTATE_EVERY_STEPS))
+# when set, the traces are sent to the central collector listening on this Unix socket instead of
+# being written to per-process files (see mldaikon.instrumentor.collector)
+collector_socket = os.getenv("ML_DAIKON_COLLECTOR_SOCKET")
+# when enabled, events are handed to a background writer thread instead of being written in place
+async_trace = os.getenv("ML_DAIKON_ASYNC_TRACE", "1" if ASYNC_TRACE else "0") == "1"
+async_overflow_policy = os.getenv(
+    "ML_DAIKON_ASYNC_OVERFLOW_POLICY", ASYNC_OVERFLOW_POLICY
+)
+# which calls of each API are traced, None traces everything
+sampling_policy_name = os.getenv("ML_DAIKON_SAMPLING_POLICY", SAMPLING_POLICY)
+sampler: SamplingPolicy | None = make_sampling_policy(
+    sampling_policy_name, SAMPLING_FIRST_N, SAMPLING_EVERY_K, SAMPLING_RESERVOIR_SIZE
+)
+sampling_keep_nested = (
+    os.getenv("ML_DAIKON_SAMPLING_KEEP_NESTED", "1" if SAMPLING_KEEP_NESTED else "0")
+    == "1"
+)
+api_stats: APIStatsCollector | None = (
+    APIStatsCollector(STATS_DUMP_INTERVAL) if api_trace_mode == "stats" else None
+)
+# the deepest traced calls (0: the outermost ones), None traces the calls at every depth
+call_depth_mode = os.getenv("ML_DAIKON_CALL_DEPTH_MODE", CALL_DEPTH_MODE)
+if call_depth_mode == "all":
+    max_call_depth: int | None = None
+elif call_depth_mode == "outermost":
+    max_call_depth = 0
+elif call_depth_mode == "max_depth":
+    max_call_depth = int(os.getenv("ML_DAIKON_MAX_CALL_DEPTH", MAX_CALL_DEPTH))
+else:
+    raise ValueError(
+        f"Unsupported call depth mode: {call_depth_mode}, expected one of ['all', 'max_depth', 'outermost']"
+    )
+# with a maximum call depth, the exact number of calls of every API (the deeper calls are not in the trace)
+call_counts: dict[int, int] = {}
+# the instrumentation log gets a line per attribute visited by the instrumentor only in the verbose mode,
+# the startup report of the process (see startup_report.py) summarizes them
+instrumentation_verbose = (
+    os.getenv(
+        "ML_DAIKON_INSTRUMENTATION_VERBOSE", "1" if INSTRUMENTATION_VERBOSE else "0"
+    )
+    == "1"
+)
+instrumentation_report = InstrumentationReport()
+# in a profiling run, the calls and the wrapper overhead of every wrapped function (see overhead_profile.py)
+instrumentation_profile: InstrumentationProfile | None = (
+    InstrumentationProfile()
+    if os.getenv(
+        "ML_DAIKON_INSTRUMENTATION_PROFILE", "1" if INSTRUMENTATION_PROFILE else "0"
+    )
+    == "1"
+    else None
+)
+
 # TODO: refactor the skipped_modules logic. Use an attribute to mark if the module is wrapped or skipped or not.
 
-trace_API_loggers: dict[int, logging.Logger] = {}
-trace_VAR_loggers: dict[int, logging.Logger] = {}
+# writers of the "trace_API" and "trace_VAR" traces, keyed by (kind, pid)
+trace_writers: dict[tuple[str, int], SegmentedTraceWriter | CollectorTraceSink] = {}
 instrumentation_loggers: dict[int, logging.Logger] = {}
+async_trace_writers: dict[int, AsyncTraceWriter] = {}
+api_stats_files: dict[int, typing.TextIO] = {}
+
+# the state of this process, cached so that writing an event does not look up the pid, the script name
+# and the writers every time. `_after_fork_in_child` resets it: a forked child opens its own writers on its
+# first event instead of writing into the parent's (those stay untouched in the registries above).
+process_id = os.getpid()
+process_trace_writers: dict[str, SegmentedTraceWriter | CollectorTraceSink] = {}
+process_async_writer: AsyncTraceWriter | None = None
+process_instrumentation_logger: logging.Logger | None = None
+process_state_lock = threading.RLock()
+# set once close_trace_writers has closed the trace files of this process, events recorded later (e.g. by
+# functions called during the interpreter shutdown) are dropped instead of reopening (and truncating) the files
+trace_writers_closed = False
+_script_name: str | None = None
+
+
+def get_script_name() -> str:
+    global _script_name
+    if _script_name is None:
+        script_name = os.getenv("MAIN_SCRIPT_NAME")
+        assert (
+            script_name is not None
+        ), "MAIN_SCRIPT_NAME is not set, examine the instrumented code to see if os.environ['MAIN_SCRIPT_NAME'] is set in the main function"
+        _script_name = script_name
+    return _script_name
+
+
+# integer IDs of the wrapped functions, resolved once at wrap time. API events only carry the ID,
+# the per-process symbol table file maps the IDs back to the qualified function names. A name is only
+# written when its function is first called in the process, most of the wrapped functions never are.
+function_names: list[str] = []
+function_ids: dict[str, int] = {}
+# IDs of the functions called in this process, whose names are in its symbol table
+called_function_ids: set[int] = set()
+# func_id -> qualified names (module + qualname) of the functions wrapped under it, the names the
+# instrumentation rules and the API rules of the tracing windows match
+function_rule_names: dict[int, set[str]] = {}
+symbol_table_files: dict[int, typing.TextIO] = {}
+symbol_table_lock = threading.Lock()
+
+# func_call_id is unique within a process (and monotonic on every thread), so (process_id, func_call_id)
+# identifies a call. The per-thread stack of active calls gives the parent call and the call depth.
+call_id_counter = itertools.count()
+
+
+class ThreadTraceState(threading.local):
+    """State of the tracer in the current thread, initialized on the first access from each thread.
+
+    call_stack: the active calls, entries are (func_call_id, target) where target tells where the events of
+        the call go: True (written), False (not traced by the sampling policy) or a list buffering them.
+    seq: sequence numbers of the events of the thread, they give the exact order of its events.
+    thread_id: ident of the thread, looked up once instead of on every call.
+    in_instrumentor: whether the thread runs the instrumentor, the calls it triggers are not traced.
+    """
 
+    def __init__(self):
+        self.call_stack: list[tuple[int, bool | list]] = []
+        self.seq = itertools.count()
+        self.thread_id = threading.get_ident()
+        self.in_instrumentor = False
 
-def get_trace_API_logger_for_process():
-    pid = os.getpid()
-    script_name = os.getenv("MAIN_SCRIPT_NAME")
-    assert (
-        script_name is not None
-    ), "MAIN_SCRIPT_NAME is not set, examine the instrumented code to see if os.environ['MAIN_SCRIPT_NAME'] is set in the main function"
 
-    if pid in trace_API_loggers:
-        return trace_API_loggers[pid]
+thread_state = ThreadTraceState()
 
-    logger = logging.getLogger(f"trace_API_{pid}")
-    logger.setLevel(logging.INFO)
-    log_file = f"{script_name}_mldaikon_trace_API_{EXP_START_TIME}_{pid}.log"
-    file_handler = logging.FileHandler(log_file)
-    file_handler.setFormatter(logging.Formatter("%(message)s"))
-    logger.addHandler(file_handler)
-    trace_API_loggers[pid] = logger
-    return logger
+
+@contextlib.contextmanager
+def not_traced_in_thread():
+    """Do not trace the calls made by this block in the current thread, e.g. the functions wrapped so far
+    that the walk of the instrumentor calls through module `__getattr__`s and properties.
+    """
+    state = thread_state
+    in_instrumentor = state.in_instrumentor
+    state.in_instrumentor = True
+    try:
+        yield
+    finally:
+        state.in_instrumentor = in_instrumentor
 
 
-def get_trace_VAR_logger_for_process():
-    pid = os.getpid()
-    script_name = os.getenv("MAIN_SCRIPT_NAME")
-    assert (
-        script_name is not None
-    ), "MAIN_SCRIPT_NAME is not set, examine the instrumented code to see if os.environ['MAIN_SCRIPT_NAME'] is set in the main function"
+def get_call_stack() -> list[tuple[int, bool | list]]:
+    return thread_state.call_stack
 
-    if pid in trace_VAR_loggers:
-        return trace_VAR_loggers[pid]
 
-    logger = logging.getLogger(f"trace_VAR_{pid}")
-    logger.setLevel(logging.INFO)
-    log_file = f"{script_name}_mldaikon_trace_VAR_{EXP_START_TIME}_{pid}.log"
-    file_handler = logging.FileHandler(log_file)
-    file_handler.setFormatter(logging.Formatter("%(message)s"))
-    logger.addHandler(file_handler)
-    trace_VAR_loggers[pid] = logger
-    return logger
+def get_function_id(func_name: str) -> int:
+    with symbol_table_lock:
+        if func_name in function_ids:
+            return function_ids[func_name]
+        func_id = len(function_names)
+        function_ids[func_name] = func_id
+        function_names.append(func_name)
+        return func_id
 
 
-def dump_trace_API(trace: dict, level=logging.INFO):
-    """add a timestamp (unix) to the trace and dump it to the trace log file"""
-    logger = get_trace_API_logger_for_process()
+def get_wrapped_function_id(func) -> int:
+    """The func_id of a function traced by the instrumentor, recording the name the rules match it by."""
+    func_id = get_function_id(get_qualified_function_name(func))
+    function_rule_names.setdefault(func_id, set()).add(typename(func))
+    return func_id
+
+
+def _write_symbols(file: typing.TextIO, func_ids: list[int]):
+    for func_id in func_ids:
+        file.write(
+            json.dumps(
+                {
+                    "process_id": process_id,
+                    "function_id": func_id,
+                    "function": function_names[func_id],
+                }
+            )
+            + "\n"
+        )
+    file.flush()
+
+
+def get_symbol_table_file_for_process():
+    """Open the symbol table file of this process and write the IDs of the functions called so far, the
+    next ones are appended on their first call (see `_add_called_function`).
+    """
+    pid = process_id
+    script_name = get_script_name()
+
+    with symbol_table_lock:
+        if pid in symbol_table_files:
+            return symbol_table_files[pid]
+
+        file = open(f"{script_name}_mldaikon_functions_{EXP_START_TIME}_{pid}.log", "w")
+        _write_symbols(file, sorted(called_function_ids))
+        symbol_table_files[pid] = file
+        return file
+
+
+def _add_called_function(func_id: int):
+    """Append the name of func_id to the symbol table of this process, on the first call of the function."""
+    file = get_symbol_table_file_for_process()
+    with symbol_table_lock:
+        if func_id not in called_function_ids:
+            called_function_ids.add(func_id)
+            _write_symbols(file, [func_id])
+
+
+# exception events only carry the hash of their traceback, the per-process traceback table maps the hashes
+# to the formatted tracebacks. A traceback is identified by the exception type and the (file, function, line)
+# of its frames, so it is only formatted (and written) the first time it is seen.
+traceback_hashes: dict[tuple, str] = {}
+traceback_texts: dict[str, str] = {}
+traceback_table_files: dict[int, typing.TextIO] = {}
+traceback_lock = threading.Lock()
+
+
+def _write_tracebacks(file: typing.TextIO, tb_hashes: list[str]):
+    for tb_hash in tb_hashes:
+        file.write(
+            json.dumps(
+                {
+                    "process_id": process_id,
+                    "traceback_hash": tb_hash,
+                    "traceback": traceback_texts[tb_hash],
+                }
+            )
+            + "\n"
+        )
+    file.flush()
+
+
+def get_traceback_hash(exception: BaseException) -> str:
+    frames = []
+    tb = exception.__traceback__
+    while tb is not None:
+        code = tb.tb_frame.f_code
+        frames.append((code.co_filename, code.co_name, tb.tb_lineno))
+        tb = tb.tb_next
+    key = (typename(type(exception)), tuple(frames))
+    tb_hash = traceback_hashes.get(key)
+    if tb_hash is not None:
+        return tb_hash
+
+    tb_hash = hashlib.blake2b(repr(key).encode(), digest_size=8).hexdigest()
+    text = "".join(traceback.format_exception(exception))
+    with traceback_lock:
+        traceback_hashes[key] = tb_hash
+        if tb_hash not in traceback_texts:
+            file = get_traceback_table_file_for_process()
+            traceback_texts[tb_hash] = text
+            _write_tracebacks(file, [tb_hash])
+    return tb_hash
+
+
+def get_traceback_table_file_for_process():
+    """Open the traceback table of this process with the tracebacks known so far (including the ones
+    inherited from the parent process), the caller must hold `traceback_lock`."""
+    pid = process_id
+    if pid not in traceback_table_files:
+        script_name = get_script_name()
+        file = open(
+            f"{script_name}_mldaikon_tracebacks_{EXP_START_TIME}_{pid}.log", "w"
+        )
+        _write_tracebacks(file, list(traceback_texts))
+        traceback_table_files[pid] = file
+    return traceback_table_files[pid]
+
+
+def describe_arg(value) -> str:
+    """Bounded-size description of an argument, without calling the (possibly expensive) str / repr of
+    tensors and arbitrary objects: tensors by dtype, shape and device, containers by type and length,
+    numbers and strings by their repr (truncated), other objects by their type."""
+    if isinstance(value, torch.Tensor):
+        return summarize_tensor(value)
+    if value is None or isinstance(value, (bool, int, float, str, bytes)):
+        text = repr(value)
+        if len(text) > ARG_DESCRIPTOR_MAX_LENGTH:
+            text = text[:ARG_DESCRIPTOR_MAX_LENGTH] + "..."
+        return text
+    if isinstance(value, (list, tuple, dict, set, frozenset)):
+        return f"{typename(type(value))}[len={len(value)}]"
+    shape = getattr(value, "shape", None)
+    if isinstance(shape, tuple) and hasattr(value, "dtype"):
+        # e.g. numpy arrays
+        return f"{typename(type(value))}[{', '.join(map(str, shape))}]({value.dtype})"
+    return typename(type(value))
+
+
+class MetaVars(dict):
+    """Global context of the traced program (e.g. step, stage), versioned.
+
+    Events only carry `meta_vars.version`. Every actual change bumps the version and writes a compact
+    record with the changed keys to the per-process context file, and the trace reader joins the
+    values back. Deleted keys are recorded as None.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.version = 0
+        # versions at which "step" changed and the new steps, to find the steps of a range of versions
+        self._step_versions: list[int] = []
+        self._steps: list = []
+
+    def _changed(self, changes: dict):
+        self.version += 1
+        if "step" in changes:
+            self._step_versions.append(self.version)
+            self._steps.append(changes["step"])
+        write_context_change(self.version, changes)
+        if "step" in changes:
+            if tracing_schedule is not None:
+                update_tracing_active()
+            if flight_recorder is not None:
+                check_flight_recorder_triggers(changes["step"])
+
+    def step_range(self, first_version: int, last_version: int) -> tuple | None:
+        """(min, max) step of the versions in [first_version, last_version], None if not known for all of them."""
+        start = bisect.bisect_right(self._step_versions, first_version) - 1
+        if start < 0:
+            return None
+        end = bisect.bisect_right(self._step_versions, last_version)
+        steps = self._steps[start:end]
+        if not all(type(step) is int for step in steps):
+            return None
+        return min(steps), max(steps)
+
+    def _is_unchanged(self, key, value) -> bool:
+        try:
+            return key in self and bool(dict.__getitem__(self, key) == value)
+        except Exception:
+            return False
+
+    def __setitem__(self, key, value):
+        if self._is_unchanged(key, value):
+            return
+        super().__setitem__(key, value)
+        self._changed({key: value})
+
+    def update(self, *args, **kwargs):
+        changes = {
+            k: v
+            for k, v in dict(*args, **kwargs).items()
+            if not self._is_unchanged(k, v)
+        }
+        if changes:
+            super().update(changes)
+            self._changed(changes)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._changed({key: None})
+
+    def pop(self, key, *args):
+        if key not in self:
+            return super().pop(key, *args)
+        value = super().pop(key)
+        self._changed({key: None})
+        return value
+
+    def clear(self):
+        if self:
+            changes = {k: None for k in self}
+            super().clear()
+            self._changed(changes)
+
+
+meta_vars = MetaVars()
+context_files: dict[int, typing.TextIO] = {}
+context_lock = threading.Lock()
+
+
+def _write_context(file: typing.TextIO, version: int, changes: dict):
+    file.write(
+        json.dumps(
+            {
+                "process_id": process_id,
+                "context_version": version,
+                "meta_vars": changes,
+            }
+        )
+        + "\n"
+    )
+    file.flush()
+
+
+def write_context_change(version: int, changes: dict):
+    with context_lock:
+        if process_id in context_files:
+            _write_context(context_files[process_id], version, changes)
+
+
+def get_context_file_for_process():
+    """Open the context file of this process, starting with a full snapshot of meta_vars."""
+    pid = process_id
+    script_name = get_script_name()
+
+    with context_lock:
+        if pid in context_files:
+            return context_files[pid]
+
+        file = open(f"{script_name}_mldaikon_context_{EXP_START_TIME}_{pid}.log", "w")
+        _write_context(file, meta_vars.version, dict(meta_vars))
+        context_files[pid] = file
+        return file
+
+
+# events are timestamped with time.monotonic_ns() (the same clock in all processes of the machine, it never goes
+# back), each process records one (monotonic, wall clock) anchor so that the reader can rebuild the wall time
+clock_anchor_pids: set[int] = set()
+clock_anchor_lock = threading.Lock()
+
+
+def write_clock_anchor_for_process():
+    pid = process_id
+    script_name = get_script_name()
+
+    with clock_anchor_lock:
+        if pid in clock_anchor_pids:
+            return
+        with open(f"{script_name}_mldaikon_clock_{EXP_START_TIME}_{pid}.log", "w") as f:
+            f.write(
+                json.dumps(
+                    {
+                        "process_id": pid,
+                        "monotonic_ns": time.monotonic_ns(),
+                        "wall_ns": time.time_ns(),
+                    }
+                )
+                + "\n"
+            )
+        clock_anchor_pids.add(pid)
+
+
+def stamp_trace(trace: dict):
+    """Add the monotonic timestamp (ns) and the per-thread sequence number to an event, unless it has them."""
     if "time" not in trace:
-        trace["time"] = datetime.datetime.now().timestamp()
-    logger.log(level, json.dumps(trace))
+        trace["time"] = time.monotonic_ns()
+    if "seq" not in trace:
+        trace["seq"] = next(thread_state.seq)
+
+
+def _make_trace_sink(kind: str, file_base: str):
+    """Sink of one segment of the "trace_API" or "trace_VAR" trace, by the configured format and compression."""
+    if kind == "trace_API" and trace_API_format != "json":
+        return ColumnarTraceWriter(file_base, trace_API_format, COLUMNAR_BLOCK_SIZE)
+    if trace_compression != "none":
+        return ChunkedTraceWriter(
+            f"{file_base}{CHUNKED_TRACE_EXT}",
+            trace_compression,
+            COMPRESSED_CHUNK_SIZE,
+            meta_vars.step_range,
+        )
+    return NDJSONTraceWriter(f"{file_base}.log")
+
+
+def _step_of_version(version: int):
+    steps = meta_vars.step_range(version, version)
+    return None if steps is None else steps[0]
+
+
+def get_trace_writer_for_process(
+    kind: str,
+) -> SegmentedTraceWriter | CollectorTraceSink:
+    """Writer of the "trace_API" or "trace_VAR" trace of this process, the collector sink if a collector is set."""
+    pid = process_id
+    script_name = get_script_name()
+
+    with process_state_lock:
+        if kind in process_trace_writers:
+            return process_trace_writers[kind]
+        writer = _open_trace_writer(kind, pid, script_name)
+        trace_writers[(kind, pid)] = process_trace_writers[kind] = writer
+        return writer
+
+
+def _open_trace_writer(
+    kind: str, pid: int, script_name: str
+) -> SegmentedTraceWriter | CollectorTraceSink:
+    if kind == "trace_API":
+        get_symbol_table_file_for_process()
+    get_context_file_for_process()
+    write_clock_anchor_for_process()
+    file_base = f"{script_name}_mldaikon_{kind}_{EXP_START_TIME}_{pid}"
+    if collector_socket is not None:
+        try:
+            return CollectorTraceSink(
+                collector_socket,
+                kind,
+                file_base,
+                COLLECTOR_BATCH_SIZE,
+                COLLECTOR_FLUSH_INTERVAL,
+            )
+        except OSError as e:
+            get_instrumentation_logger_for_process().warning(
+                f"Cannot connect to the trace collector at {collector_socket} ({e}), writing the {kind} trace of this process to files."
+            )
+    return SegmentedTraceWriter(
+        file_base,
+        functools.partial(_make_trace_sink, kind),
+        kind,
+        rotate_max_bytes,
+        rotate_every_steps,
+        _step_of_version,
+        f"{script_name}_mldaikon_manifest_{EXP_START_TIME}.log",
+    )
+
+
+def get_async_trace_writer_for_process() -> AsyncTraceWriter:
+    global process_async_writer
+    with process_state_lock:
+        if process_async_writer is None:
+            process_async_writer = async_trace_writers[process_id] = AsyncTraceWriter(
+                ASYNC_RING_CAPACITY,
+                async_overflow_policy,
+                ASYNC_SAMPLE_EVERY,
+                ASYNC_FLUSH_INTERVAL,
+            )
+        return process_async_writer
+
+
+def flush_async_trace_writer():
+    pid = process_id
+    if pid in async_trace_writers:
+        async_trace_writers[pid].flush()
+
+
+def wake_async_trace_writer():
+    pid = process_id
+    if pid in async_trace_writers:
+        async_trace_writers[pid].wake()
+
+
+def _flush_on_uncaught_exception(exc_type, exc_value, exc_traceback):
+    # the exception is about to bring the process down, make sure the pending events (including the
+    # exception events of the traced APIs it went through) are on disk
+    flush_async_trace_writer()
+    _previous_excepthook(exc_type, exc_value, exc_traceback)
+
+
+_previous_excepthook = sys.excepthook
+if async_trace:
+    sys.excepthook = _flush_on_uncaught_exception
+
+
+@atexit.register
+def close_trace_writers():
+    """Drain the async writer (if any), then close the columnar writer and the side tables of this process."""
+    global process_async_writer, trace_writers_closed
+    pid = process_id
+    if monitoring_backend is not None:
+        # no more events from the interpreter while the sinks are closed
+        monitoring_backend.stop()
+    if torch_ops_mode is not None:
+        torch_ops_mode.stop()
+    if sampler is not None:
+        sampler.flush(dump_trace_API, final=True)
+    if sampler is not None or (max_call_depth is not None and api_stats is None):
+        dump_call_counts()
+    if api_stats is not None:
+        dump_api_stats()
+        if pid in api_stats_files:
+            api_stats_files.pop(pid).close()
+    if instrumentation_report.targets:
+        # written once, with the attributes instrumented lazily (or by the import hook) since startup
+        dump_instrumentation_report()
+    if instrumentation_profile is not None:
+        dump_instrumentation_profile()
+    if pid in async_trace_writers:
+        process_async_writer = None
+        writer = async_trace_writers.pop(pid)
+        writer.close()
+        if writer.num_dropped > 0:
+            get_instrumentation_logger_for_process().warning(
+                f"Async trace writer dropped {writer.num_dropped} events due to the '{writer.overflow_policy}' overflow policy."
+            )
+    trace_writers_closed = True
+    for kind in ["trace_API", "trace_VAR"]:
+        if (kind, pid) in trace_writers:
+            process_trace_writers.pop(kind, None)
+            trace_writers.pop((kind, pid)).close()
+    with symbol_table_lock:
+        if pid in symbol_table_files:
+            symbol_table_files.pop(pid).close()
+    with context_lock:
+        if pid in context_files:
+            context_files.pop(pid).close()
+    with traceback_lock:
+        if pid in traceback_table_files:
+            traceback_table_files.pop(pid).close()
+
+
+def dump_call_counts():
+    """Write the exact number of calls of every API, counted by the call depth guard or the sampling policy."""
+    if max_call_depth is not None:
+        # the sampling policy (if any) does not see the calls below the maximum depth
+        num_calls = call_counts
+    else:
+        assert sampler is not None
+        num_calls = sampler.num_calls
+    script_name = get_script_name()
+    pid = process_id
+    with open(
+        f"{script_name}_mldaikon_call_counts_{EXP_START_TIME}_{pid}.log", "w"
+    ) as f:
+        for func_id, count in num_calls.items():
+            f.write(
+                json.dumps(
+                    {"process_id": pid, "function_id": func_id, "num_calls": count}
+                )
+                + "\n"
+            )
+
+
+def dump_api_stats():
+    """Append the statistics accumulated since the last dump to the stats file of this process."""
+    pid = process_id
+    assert api_stats is not None
+    script_name = get_script_name()
+
+    stats = api_stats.pop_stats()
+    if pid not in api_stats_files:
+        get_symbol_table_file_for_process()
+        api_stats_files[pid] = open(
+            f"{script_name}_mldaikon_api_stats_{EXP_START_TIME}_{pid}.log", "w"
+        )
+    file = api_stats_files[pid]
+    for record in stats:
+        record["process_id"] = pid
+        file.write(json.dumps(record) + "\n")
+    file.flush()
+
+
+def _before_fork():
+    pid = process_id
+    if pid in async_trace_writers:
+        async_trace_writers[pid].before_fork()
+
+
+def _after_fork_in_parent():
+    pid = process_id
+    if pid in async_trace_writers:
+        async_trace_writers[pid].after_fork_in_parent()
+
+
+def _register_close_in_child(_):
+    # multiprocessing children leave through os._exit, which skips atexit, but they do run the finalizers
+    multiprocessing.util.Finalize(None, close_trace_writers, exitpriority=0)
+
+
+def _after_fork_in_child():
+    global sampler, api_stats, process_id, process_trace_writers, process_async_writer
+    global process_instrumentation_logger, process_state_lock, symbol_table_lock, context_lock
+    global clock_anchor_lock, traceback_lock, trace_writers_closed, instrumentation_report
+    global flight_recorder, call_counts, instrumentation_profile, called_function_ids
+    process_id = os.getpid()
+    thread_state.thread_id = threading.get_ident()
+    # the calls active at the time of the fork are the parent's, the calls of the child start at depth 0
+    # (the ones of the stats mode with the new collector below). They still return in the child, `end_call`
+    # ignores them.
+    thread_state.call_stack = []
+    if monitoring_backend is not None:
+        monitoring_backend.reset_stacks()
+    # the cached writers are the parent's, the child opens its own on its first event
+    process_trace_writers = {}
+    process_async_writer = None
+    process_instrumentation_logger = None
+    trace_writers_closed = False
+    # a lock held by another thread of the parent at the time of the fork is never released in the child
+    process_state_lock = threading.RLock()
+    symbol_table_lock = threading.Lock()
+    context_lock = threading.Lock()
+    clock_anchor_lock = threading.Lock()
+    traceback_lock = threading.Lock()
+    # the calls counted (and buffered) so far belong to the parent
+    sampler = make_sampling_policy(
+        sampling_policy_name,
+        SAMPLING_FIRST_N,
+        SAMPLING_EVERY_K,
+        SAMPLING_RESERVOIR_SIZE,
+    )
+    if api_stats is not None:
+        api_stats = APIStatsCollector(STATS_DUMP_INTERVAL)
+    call_counts = {}
+    # the symbol table of the child only lists the functions called in the child
+    called_function_ids = set()
+    # the instrumentation done so far is reported by the parent
+    instrumentation_report = InstrumentationReport()
+    if instrumentation_profile is not None:
+        # the calls profiled so far belong to the parent
+        instrumentation_profile = InstrumentationProfile()
+    if flight_recorder is not None:
+        # the events recorded so far belong to the parent
+        flight_recorder = FlightRecorder(
+            flight_recorder.num_steps,
+            flight_recorder.max_bytes,
+            flight_recorder.chunk_size,
+        )
+
+
+# the child of a fork gets its own writers (see _after_fork_in_child), the parent's pending events are flushed before forking
+os.register_at_fork(
+    before=_before_fork,
+    after_in_parent=_after_fork_in_parent,
+    after_in_child=_after_fork_in_child,
+)
+multiprocessing.util.register_after_fork(close_trace_writers, _register_close_in_child)
+
+
+def _write_trace_API(trace: dict, level):
+    try:
+        writer = process_trace_writers["trace_API"]
+    except KeyError:
+        if trace_writers_closed:
+            return
+        writer = get_trace_writer_for_process("trace_API")
+    writer.write(trace)
+
+
+def _write_trace_VAR(trace: dict, level):
+    try:
+        writer = process_trace_writers["trace_VAR"]
+    except KeyError:
+        if trace_writers_closed:
+            return
+        writer = get_trace_writer_for_process("trace_VAR")
+    writer.write(trace)
+
+
+def dump_trace_API(trace: dict, level=logging.INFO):
+    """add a timestamp (monotonic ns) and a sequence number to the trace and dump it to the trace log file"""
+    stamp_trace(trace)
+    if flight_recorder is not None:
+        _record_flight_event("trace_API", trace)
+    elif async_trace:
+        (process_async_writer or get_async_trace_writer_for_process()).push(
+            (_write_trace_API, trace, level)
+        )
+    else:
+        _write_trace_API(trace, level)
 
 
 def dump_trace_VAR(trace: dict, level=logging.INFO):
-    """add a timestamp (unix) to the trace and dump it to the trace log file"""
-    logger = get_trace_VAR_logger_for_process()
-    if "time" not in trace:
-        trace["time"] = datetime.datetime.now().timestamp()
-    logger.log(level, json.dumps(trace))
+    """add a timestamp (monotonic ns) and a sequence number to the trace and dump it to the trace log file"""
+    stamp_trace(trace)
+    if flight_recorder is not None:
+        _record_flight_event("trace_VAR", trace)
+    elif async_trace:
+        (process_async_writer or get_async_trace_writer_for_process()).push(
+            (_write_trace_VAR, trace, level)
+        )
+    else:
+        _write_trace_VAR(trace, level)
+
+
+# flight-recorder mode (see flight_recorder.py): the events of the last steps are kept in memory and only written
+# when a trigger fires
+flight_recorder: FlightRecorder | None = (
+    FlightRecorder(
+        int(os.getenv("ML_DAIKON_FLIGHT_RECORDER_STEPS", FLIGHT_RECORDER_STEPS)),
+        FLIGHT_RECORDER_MAX_BYTES,
+        FLIGHT_RECORDER_CHUNK_SIZE,
+    )
+    if os.getenv("ML_DAIKON_FLIGHT_RECORDER", "1" if FLIGHT_RECORDER else "0") == "1"
+    else None
+)
+flight_recorder_triggers: list[str] = os.getenv(
+    "ML_DAIKON_FLIGHT_RECORDER_TRIGGERS", ",".join(FLIGHT_RECORDER_TRIGGERS)
+).split(",")
+# user callbacks called with the new step whenever the step changes, the recorder is dumped if one returns True
+flight_recorder_callbacks: list[typing.Callable[[typing.Any], bool]] = []
+_flight_recorder_dumping = False
+
+
+def _record_flight_event(kind: str, trace: dict):
+    assert flight_recorder is not None
+    if process_id not in context_files:
+        # the events refer to the context versions of their steps, the changes are written from the start
+        get_context_file_for_process()
+    flight_recorder.record(kind, trace, meta_vars.get("step"))
+    if flight_recorder.pending_trigger is not None:
+        reason, flight_recorder.pending_trigger = flight_recorder.pending_trigger, None
+        trigger_flight_recorder(reason)
+
+
+def trigger_flight_recorder(reason: str = "callback"):
+    """Write the events kept by the flight recorder to the trace files (no-op outside of the flight-recorder mode)."""
+    global _flight_recorder_dumping
+    if flight_recorder is None or _flight_recorder_dumping:
+        return
+    _flight_recorder_dumping = True
+    try:
+        steps = flight_recorder.steps()
+        events = flight_recorder.drain()
+        get_instrumentation_logger_for_process().warning(
+            f"Flight recorder triggered by {reason} at step {meta_vars.get('step')}, writing {len(events)} events of steps {steps}"
+            + (
+                f" ({flight_recorder.num_dropped} older events were dropped to stay within {FLIGHT_RECORDER_MAX_BYTES} bytes)"
+                if flight_recorder.num_dropped
+                else ""
+            )
+        )
+        flight_recorder.num_dropped = 0
+        for kind, trace in events:
+            if kind == "trace_API":
+                _write_trace_API(trace, logging.INFO)
+            else:
+                _write_trace_VAR(trace, logging.INFO)
+    finally:
+        _flight_recorder_dumping = False
+
+
+def add_flight_recorder_trigger(callback: typing.Callable[[typing.Any], bool]):
+    """Call `callback(step)` whenever the step changes, the flight recorder is dumped when it returns True."""
+    flight_recorder_callbacks.append(callback)
+
+
+def check_flight_recorder_triggers(step):
+    assert flight_recorder is not None
+    if flight_recorder.pending_trigger is not None:
+        reason, flight_recorder.pending_trigger = flight_recorder.pending_trigger, None
+        trigger_flight_recorder(reason)
+    if "callback" in flight_recorder_triggers:
+        for callback in flight_recorder_callbacks:
+            if callback(step):
+                trigger_flight_recorder(f"callback {callback.__name__}")
+
+
+def _on_flight_recorder_signal(signum, frame):
+    # the dump writes files, it is left to the next event / step instead of the signal handler
+    if flight_recorder is not None:
+        flight_recorder.pending_trigger = signal.Signals(signum).name
+
+
+if (
+    flight_recorder is not None
+    and "signal" in flight_recorder_triggers
+    and FLIGHT_RECORDER_SIGNAL is not None
+):
+    try:
+        signal.signal(
+            getattr(signal, FLIGHT_RECORDER_SIGNAL), _on_flight_recorder_signal
+        )
+    except (AttributeError, ValueError):
+        # not available on this platform, or not imported from the main thread
+        pass
 
 
 def get_instrumentation_logger_for_process():
-    pid = os.getpid()
-    script_name = os.getenv("MAIN_SCRIPT_NAME")
-    assert (
-        script_name is not None
-    ), "MAIN_SCRIPT_NAME is not set, examine the instrumented code to see if os.environ['MAIN_SCRIPT_NAME'] is set in the main function"
+    global process_instrumentation_logger
+    if process_instrumentation_logger is not None:
+        return process_instrumentation_logger
+    pid = process_id
+    script_name = get_script_name()
 
     if pid in instrumentation_loggers:
         return instrumentation_loggers[pid]
 
     logger = logging.getLogger(f"instrumentation_{pid}")
-    logger.setLevel(logging.INFO)
+    logger.setLevel(logging.DEBUG if instrumentation_verbose else logging.INFO)
     log_file = f"{script_name}_mldaikon_instrumentation_{EXP_START_TIME}_{pid}.log"
     file_handler = logging.FileHandler(log_file)
     file_handler.setFormatter(logging.Formatter("%(message)s"))
     logger.addHandler(file_handler)
-    instrumentation_loggers[pid] = logger
+    instrumentation_loggers[pid] = process_instrumentation_logger = logger
     return logger
 
 
-def global_wrapper(original_function, *args, **kwargs):
-    func_call_id = random.randint(0, 1000)
+def dump_instrumentation_report():
+    """Write the startup report of the instrumentor of this process, once at exit."""
+    script_name = get_script_name()
+    with open(
+        f"{script_name}_mldaikon_instrumentation_report_{EXP_START_TIME}_{process_id}.json",
+        "w",
+    ) as f:
+        json.dump(instrumentation_report.to_dict(INSTRUMENTATION_REPORT_MAX_OWNERS), f)
+
+
+def dump_instrumentation_profile():
+    assert instrumentation_profile is not None
+    with open(
+        f"{get_script_name()}_mldaikon_instrumentation_profile_{EXP_START_TIME}_{process_id}.json",
+        "w",
+    ) as f:
+        json.dump(
+            instrumentation_profile.to_dict(function_names, function_rule_names), f
+        )
 
-    # Get the current thread object
-    current_thread = threading.current_thread()
-    # Get the thread ID
-    thread_id = current_thread.ident
-    process_id = os.getpid()
 
-    func_name = original_function.__name__
-    if hasattr(original_function, "__module__"):
-        module_name = original_function.__module__
+def _emit_trace_API(target: bool | list, trace: dict, level=logging.INFO):
+    if target is True:
+        dump_trace_API(trace, level)
+    elif target is not False:
+        # buffered by the sampling policy, written later
+        stamp_trace(trace)
+        target.append((trace, level))
+
+
+# the schedule of the tracing windows (see windows.py), None traces every call
+_tracing_windows_spec = os.getenv("ML_DAIKON_TRACING_WINDOWS", TRACING_WINDOWS)
+tracing_schedule: TracingSchedule | None = (
+    None
+    if _tracing_windows_spec is None
+    else TracingSchedule(parse_windows(_tracing_windows_spec))
+)
+# whether a window is active, checked by the wrappers before anything else, and the rules selecting the only
+# APIs traced in the active windows (None: all of them)
+tracing_active = True
+window_apis: InstrumentationRules | None = None
+_window_api_rules: dict[tuple[str, ...], InstrumentationRules] = {}
+# func_id -> whether it is traced in the active windows, per set of window API rules
+window_api_decisions: dict[int, bool] = {}
+_window_api_decisions: dict[tuple[str, ...], dict[int, bool]] = {}
+
+
+def update_tracing_active():
+    """Recompute the tracing flag, called when the step or the windows change."""
+    global tracing_active, window_apis, window_api_decisions
+    if tracing_schedule is None:
+        tracing_active, window_apis = True, None
+        return
+    active, apis = tracing_schedule.active(meta_vars.get("step"))
+    if apis is not None and apis not in _window_api_rules:
+        _window_api_rules[apis] = InstrumentationRules(list(apis), [])
+        _window_api_decisions[apis] = {}
+    if apis is not None:
+        window_api_decisions = _window_api_decisions[apis]
+    window_apis = None if apis is None else _window_api_rules[apis]
+    tracing_active = active
+
+
+def is_traced_in_window(func_id: int) -> bool:
+    """Whether the calls of func_id are traced in the active windows, by the rules they were instrumented by."""
+    traced = window_api_decisions.get(func_id)
+    if traced is None:
+        assert window_apis is not None
+        # torch ops are not wrapped, they are matched by their traced name
+        names = function_rule_names.get(func_id) or [function_names[func_id]]
+        traced = window_api_decisions[func_id] = any(
+            window_apis.should_instrument(name) for name in names
+        )
+    return traced
+
+
+@contextlib.contextmanager
+def tracing_window(
+    steps: int | tuple[int, int] | range | None = None, apis: list[str] | None = None
+):
+    """Trace the calls made in this block, only in the given steps (a step, an inclusive (first, last) range
+    or a range) and of the given APIs (rules like INSTRUMENTATION_INCLUDE) if any.
+
+    While the block runs, calls are only traced inside the active windows. Without a configured schedule,
+    every call is traced again once the blocks exit.
+    """
+    global tracing_schedule
+    if steps is None:
+        window = TracingWindow(apis=apis)
+    elif isinstance(steps, int):
+        window = TracingWindow(steps, steps, apis)
+    elif isinstance(steps, range):
+        window = TracingWindow(steps.start, steps.stop - 1, apis)
     else:
-        module_name = "unknown"
+        window = TracingWindow(steps[0], steps[1], apis)
+    schedule = tracing_schedule
+    if schedule is None:
+        schedule = tracing_schedule = TracingSchedule([], temporary=True)
+    schedule.add(window)
+    update_tracing_active()
+    try:
+        yield window
+    finally:
+        schedule.remove(window)
+        if tracing_schedule is schedule and not schedule.windows and schedule.temporary:
+            # the schedule was only there for the windows of the blocks
+            tracing_schedule = None
+        update_tracing_active()
+
+
+# the window opened / closed by the tracing signal, tracing everything while it is open
+_signal_window = TracingWindow()
+
+
+def _on_tracing_signal(signum, frame):
+    global tracing_schedule
+    if tracing_schedule is None:
+        # tracing everything so far
+        tracing_schedule = TracingSchedule([])
+    elif _signal_window in tracing_schedule.windows:
+        tracing_schedule.remove(_signal_window)
+    else:
+        tracing_schedule.add(_signal_window)
+    update_tracing_active()
 
-    func_name = f"{module_name}.{func_name}"
 
-    dump_trace_API(
-        {
-            "func_call_id": func_call_id,
-            "thread_id": thread_id,
-            "process_id": process_id,
-            "meta_vars": meta_vars,
-            "type": "function_call (pre)",
-            "function": func_name,
-        }
-    )
+_tracing_window_signal = os.getenv(
+    "ML_DAIKON_TRACING_WINDOW_SIGNAL", TRACING_WINDOW_SIGNAL
+)
+if _tracing_window_signal:
     try:
-        result = original_function(*args, **kwargs)
-    except Exception as e:
-        dump_trace_API(
+        # the default action of the signal would kill the process, a handler set by the program is kept
+        if signal.getsignal(getattr(signal, _tracing_window_signal)) == signal.SIG_DFL:
+            signal.signal(getattr(signal, _tracing_window_signal), _on_tracing_signal)
+    except (AttributeError, ValueError):
+        # not available on this platform, or not imported from the main thread
+        pass
+
+
+def begin_call(func_id: int, op_args: tuple | None = None) -> tuple | None:
+    """Record the start of a call of func_id and return the state `end_call` needs.
+
+    This is shared by all tracing backends, so that they produce the same trace. The torch op modes
+    pass the (args, kwargs) of the op as op_args, to add a summary of its tensors to the pre event.
+    Outside of the tracing windows (and in the instrumentor), the call is not recorded and None is returned. Below the maximum call
+    depth, the call is only counted.
+    """
+    if (
+        not tracing_active
+        or thread_state.in_instrumentor
+        or (window_apis is not None and not is_traced_in_window(func_id))
+    ):
+        return None
+    if func_id not in called_function_ids:
+        _add_called_function(func_id)
+    if api_stats is not None:
+        stack = api_stats.get_stack()
+        parent_func_id = stack[-1] if stack else None
+        stack.append(func_id)
+        return (func_id, parent_func_id, time.perf_counter_ns(), process_id)
+
+    state = thread_state
+    call_stack = state.call_stack
+    call_depth = len(call_stack)
+    if max_call_depth is not None:
+        call_counts[func_id] = call_counts.get(func_id, 0) + 1
+        if call_depth > max_call_depth:
+            # the calls it makes are deeper, they are not traced either
+            call_stack.append((None, False))
+            return (func_id, None, None, call_depth, False, None, process_id)
+
+    func_call_id = next(call_id_counter)
+    if call_stack:
+        parent_call_id, parent_target = call_stack[-1]
+    else:
+        parent_call_id, parent_target = None, False
+
+    target: bool | list = True
+    if sampler is not None:
+        # the policy of the API decides at every depth, unless the calls inside a traced call are kept (into
+        # the same target)
+        inherited = sampling_keep_nested and parent_target is not False
+        target = sampler.sample(func_id, inherited, meta_vars.get("step"))
+        if inherited:
+            target = parent_target
+        if sampler.has_pending:
+            sampler.flush(dump_trace_API)
+
+    call_stack.append((func_call_id, target))
+    if target is False:
+        return (
+            func_id,
+            func_call_id,
+            parent_call_id,
+            call_depth,
+            target,
+            None,
+            process_id,
+        )
+
+    thread_id = state.thread_id
+    trace = {
+        "func_call_id": func_call_id,
+        "parent_call_id": parent_call_id,
+        "call_depth": call_depth,
+        "thread_id": thread_id,
+        "process_id": process_id,
+        "context_version": meta_vars.version,
+        "type": "function_call (pre)",
+        "function_id": func_id,
+    }
+    if op_args is not None:
+        trace["tensors"] = summarize_tensors(*op_args)
+    _emit_trace_API(target, trace)
+    return (
+        func_id,
+        func_call_id,
+        parent_call_id,
+        call_depth,
+        target,
+        thread_id,
+        process_id,
+    )
+
+
+def end_call(
+    call: tuple | None,
+    exception: BaseException | None = None,
+    args: tuple = (),
+    kwargs: dict | None = None,
+):
+    """Record the end of a call started with `begin_call`.
+
+    An `Exception` is recorded as a "function_call (post) (exception)" event, other `BaseException`s
+    (e.g. KeyboardInterrupt) only close the call.
+    """
+    if call is None:
+        # started outside of the tracing windows
+        return
+    if call[-1] != process_id:
+        # started in the parent process before the fork, the call stacks of the child do not hold it
+        return
+    if api_stats is not None:
+        func_id, parent_func_id, start, _ = call
+        end = time.perf_counter_ns()
+        api_stats.get_stack().pop()
+        api_stats.record(
+            func_id,
+            parent_func_id,
+            meta_vars.get("step"),
+            end - start,
+            exception is not None,
+        )
+        if end > api_stats.next_dump_ns:
+            dump_api_stats()
+        return
+
+    func_id, func_call_id, parent_call_id, call_depth, target, thread_id, _ = call
+    thread_state.call_stack.pop()
+    if target is False:
+        return
+
+    if exception is None:
+        _emit_trace_API(
+            target,
+            {
+                "func_call_id": func_call_id,
+                "parent_call_id": parent_call_id,
+                "call_depth": call_depth,
+                "thread_id": thread_id,
+                "process_id": process_id,
+                "context_version": meta_vars.version,
+                "type": "function_call (post)",
+                "function_id": func_id,
+            },
+            logging.INFO,
+        )
+    elif isinstance(exception, Exception):
+        kwargs = kwargs or {}
+        _emit_trace_API(
+            target,
             {
                 "func_call_id": func_call_id,
+                "parent_call_id": parent_call_id,
+                "call_depth": call_depth,
                 "thread_id": thread_id,
                 "process_id": process_id,
-                "meta_vars": meta_vars,
+                "context_version": meta_vars.version,
                 "type": "function_call (post) (exception)",
-                "function": func_name,
-                "args": [f"{arg}" for arg in args],
-                "kwargs": [f"{k}={v}" for k, v in kwargs.items()],
-                "exception": str(e),
-                "traceback": traceback.format_exc(),
+                "function_id": func_id,
+                "args": [describe_arg(arg) for arg in args],
+                "kwargs": [f"{k}={describe_arg(v)}" for k, v in kwargs.items()],
+                "exception": _exception_message(exception),
+                "traceback_hash": get_traceback_hash(exception),
             },
             logging.ERROR,
         )
-        print(f"Error in {func_name}: {e}")
+        # write the exception soon without writing in this thread, programs may catch (many) exceptions of
+        # traced APIs. An uncaught exception flushes the pending events in sys.excepthook and at exit.
+        wake_async_trace_writer()
+        if flight_recorder is not None and "exception" in flight_recorder_triggers:
+            trigger_flight_recorder(f"exception in {function_names[func_id]}")
+        print(f"Error in {function_names[func_id]}: {exception}")
+
+
+def _exception_message(exception: BaseException) -> str:
+    try:
+        message = str(exception)
+    except Exception:
+        message = typename(type(exception))
+    if len(message) > EXCEPTION_MESSAGE_MAX_LENGTH:
+        message = message[:EXCEPTION_MESSAGE_MAX_LENGTH] + "..."
+    return message
+
+
+def global_wrapper(original_function, func_id, /, *args, **kwargs):
+    call = begin_call(func_id)
+    try:
+        result = original_function(*args, **kwargs)
+    except BaseException as e:
+        end_call(call, e, args, kwargs)
+        raise e
+    end_call(call)
+    return result
+
+
+def profiled_global_wrapper(original_function, func_id, /, *args, **kwargs):
+    """`global_wrapper` measuring the time spent outside of the original function, for the profiling run."""
+    start = time.perf_counter_ns()
+    call = begin_call(func_id)
+    overhead = time.perf_counter_ns() - start
+    try:
+        result = original_function(*args, **kwargs)
+    except BaseException as e:
+        start = time.perf_counter_ns()
+        end_call(call, e, args, kwargs)
+        instrumentation_profile.record(  # type: ignore
+            func_id, overhead + time.perf_counter_ns() - start
+        )
         raise e
-    dump_trace_API(
-        {
-            "func_call_id": func_call_id,
-            "thread_id": thread_id,
-            "process_id": process_id,
-            "meta_vars": meta_vars,
-            "type": "function_call (post)",
-            "function": func_name,
-        },
-        logging.INFO,
+    start = time.perf_counter_ns()
+    end_call(call)
+    instrumentation_profile.record(  # type: ignore
+        func_id, overhead + time.perf_counter_ns() - start
     )
     return result
 
 
+# "wrapper" replaces the instrumented functions with wrappers calling `global_wrapper`, "monitoring" leaves
+# them in place and gets their calls from sys.monitoring (sys.setprofile before Python 3.12)
+tracing_backend = os.getenv("ML_DAIKON_TRACING_BACKEND", TRACING_BACKEND)
+monitoring_backend: MonitoringBackend | None = (
+    make_monitoring_backend(begin_call, end_call)
+    if tracing_backend == "monitoring"
+    else None
+)
+# C-implemented torch ops are traced by a torch function / dispatch mode, "off" disables it
+trace_torch_ops = os.getenv("ML_DAIKON_TRACE_TORCH_OPS", TRACE_TORCH_OPS)
+torch_ops_mode = make_torch_ops_mode(
+    trace_torch_ops, begin_call, end_call, get_function_id
+)
+# with the torch function mode, the builtins it sees are not wrapped as well
+torch_function_overridables: set = (
+    set(torch.overrides.get_testing_overrides())
+    if trace_torch_ops == "function"
+    else set()
+)
+
+
+def get_qualified_function_name(original_function) -> str:
+    func_name = original_function.__name__
+    if hasattr(original_function, "__module__"):
+        module_name = original_function.__module__
+    else:
+        module_name = "unknown"
+    return f"{module_name}.{func_name}"
+
+
 def wrapper(original_function):
+    # resolve the function identity once here instead of on every call
+    func_id = get_wrapped_function_id(original_function)
+    traced_call = global_wrapper
+    if instrumentation_profile is not None:
+        traced_call = profiled_global_wrapper
+
     @functools.wraps(original_function)
     def wrapped(*args, **kwargs):
-        return global_wrapper(original_function, *args, **kwargs)
+        # outside of the tracing windows, the wrapper costs this check
+        if not tracing_active:
+            return original_function(*args, **kwargs)
+        return traced_call(original_function, func_id, *args, **kwargs)
 
     return wrapped
 
@@ -296,14 +1500,75 @@ instrumented_modules = set()
 skipped_modules: set[types.ModuleType | type | types.FunctionType] = set()
 skipped_functions = set()
 
-# there are certain modules that we don't want to instrument (for example, download(), tqdm, etc.)
-modules_to_skip = [
-    "torch.fx",
-    "torch.jit",
-    "torch._jit",
-    "torch._C",
-    "torch._sources",  # FIXME: cannot handle this module, instrumenting it will lead to exceptions: TypeError: module, class, method, function, traceback, frame, or code object was expected, got builtin_function_or_method
-]
+# rules selecting what is instrumented by qualified name (see rules.py), the exclude rules hold the modules that
+# we don't want to instrument (for example, download(), tqdm, etc.)
+instrumentation_include: list[str] = json.loads(
+    os.getenv("ML_DAIKON_INSTRUMENTATION_INCLUDE", json.dumps(INSTRUMENTATION_INCLUDE))
+)
+instrumentation_exclude: list[str] = json.loads(
+    os.getenv("ML_DAIKON_INSTRUMENTATION_EXCLUDE", json.dumps(INSTRUMENTATION_EXCLUDE))
+)
+# the exclusion list of a profiling run (see overhead_profile.py)
+instrumentation_exclude_file = os.getenv(
+    "ML_DAIKON_INSTRUMENTATION_EXCLUDE_FILE", INSTRUMENTATION_EXCLUDE_FILE
+)
+if instrumentation_exclude_file:
+    instrumentation_exclude += load_exclusion_list(instrumentation_exclude_file)
+instrumentation_rules = InstrumentationRules(
+    instrumentation_include, instrumentation_exclude
+)
+
+# the plan of the walk over a target (the functions to patch) is cached across runs, see plan_cache.py
+plan_cache_enabled = (
+    os.getenv("ML_DAIKON_PLAN_CACHE", "1" if INSTRUMENTATION_PLAN_CACHE else "0") == "1"
+)
+plan_cache_dir = os.getenv("ML_DAIKON_PLAN_CACHE_DIR", INSTRUMENTATION_PLAN_CACHE_DIR)
+# "eager" walks the whole target when it is instrumented, "lazy" only instruments an attribute of a module the
+# first time it is looked up (see LazyInstrumentedModule)
+instrumentation_mode = os.getenv("ML_DAIKON_INSTRUMENTATION_MODE", INSTRUMENTATION_MODE)
+
+
+class _LazyModuleState:
+    def __init__(self, instrumentor: "Instrumentor", name: str, depth: int, path: str):
+        self.instrumentor = instrumentor
+        self.name = name
+        self.depth = depth
+        self.path = path
+        # attributes already looked up (and instrumented if needed)
+        self.seen: set[str] = set()
+
+
+lazy_module_states: dict[types.ModuleType, _LazyModuleState] = {}
+lazy_instrumentation_lock = threading.RLock()
+
+
+class LazyInstrumentedModule(types.ModuleType):
+    """Class swapped in for the class of the modules instrumented lazily.
+
+    The first lookup of an attribute goes through the same checks as the eager walk: functions are replaced
+    by their wrappers in the module, submodules get this class in turn and classes are instrumented as a
+    whole. Later lookups only pay for this `__getattribute__` and a set lookup.
+    """
+
+    # modules see the `__module__` of their class, keep it the one of ModuleType so that `typename` of a
+    # lazily instrumented module is still its name
+    __module__ = types.ModuleType.__module__
+
+    def __getattribute__(self, name):
+        value = types.ModuleType.__getattribute__(self, name)
+        if name[:2] == "__":
+            return value
+        state = lazy_module_states.get(self)
+        if state is None or name in state.seen:
+            return value
+        with lazy_instrumentation_lock, not_traced_in_thread():
+            if name not in state.seen:
+                state.seen.add(name)
+                state.instrumentor._instrument_attr(
+                    self, state.name, name, state.depth, state.path
+                )
+        # the attribute may have been replaced by its wrapper
+        return types.ModuleType.__getattribute__(self, "__dict__").get(name, value)
 
 
 class Instrumentor:
@@ -339,217 +1604,438 @@ class Instrumentor:
             self.instrumenting = False
         self.instrumented_count = 0
         self.target = target
-
-        # TODO: check if self.target or self.root_module is in the modules_to_skip list
+        self.target_name = typename(target)
+        # how the target was instrumented: "walk", "plan", "lazy" or "already_instrumented"
+        self.method = "walk"
+        # plan recorded by the walk: the visited owners and the patched (owner path, attribute, kind)
+        self.plan_owners: list[str] = []
+        self.plan_functions: list[tuple[str, str, str]] = []
+        # paths of the owners reached by the walk that were instrumented before it by another target
+        self.plan_instrumented_before: list[str] = []
+        self.walked: set[types.ModuleType | type] = set()
 
         # remove the target from the skipped_modules set
         if target in skipped_modules and self.instrumenting:
             assert not callable(target), f"Skipping callable {target} is not supported"
             skipped_modules.remove(target)
 
-    def check_if_to_skip(self, attr: type):
-        if typename(attr) in modules_to_skip:
-            return True
-
-        for modules_to_skip_prefix in modules_to_skip:
-            if typename(attr).startswith(modules_to_skip_prefix):
-                return True
+    def check_if_to_skip(self, attr, name: str | None = None):
+        """Whether attr (whose qualified name is `name`, looked up if not given) is not instrumented."""
+        if name is None:
+            name = typename(attr)
 
         # attr should also be skipped if the attr does belong to the target
-        if not typename(attr).startswith(typename(self.target)):
+        if not name.startswith(self.target_name):
             return True
 
-        return False
+        if isinstance(attr, types.ModuleType) or inspect.isclass(attr):
+            return not instrumentation_rules.should_visit(name)
+        return not instrumentation_rules.should_instrument(name)
 
     def instrument(self):
         if self.instrumenting:
-            self.instrumented_count = self._instrument_module(self.target)
+            start_ns = time.perf_counter_ns()
+            with not_traced_in_thread():
+                self.instrumented_count = self._instrument_target()
+            if monitoring_backend is not None:
+                monitoring_backend.start()
+            if torch_ops_mode is not None:
+                torch_ops_mode.start()
+            duration_ns = time.perf_counter_ns() - start_ns
+            instrumentation_report.add_target(
+                self.target_name, self.method, self.instrumented_count, duration_ns
+            )
+            get_instrumentation_logger_for_process().info(
+                f"Instrumented {self.target_name} ({self.method}) in {duration_ns / 1e9:.3f}s, wrapped {self.instrumented_count} functions"
+            )
             return self.instrumented_count
         return 0
 
-    def _instrument_module(self, pymodule: types.ModuleType | type, depth=0):
+    def _instrument_target(self) -> int:
+        """Apply the cached plan of the target if there is one, otherwise walk the target and cache its plan."""
+        target_name = self.target_name
+        if self.target in instrumented_modules:
+            # instrumented_modules is the registry shared by every Instrumentor of the process (including the
+            # ones created by the import hook), a module reached again is not walked (nor its plan recorded)
+            get_instrumentation_logger_for_process().info(
+                f"{target_name} is already instrumented, skipping"
+            )
+            self.method = "already_instrumented"
+            return 0
+        if instrumentation_mode == "lazy" and isinstance(self.target, types.ModuleType):
+            self.method = "lazy"
+            self._instrument_target_lazily()
+            return 0
+        self.method = "walk"
+        if not plan_cache_enabled:
+            return self._instrument_module(self.target)
+
+        key = plan_cache_key(
+            target_name,
+            {
+                "tracing_backend": tracing_backend,
+                "trace_torch_ops": trace_torch_ops,
+                "instrumentation_include": instrumentation_include,
+                "instrumentation_exclude": instrumentation_exclude,
+            },
+        )
+        plan = load_plan(plan_cache_dir, key)
+        if plan is not None:
+            count = self._apply_plan(plan)
+            if count is not None:
+                self.method = "plan"
+                get_instrumentation_logger_for_process().info(
+                    f"Applied the cached instrumentation plan of {target_name}, wrapped {count} functions"
+                )
+                return count
+            get_instrumentation_logger_for_process().warning(
+                f"The cached instrumentation plan of {target_name} does not match the loaded modules, instrumenting from scratch"
+            )
+
+        count = self._instrument_module(self.target)
+        save_plan(
+            plan_cache_dir,
+            key,
+            self.plan_owners,
+            self.plan_functions,
+            self.plan_instrumented_before,
+        )
+        return count
+
+    def _instrument_target_lazily(self):
+        assert isinstance(self.target, types.ModuleType)
+        get_instrumentation_logger_for_process().info(
+            f"Instrumenting {self.target.__name__} lazily, attributes are instrumented on their first lookup"
+        )
+        self._instrument_module_lazily(self.target, 0, "")
+        # submodules imported before may be used without a lookup through their parent (e.g. `F` bound by
+        # `from torch.nn import functional as F` in other torch modules), they get the lazy class right away
+        prefix = f"{self.target.__name__}."
+        for name, module in list(sys.modules.items()):
+            if (
+                name.startswith(prefix)
+                and isinstance(module, types.ModuleType)
+                and typename(module).startswith(self.root_module)
+                and not self.check_if_to_skip(module)
+            ):
+                self._instrument_module_lazily(
+                    module, name.count(".") - prefix.count(".") + 1, name[len(prefix) :]
+                )
+
+    def _instrument_module_lazily(self, pymodule: types.ModuleType, depth, path: str):
+        if pymodule in instrumented_modules or pymodule in skipped_modules:
+            return
+        if type(pymodule) is not types.ModuleType:
+            # modules with their own class (e.g. torch._ops namespaces) cannot be given the lazy class
+            self._instrument_module(pymodule, depth, path)
+            return
+        get_instrumentation_logger_for_process().debug(
+            f"Depth: {depth}, Deferring the instrumentation of module: {pymodule.__name__}"
+        )
+        instrumented_modules.add(pymodule)
+        lazy_module_states[pymodule] = _LazyModuleState(
+            self, pymodule.__name__, depth, path
+        )
+        instrumentation_report.add_owner(pymodule.__name__, "lazy module")
+        pymodule.__class__ = LazyInstrumentedModule
+
+    def _instrument_submodule(self, pymodule: types.ModuleType, depth, path: str):
+        if instrumentation_mode == "lazy":
+            self._instrument_module_lazily(pymodule, depth, path)
+            return 0
+        return self._instrument_module(pymodule, depth, path)
+
+    def _resolve_plan_owner(self, path: str):
+        owner = self.target
+        for name in path.split(".") if path else []:
+            owner = owner.__dict__.get(name)
+            if not (isinstance(owner, types.ModuleType) or inspect.isclass(owner)):
+                return None
+        return owner
+
+    def _apply_plan(self, plan: dict) -> int | None:
+        """Patch the functions listed in the plan, None (and nothing patched) if the plan cannot be applied."""
+        owners = {}
+        for path in plan["owners"]:
+            owner = self._resolve_plan_owner(path)
+            if owner is None or owner in instrumented_modules:
+                return None
+            owners[path] = owner
+        for path in plan["instrumented_before"]:
+            owner = self._resolve_plan_owner(path)
+            if owner not in instrumented_modules:
+                # the plan relied on another target instrumenting it first
+                return None
+
+        patches = []
+        for path, attr_name, kind in plan["functions"]:
+            owner = owners.get(path)
+            attr = None if owner is None else owner.__dict__.get(attr_name)
+            if not isinstance(attr, (types.FunctionType, types.BuiltinFunctionType)):
+                return None
+            patches.append((owner, attr_name, attr, kind))
+
+        instrumented_modules.update(owners.values())
+        for owner, attr_name, attr, kind in patches:
+            if kind == "monitoring":
+                assert monitoring_backend is not None
+                monitoring_backend.add_function(attr, get_wrapped_function_id(attr))
+            else:
+                setattr(owner, attr_name, wrapper(attr))
+        return len(patches)
+
+    def _instrument_module(
+        self, pymodule: types.ModuleType | type, depth=0, path: str = ""
+    ):
+        """Walk a module / class (at the attribute path `path` from the target) and patch its functions."""
         target_name = pymodule.__name__
 
         if pymodule in instrumented_modules or pymodule in skipped_modules:
-            get_instrumentation_logger_for_process().info(
+            get_instrumentation_logger_for_process().debug(
                 f"Depth: {depth}, Skipping module: {target_name}"
             )
+            if pymodule in instrumented_modules and pymodule not in self.walked:
+                self.plan_instrumented_before.append(path)
             return 0
 
-        get_instrumentation_logger_for_process().info(
+        get_instrumentation_logger_for_process().debug(
             f"Depth: {depth}, Instrumenting module: {target_name}"
         )
         instrumented_modules.add(pymodule)
+        self.walked.add(pymodule)
+        self.plan_owners.append(path)
 
+        owner_name = typename(pymodule)
+        instrumentation_report.begin_owner(
+            owner_name, "module" if isinstance(pymodule, types.ModuleType) else "class"
+        )
         count_wrapped = 0
-        for attr_name in dir(pymodule):
-            if not hasattr(pymodule, attr_name):
-                # handle __abstractmethods__ attribute
-                get_instrumentation_logger_for_process().info(
-                    f"Depth: {depth}, Skipping attribute as it does not exist: {attr_name}"
+        try:
+            for attr_name in dir(pymodule):
+                count_wrapped += self._instrument_attr(
+                    pymodule, owner_name, attr_name, depth, path
                 )
-                continue
+        finally:
+            instrumentation_report.end_owner()
 
-            attr = pymodule.__dict__.get(
-                attr_name, None
-            )  # getattr(pymodule, attr_name)
-
-            if attr is None:
-                get_instrumentation_logger_for_process().info(
-                    f"Depth: {depth}, Skipping attribute as it is None: {attr_name}"
-                )
-                """
-                TODO: From my observation, this is happening for the attributes that are implemented in C extension, which usually include math ops and other low level operations for tensors
-                , such as tensor.add_.
-                We should support these operations as well. Reason is in PyTorch-FORUM84911.
-                """
-                continue
+        get_instrumentation_logger_for_process().debug(
+            f"Depth: {depth}, Wrapped {count_wrapped} functions in module {target_name}"
+        )
+        return count_wrapped
 
-            # TODO: fix the bug "TypeError: module, class, method, function, traceback, frame, or code object was expected, got builtin_function_or_method"
-            if "getfile" in attr_name:
-                get_instrumentation_logger_for_process().info(
-                    f"Depth: {depth}, Skipping attribute as it is getfile: {attr_name}"
-                )
-                continue
+    def _instrument_attr(
+        self,
+        pymodule: types.ModuleType | type,
+        owner_name: str,
+        attr_name: str,
+        depth: int,
+        path: str,
+    ) -> int:
+        """Instrument one attribute of a module / class (named owner_name), returns the number of functions
+        wrapped."""
+        if not hasattr(pymodule, attr_name):
+            # handle __abstractmethods__ attribute
+            get_instrumentation_logger_for_process().debug(
+                f"Depth: {depth}, Skipping attribute as it does not exist: {attr_name}"
+            )
+            instrumentation_report.record(owner_name, "missing")
+            return 0
 
-            # skip private attributes
-            if attr_name.startswith("__"):
-                get_instrumentation_logger_for_process().info(
-                    f"Depth: {depth}, Skipping magic functions: {attr_name}"
-                )
-                # if callable(attr): # TODO: understand why callable leads to issues
-                if isinstance(attr, types.FunctionType):
-                    skipped_functions.add(attr)
-                elif isinstance(attr, types.ModuleType):
-                    skipped_modules.add(attr)
-                continue
-
-            """Current Issue with private attributes:
-
-            Background: 
-            
-                There are actually no *private* attributes in Python. 
-                The single underscore prefix is a *convention* that is used to indicate 
-                that the attribute should not be accessed directly. 
-            
-                The double underscore function names such as `__init__` are actually 
-                'magic' functions in Python. 
-                These functions are super useful and are used to control the behavior of the class. 
-                To know more, refer to this link: https://rszalski.github.io/magicmethods/    
-                A lot of these magic functions, if instrumented, can be helpful. For example,
-                arguments to __init__ can be printed to understand how the class is initialized.
-                Also, incepting `__setattr__` can keep track of variable (e.g. weights and gradients) 
-                changes in the class.
-
-            Issue:
-                The problem is that if we are to instrument all the magic functions, the `__repr__` 
-                is leading to some troubles. 
-
-                ```
-                Before calling __repr__
-                Exception in __repr__: maximum recursion depth exceeded
-                Exception in extra_repr: maximum recursion depth exceeded while getting the repr of an object
-                Before calling __repr__
-                Before calling extra_repr
-                ```
-                This is because `__repr__` is called by `extra_repr` and `extra_repr` is called by `__repr__`.
-
-
-            Plan for now:
-                This feature is being delayed for now. The original motivation for tracking the magic functions is to 
-                capture invalid configs when initialting the classes. For example, if a optimizer is intialized with
-                no learnable parameters, it is a sign of a bug. 
-                However, we plan to delay this feature for now. The reasons are two fold:
-                1. In most ML pipelines, the class initialization code are only run once. This means if we want to 
-                    infer invariants from these initializations, we need to combine trace from multiple pipelines. I think
-                    it is better to just focus on the main training loop for now as these are executed multiple times and 
-                    we can infer things from just one pipeline.
-                2. The second reason is these invalid initializations usually have symptoms during the training loop.
-                    If the optimizer is not passed with learnable parameters, we will observe that no updates are being performed
-                    to the model weights. This is a clear symptom that can be captured during the training loop.
-
-                So for now, we will skip the magic functions.
-            """
+        attr = pymodule.__dict__.get(attr_name, None)  # getattr(pymodule, attr_name)
 
-            # if callable(attr):
+        if attr is None:
+            get_instrumentation_logger_for_process().debug(
+                f"Depth: {depth}, Skipping attribute as it is None: {attr_name}"
+            )
             """
-              File "/home/yuxuan/gitrepos/ml-daikon/src/instrumentor/tracer.py", line 243, in _instrument_module
-                if attr in skipped_functions:
-            TypeError: unhashable type: 'instancemethod'
-              File "/home/yuxuan/miniconda3/envs/PyTorch-FORUM84911/lib/python3.10/site-packages/torch/library.py", line 109, in impl
-                elif isinstance(op_name, OpOverload):
-            TypeError: isinstance() arg 2 must be a type, a tuple of types, or a union
+            TODO: From my observation, this is happening for the attributes that are implemented in C extension, which usually include math ops and other low level operations for tensors
+            , such as tensor.add_.
+            We should support these operations as well. Reason is in PyTorch-FORUM84911.
             """
+            instrumentation_report.record(owner_name, "none")
+            return 0
 
-            if self.check_if_to_skip(attr):
-                get_instrumentation_logger_for_process().info(
-                    f"Depth: {depth}, Skipping due to modules_to_skip: {typename(attr)}"
-                )
-                continue
+        # TODO: fix the bug "TypeError: module, class, method, function, traceback, frame, or code object was expected, got builtin_function_or_method"
+        if "getfile" in attr_name:
+            get_instrumentation_logger_for_process().debug(
+                f"Depth: {depth}, Skipping attribute as it is getfile: {attr_name}"
+            )
+            instrumentation_report.record(owner_name, "getfile")
+            return 0
 
-            if isinstance(attr, types.FunctionType) or isinstance(
-                attr, types.BuiltinFunctionType
-            ):
-                # if isinstance(attr
-                try:
-                    if attr in skipped_functions:
-                        get_instrumentation_logger_for_process().info(
-                            f"Depth: {depth}, Skipping function: {typename(attr)}"
-                        )
-                        continue
-                except Exception as e:
-                    get_instrumentation_logger_for_process().fatal(
-                        f"Depth: {depth}, Error while checking if function {typename(attr)} is in skipped_functions: {e}"
-                    )
-                    continue
-                get_instrumentation_logger_for_process().info(
-                    f"Instrumenting function: {typename(attr)}"
-                )
-                wrapped = wrapper(attr)
-                try:
-                    setattr(pymodule, attr_name, wrapped)
-                except Exception as e:
-                    # handling immutable types and attrs that have no setters
-                    get_instrumentation_logger_for_process().info(
-                        f"Depth: {depth}, Skipping function {typename(attr)} due to error: {e}"
-                    )
-                    continue
-                count_wrapped += 1
+        # skip private attributes
+        if attr_name.startswith("__"):
+            get_instrumentation_logger_for_process().debug(
+                f"Depth: {depth}, Skipping magic functions: {attr_name}"
+            )
+            # if callable(attr): # TODO: understand why callable leads to issues
+            if isinstance(attr, types.FunctionType):
+                skipped_functions.add(attr)
             elif isinstance(attr, types.ModuleType):
-                if attr in skipped_modules:
-                    get_instrumentation_logger_for_process().info(
-                        f"Depth: {depth}, Skipping module: {typename(attr)}"
-                    )
-                    continue
-                if not typename(attr).startswith(
-                    self.root_module
-                ):  # TODO: refine the logic of how to rule out irrelevant modules
-                    get_instrumentation_logger_for_process().info(
-                        f"Depth: {depth}, Skipping module due to irrelevant name:{typename(attr)}"
-                    )
-                    skipped_modules.add(attr)
-                    continue
+                skipped_modules.add(attr)
+            instrumentation_report.record(owner_name, "magic")
+            return 0
 
-                get_instrumentation_logger_for_process().info(
-                    f"Depth: {depth}, Recursing into module: {typename(attr)}"
-                )
-                count_wrapped += self._instrument_module(attr, depth + 1)
+        """Current Issue with private attributes:
+
+        Background: 
+
+            There are actually no *private* attributes in Python. 
+            The single underscore prefix is a *convention* that is used to indicate 
+            that the attribute should not be accessed directly. 
+
+            The double underscore function names such as `__init__` are actually 
+            'magic' functions in Python. 
+            These functions are super useful and are used to control the behavior of the class. 
+            To know more, refer to this link: https://rszalski.github.io/magicmethods/    
+            A lot of these magic functions, if instrumented, can be helpful. For example,
+            arguments to __init__ can be printed to understand how the class is initialized.
+            Also, incepting `__setattr__` can keep track of variable (e.g. weights and gradients) 
+            changes in the class.
+
+        Issue:
+            The problem is that if we are to instrument all the magic functions, the `__repr__` 
+            is leading to some troubles. 
+
+            ```
+            Before calling __repr__
+            Exception in __repr__: maximum recursion depth exceeded
+            Exception in extra_repr: maximum recursion depth exceeded while getting the repr of an object
+            Before calling __repr__
+            Before calling extra_repr
+            ```
+            This is because `__repr__` is called by `extra_repr` and `extra_repr` is called by `__repr__`.
+
+
+        Plan for now:
+            This feature is being delayed for now. The original motivation for tracking the magic functions is to 
+            capture invalid configs when initialting the classes. For example, if a optimizer is intialized with
+            no learnable parameters, it is a sign of a bug. 
+            However, we plan to delay this feature for now. The reasons are two fold:
+            1. In most ML pipelines, the class initialization code are only run once. This means if we want to 
+                infer invariants from these initializations, we need to combine trace from multiple pipelines. I think
+                it is better to just focus on the main training loop for now as these are executed multiple times and 
+                we can infer things from just one pipeline.
+            2. The second reason is these invalid initializations usually have symptoms during the training loop.
+                If the optimizer is not passed with learnable parameters, we will observe that no updates are being performed
+                to the model weights. This is a clear symptom that can be captured during the training loop.
+
+            So for now, we will skip the magic functions.
+        """
 
-            elif inspect.isclass(attr):
-                get_instrumentation_logger_for_process().info(
-                    f"Depth: {depth}, Recursing into class: {typename(attr)}"
-                )
-                if not attr.__module__.startswith(self.root_module):
-                    get_instrumentation_logger_for_process().info(
-                        f"Depth: {depth}, Skipping class {typename(attr)} due to irrelevant module: {attr.__module__}"
+        # if callable(attr):
+        """
+          File "/home/yuxuan/gitrepos/ml-daikon/src/instrumentor/tracer.py", line 243, in _instrument_module
+            if attr in skipped_functions:
+        TypeError: unhashable type: 'instancemethod'
+          File "/home/yuxuan/miniconda3/envs/PyTorch-FORUM84911/lib/python3.10/site-packages/torch/library.py", line 109, in impl
+            elif isinstance(op_name, OpOverload):
+        TypeError: isinstance() arg 2 must be a type, a tuple of types, or a union
+        """
+
+        if not (
+            isinstance(attr, (types.FunctionType, types.BuiltinFunctionType))
+            or isinstance(attr, types.ModuleType)
+            or inspect.isclass(attr)
+        ):
+            instrumentation_report.record(owner_name, "other_type")
+            return 0
+
+        # the qualified name is looked up once, the rules memoize their decision per name
+        name = typename(attr)
+        if self.check_if_to_skip(attr, name):
+            get_instrumentation_logger_for_process().debug(
+                f"Depth: {depth}, Skipping due to the instrumentation rules: {name}"
+            )
+            instrumentation_report.record(owner_name, "rules")
+            return 0
+
+        if isinstance(attr, types.FunctionType) or isinstance(
+            attr, types.BuiltinFunctionType
+        ):
+            # if isinstance(attr
+            try:
+                if attr in skipped_functions:
+                    get_instrumentation_logger_for_process().debug(
+                        f"Depth: {depth}, Skipping function: {name}"
                     )
-                    continue
-                count_wrapped += self._instrument_module(attr, depth + 1)
+                    instrumentation_report.record(owner_name, "skipped_function")
+                    return 0
+            except Exception as e:
+                get_instrumentation_logger_for_process().fatal(
+                    f"Depth: {depth}, Error while checking if function {name} is in skipped_functions: {e}"
+                )
+                instrumentation_report.record(owner_name, "error")
+                return 0
+            get_instrumentation_logger_for_process().debug(
+                f"Instrumenting function: {name}"
+            )
+            if attr in torch_function_overridables:
+                get_instrumentation_logger_for_process().debug(
+                    f"Depth: {depth}, Skipping function traced by the torch function mode: {name}"
+                )
+                instrumentation_report.record(owner_name, "torch_function_mode")
+                return 0
+            if monitoring_backend is not None and monitoring_backend.add_function(
+                attr, get_wrapped_function_id(attr)
+            ):
+                # traced in place, builtins and generators still get a wrapper
+                self.plan_functions.append((path, attr_name, "monitoring"))
+                instrumentation_report.record(owner_name, "wrapped")
+                return 1
+            wrapped = wrapper(attr)
+            try:
+                setattr(pymodule, attr_name, wrapped)
+            except Exception as e:
+                # handling immutable types and attrs that have no setters
+                get_instrumentation_logger_for_process().debug(
+                    f"Depth: {depth}, Skipping function {name} due to error: {e}"
+                )
+                instrumentation_report.record(owner_name, "setattr_error")
+                return 0
+            self.plan_functions.append((path, attr_name, "wrapper"))
+            instrumentation_report.record(owner_name, "wrapped")
+            return 1
+        elif isinstance(attr, types.ModuleType):
+            if attr in skipped_modules:
+                get_instrumentation_logger_for_process().debug(
+                    f"Depth: {depth}, Skipping module: {name}"
+                )
+                instrumentation_report.record(owner_name, "skipped_module")
+                return 0
+            if not name.startswith(
+                self.root_module
+            ):  # TODO: refine the logic of how to rule out irrelevant modules
+                get_instrumentation_logger_for_process().debug(
+                    f"Depth: {depth}, Skipping module due to irrelevant name:{name}"
+                )
+                skipped_modules.add(attr)
+                instrumentation_report.record(owner_name, "irrelevant_module")
+                return 0
 
-        get_instrumentation_logger_for_process().info(
-            f"Depth: {depth}, Wrapped {count_wrapped} functions in module {target_name}"
-        )
-        return count_wrapped
+            get_instrumentation_logger_for_process().debug(
+                f"Depth: {depth}, Recursing into module: {name}"
+            )
+            instrumentation_report.record(owner_name, "visited")
+            return self._instrument_submodule(
+                attr, depth + 1, f"{path}.{attr_name}" if path else attr_name
+            )
+
+        elif inspect.isclass(attr):
+            get_instrumentation_logger_for_process().debug(
+                f"Depth: {depth}, Recursing into class: {name}"
+            )
+            if not attr.__module__.startswith(self.root_module):
+                get_instrumentation_logger_for_process().debug(
+                    f"Depth: {depth}, Skipping class {name} due to irrelevant module: {attr.__module__}"
+                )
+                instrumentation_report.record(owner_name, "irrelevant_class")
+                return 0
+            instrumentation_report.record(owner_name, "visited")
+            return self._instrument_module(
+                attr, depth + 1, f"{path}.{attr_name}" if path else attr_name
+            )
+        return 0
 
 
 class StateVarObserver:
@@ -571,16 +2057,18 @@ class StateVarObserver:
             var = var[0]
         assert isinstance(var, torch.nn.Module), "Currently only supports torch models."
         self.var = var
+        # parameters holding a NaN at the last observation, for the "nan" flight-recorder trigger
+        self.nan_params: set[str] = set()
 
-        timestamp = datetime.datetime.now().timestamp()
+        timestamp = time.monotonic_ns()
         self.current_state = self._get_state_copy()
 
         for param in self.current_state:
             dump_trace_VAR(
                 {
-                    "process_id": os.getpid(),
-                    "thread_id": threading.current_thread().ident,
-                    "meta_vars": meta_vars,
+                    "process_id": process_id,
+                    "thread_id": thread_state.thread_id,
+                    "context_version": meta_vars.version,
                     "type": "state_init",
                     "var_type": param["type"],
                     "var_name": param["name"],
@@ -670,15 +2158,15 @@ class StateVarObserver:
         self.step += 1
         meta_vars.update({"step": self.step})
 
-        timestamp = datetime.datetime.now().timestamp()
+        timestamp = time.monotonic_ns()
 
         state_copy = self._get_state_copy()
         for old_param, new_param in zip(self.current_state, state_copy):
             # three types of changes: value, properties, and both
             msg_dict = {
-                "process_id": os.getpid(),
-                "thread_id": threading.current_thread().ident,
-                "meta_vars": meta_vars,
+                "process_id": process_id,
+                "thread_id": thread_state.thread_id,
+                "context_version": meta_vars.version,
                 "type": "state_change",
                 # "var": self.var.__class__.__name__,
                 "var_type": old_param["type"],  # FIXME: hardcoding the type for now
@@ -704,6 +2192,18 @@ class StateVarObserver:
 
         self.current_state = state_copy
 
+        if flight_recorder is not None and "nan" in flight_recorder_triggers:
+            # the trigger fires when a NaN shows up in a parameter, not again while it stays there
+            nan_params = {
+                name
+                for name, param in self.var.named_parameters()
+                if param.is_floating_point() and bool(torch.isnan(param).any())
+            }
+            new_nan_params = nan_params - self.nan_params
+            self.nan_params = nan_params
+            if new_nan_params:
+                trigger_flight_recorder(f"NaN in {', '.join(sorted(new_nan_params))}")
+
 
 if __name__ == "__main__":
     Instrumentor(torch).instrument()
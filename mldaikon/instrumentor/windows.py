@@ -0,0 +1,88 @@
+"""
+Tracing windows: the steps (and APIs) in which calls are traced.
+
+Without a schedule, every call of an instrumented API is traced. With one, calls are only traced while a
+window is active, outside of the windows a wrapped function only checks a global flag before calling the
+original function. Windows come from:
+    - the schedule configured with TRACING_WINDOWS / ML_DAIKON_TRACING_WINDOWS, a comma-separated list of
+      step ranges: "1000-1010" (both included), "1000" (a single step) or "1000-" (from a step on).
+      An empty list ("") starts with tracing off, for programs that only use the two below.
+    - `tracing_window(steps=..., apis=...)`, active while its block runs (and, if steps are given, while
+      the current step is in them). Without a configured schedule, every call is traced again once the
+      blocks exit.
+    - the TRACING_WINDOW_SIGNAL signal (none by default, e.g. SIGUSR2), which turns tracing on / off at runtime.
+
+A window can be restricted to some APIs with rules like INSTRUMENTATION_INCLUDE (see rules.py), then only
+the calls of the matching APIs are traced in it. The rules match the qualified names of the functions like
+the instrumentation rules do (e.g. `torch.optim.sgd.SGD.step`), torch ops their traced name.
+"""
+
+
+class TracingWindow:
+    def __init__(
+        self,
+        first_step: int | None = None,
+        last_step: int | None = None,
+        apis: list[str] | None = None,
+    ):
+        self.first_step = first_step
+        self.last_step = last_step
+        self.apis = None if apis is None else list(apis)
+
+    def contains(self, step) -> bool:
+        if self.first_step is None and self.last_step is None:
+            return True
+        if type(step) is not int:
+            # the step is not known (yet)
+            return False
+        return (self.first_step is None or step >= self.first_step) and (
+            self.last_step is None or step <= self.last_step
+        )
+
+    def __repr__(self):
+        return f"TracingWindow({self.first_step}, {self.last_step}, apis={self.apis})"
+
+
+def parse_windows(spec: str) -> list[TracingWindow]:
+    """Parse a comma-separated list of step ranges ("1000-1010", "1000", "1000-")."""
+    windows = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, sep, last = part.partition("-")
+        try:
+            first_step = int(first) if first else None
+            last_step = (int(last) if last else None) if sep else first_step
+        except ValueError:
+            raise ValueError(
+                f"Invalid tracing window: {part}, expected a step range like 1000-1010, 1000 or 1000-"
+            )
+        windows.append(TracingWindow(first_step, last_step))
+    return windows
+
+
+class TracingSchedule:
+    def __init__(self, windows: list[TracingWindow], temporary: bool = False):
+        self.windows = list(windows)
+        # created for the `tracing_window` blocks of a program without a schedule, dropped (every call is
+        # traced again) once the last of them exits
+        self.temporary = temporary
+
+    def add(self, window: TracingWindow):
+        self.windows.append(window)
+
+    def remove(self, window: TracingWindow):
+        self.windows.remove(window)
+
+    def active(self, step) -> tuple[bool, tuple[str, ...] | None]:
+        """Whether calls are traced at this step, and the only APIs traced (None: all of them)."""
+        active = False
+        apis: set[str] = set()
+        for window in self.windows:
+            if window.contains(step):
+                if window.apis is None:
+                    return True, None
+                active = True
+                apis.update(window.apis)
+        return active, tuple(sorted(apis)) if active else None
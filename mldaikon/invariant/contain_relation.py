@@ -42,6 +42,7 @@ def events_scanner(trace_df: pl.DataFrame, parent_func_name: str) -> set[str] |
     func_call_id = first_record["func_call_id"]
 
     # get the post-event of the parent_func_name, according to func_call_id
+    # func_call_id is only unique within a process, thus also matching on process_id and thread_id
     post_idx = trace_df.select(
         pl.arg_where(
             (
@@ -51,6 +52,8 @@ def events_scanner(trace_df: pl.DataFrame, parent_func_name: str) -> set[str] |
             )
             & (pl.col("function") == parent_func_name)
             & (pl.col("func_call_id") == func_call_id)
+            & (pl.col("process_id") == process_id)
+            & (pl.col("thread_id") == thread_id)
         )
     ).to_series()
 
@@ -61,15 +64,9 @@ def events_scanner(trace_df: pl.DataFrame, parent_func_name: str) -> set[str] |
         )
         return None
 
-    # This assert no longer holds as we do not use UUIDs for func_call_id
-    # assert (
-    #     num_records == 1
-    # ), "There should be only one post-event for the parent_func_name"
-    post_idx = post_idx[0]  # the first post-event
-    post_event = trace_df.row(index=post_idx, named=True)
-    assert (
-        post_event["process_id"] == process_id and post_event["thread_id"] == thread_id
-    ), "The post-event of the parent_func_name should be on the same thread and process"
+    # traces recorded before func_call_id became unique per process can still have collisions,
+    # in which case the first post-event is taken
+    post_idx = post_idx[0]
 
     # get the events that happened within the pre and post events of the parent_func_name
     func_names = (
@@ -91,6 +88,50 @@ def events_scanner(trace_df: pl.DataFrame, parent_func_name: str) -> set[str] |
     return set(func_names)
 
 
+def collect_contained_functions(trace_df: pl.DataFrame) -> dict[tuple, set[str]]:
+    """Return, for every call in the trace, the set of function names called within it.
+
+    The calls are keyed by (process_id, func_call_id). Instead of scanning forward for the post-event
+    of every call, the events of every thread are paired in a single pass, with a stack of the calls of
+    the thread that are still open: when a call ends, its set is merged into the call below it on the
+    stack. A call thus contains every call made between its pre and post events on the same thread, even
+    when the calls in between were not traced (sampling policies, call depth limit, tracing windows).
+
+    Same as `events_scanner`, the set of a call also contains the function of the call itself, and calls
+    made by other threads or processes while it runs are not contained in it.
+    """
+    events = trace_df.filter(
+        pl.col("type").is_in(
+            [
+                "function_call (pre)",
+                "function_call (post)",
+                "function_call (post) (exception)",
+            ]
+        )
+    ).select("process_id", "thread_id", "func_call_id", "type", "function")
+    contained: dict[tuple, set[str]] = {}
+    # (process_id, thread_id) -> keys of the open calls of the thread, innermost last
+    open_calls: dict[tuple, list[tuple]] = {}
+    for process_id, thread_id, func_call_id, event_type, function in events.iter_rows():
+        stack = open_calls.setdefault((process_id, thread_id), [])
+        call = (process_id, func_call_id)
+        if event_type == "function_call (pre)":
+            contained[call] = {function}
+            stack.append(call)
+            continue
+        if call not in stack:
+            # the pre-event of the call is not in the trace
+            continue
+        # calls above it on the stack have no post-event, they end with it
+        while True:
+            ended = stack.pop()
+            if stack:
+                contained[stack[-1]].update(contained[ended])
+            if ended == call:
+                break
+    return contained
+
+
 class APIContainRelation(Relation):
     """Relation that checks if the API contain relation holds.
     In the API contain relation, an parent API call will always contain the child API call.
@@ -111,6 +152,20 @@ class APIContainRelation(Relation):
             trace.events.select("function").drop_nulls().unique().to_series().to_list()
         )
 
+        # traces that record the parent of each call have unique func_call_ids per process and are paired
+        # in a single pass, older traces fall back to scanning for the post-event of each call
+        contained_functions = None
+        if "parent_call_id" in trace.events.columns:
+            contained_functions = collect_contained_functions(trace.events)
+
+        # with a sampling policy, only part of the calls of an API are in the trace
+        call_counts: dict[str, int] = {}
+        if trace.call_counts is not None:
+            call_counts = dict(
+                trace.call_counts.select("function", "num_calls").iter_rows()
+            )
+        coverage: dict[str, str] = {}
+
         for parent in func_names:
             logger.debug(f"Starting the analysis for the parent function: {parent}")
             # get all parent pre event indexes
@@ -123,12 +178,24 @@ class APIContainRelation(Relation):
             logger.debug(
                 f"Found {len(parent_pre_idx)} invocations for the function: {parent}"
             )
+            if parent in call_counts:
+                coverage[parent] = f"{len(parent_pre_idx)}/{call_counts[parent]}"
+                logger.debug(f"{coverage[parent]} invocations of {parent} were traced")
             all_child_func_names: list[set[str]] = []
             for idx in parent_pre_idx:
                 # get all child post events
-                child_func_names = events_scanner(
-                    trace_df=trace.events.slice(idx, None), parent_func_name=parent
-                )
+                if contained_functions is not None:
+                    parent_pre_event = trace.events.row(index=idx, named=True)
+                    child_func_names = contained_functions[
+                        (
+                            parent_pre_event["process_id"],
+                            parent_pre_event["func_call_id"],
+                        )
+                    ]
+                else:
+                    child_func_names = events_scanner(
+                        trace_df=trace.events.slice(idx, None), parent_func_name=parent
+                    )
                 if child_func_names is None:
                     raise ValueError(
                         "The events_scanner should return a set of function names during inference."
@@ -183,7 +250,10 @@ class APIContainRelation(Relation):
         for p, child_hypotheses in hypothesis.items():
             for k, h in child_hypotheses.items():
                 all_invariants.append(h.invariant)
-                all_hypotheses.append((h, f"{p} contains {k}"))
+                desc = f"{p} contains {k}"
+                if p in coverage:
+                    desc += f" (traced invocations: {coverage[p]})"
+                all_hypotheses.append((h, desc))
 
         # sort the hypotheses for debugging purposes
         all_hypotheses.sort(key=lambda h: len(h[0].positive_examples), reverse=True)
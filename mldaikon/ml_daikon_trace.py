@@ -1,7 +1,14 @@
+import glob
+import io
+import json
 import logging
+import os
+import re
 
 import polars as pl
 
+from mldaikon.instrumentor.trace_writer import CHUNKED_TRACE_EXT, read_chunked_trace
+
 logger = logging.getLogger(__name__)
 
 # TODO: formalize the trace schema for efficient polars processing
@@ -39,6 +46,9 @@ def unnest_all(df: pl.DataFrame, separator=".") -> pl.DataFrame:
 class Trace:
     def __init__(self, events: pl.DataFrame | list[pl.DataFrame] | list[dict]):
         self.events = events
+        # exact number of calls per function (columns: function, num_calls), only known when the trace
+        # was collected with a sampling policy or a call depth limit, in which case not every call is in the events
+        self.call_counts: pl.DataFrame | None = None
 
         if isinstance(events, list) and all(
             [isinstance(e, pl.DataFrame) for e in events]
@@ -52,8 +62,10 @@ class Trace:
             self.events, pl.DataFrame
         ), "events should be a DataFrame, list of DataFrames, or a list of dictionaries."
 
+        # `time` is a monotonic timestamp in ns, `seq` orders the events of a thread that have the same timestamp
+        sort_by = ["time", "seq"] if "seq" in self.events.columns else ["time"]
         try:
-            self.events = self.events.sort("time", descending=False)
+            self.events = self.events.sort(sort_by, descending=False)
         except pl.PolarsError:
             raise ValueError(
                 "Failed to sort the events by time. Check if the time column is present in the events."
@@ -117,12 +129,367 @@ class Trace:
         return groups
 
 
-def read_trace_file(file_path: str | list[str]) -> Trace:
-    """Reads the trace file and returns the trace instance."""
-    if isinstance(file_path, list):
-        events = pl.concat(
-            [pl.read_ndjson(f) for f in file_path], how="diagonal_relaxed"
+def _read_events(
+    file_path: str,
+    time_range: tuple | None = None,
+    step_range: tuple | None = None,
+) -> pl.DataFrame:
+    """Reads a single trace file, the format is decided by the file extension.
+
+    `.arrows` (Arrow IPC stream) and `.parquet` files are written by the columnar trace writer,
+    `.chunks` files by the compressed chunked writer (chunks outside time_range / step_range are skipped),
+    anything else is treated as an NDJSON trace log.
+    """
+    if file_path.endswith(".parquet"):
+        return pl.read_parquet(file_path)
+    if file_path.endswith(".arrows"):
+        return _read_arrow_stream(file_path)
+    if file_path.endswith(CHUNKED_TRACE_EXT):
+        content = read_chunked_trace(file_path, time_range, step_range)
+        if not content:
+            return pl.DataFrame()
+        return pl.read_ndjson(io.BytesIO(content), infer_schema_length=None)
+    # events of different types carry different fields (e.g. `exception` only in the exception events),
+    # the schema has to be inferred from all of them
+    return pl.read_ndjson(file_path, infer_schema_length=None)
+
+
+def _read_arrow_stream(file_path: str) -> pl.DataFrame:
+    """Reads an Arrow IPC stream. A truncated last block (e.g. the process was killed while writing it)
+    is ignored."""
+    try:
+        return pl.read_ipc_stream(file_path)
+    except OSError:
+        import pyarrow as pa
+
+        batches = []
+        with pa.ipc.open_stream(file_path) as reader:
+            try:
+                for batch in reader:
+                    batches.append(batch)
+            except (OSError, pa.ArrowInvalid):
+                logger.warning(f"Ignoring the truncated last block of {file_path}")
+            table = pa.Table.from_batches(batches, schema=reader.schema)
+        return pl.from_arrow(table)
+
+
+def _find_run_files(file_paths: list[str], kind: str) -> list[str]:
+    """Find the side files (e.g. `functions` symbol tables, `context` files) written by the runs
+    the given trace files belong to."""
+    run_files = set()
+    for file_path in file_paths:
+        match = re.match(
+            r"(.*)_mldaikon_(?:trace_API|trace_VAR|api_stats)_(\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})_",
+            file_path,
+        )
+        if match is None:
+            continue
+        script_prefix, exp_start_time = match.groups()
+        run_files.update(
+            glob.glob(f"{script_prefix}_mldaikon_{kind}_{exp_start_time}_*.log")
+        )
+    return sorted(run_files)
+
+
+def _read_symbol_tables(file_paths: list[str]) -> pl.DataFrame | None:
+    symbol_tables = _find_run_files(file_paths, "functions")
+    if len(symbol_tables) == 0:
+        return None
+    return pl.concat([pl.read_ndjson(f) for f in symbol_tables]).unique(
+        subset=["process_id", "function_id"]
+    )
+
+
+def _resolve_function_names(events: pl.DataFrame, file_paths: list[str]):
+    """API events only carry the integer function ID, join the qualified names back from the symbol tables."""
+    if "function_id" not in events.columns or "function" in events.columns:
+        return events
+    symbols = _read_symbol_tables(file_paths)
+    if symbols is None:
+        logger.warning(
+            "No function symbol table found for the trace, the function names cannot be resolved."
+        )
+        return events
+    return events.join(symbols, on=["process_id", "function_id"], how="left")
+
+
+def _resolve_tracebacks(events: pl.DataFrame, file_paths: list[str]):
+    """Exception events only carry the hash of their traceback, join the text back from the traceback tables."""
+    if "traceback_hash" not in events.columns or "traceback" in events.columns:
+        return events
+    traceback_tables = _find_run_files(file_paths, "tracebacks")
+    if len(traceback_tables) == 0:
+        logger.warning(
+            "No traceback table found for the trace, the tracebacks cannot be resolved."
+        )
+        return events
+    # the hash only depends on the traceback, so the tables of all processes can be merged
+    tracebacks = (
+        pl.concat([pl.read_ndjson(f) for f in traceback_tables])
+        .unique(subset=["traceback_hash"])
+        .select("traceback_hash", "traceback")
+    )
+    return events.join(tracebacks, on="traceback_hash", how="left")
+
+
+def _read_call_counts(file_paths: list[str]) -> pl.DataFrame | None:
+    """Exact number of calls per function, written by the tracer when a sampling policy or a call depth limit is used."""
+    call_counts_files = _find_run_files(file_paths, "call_counts")
+    symbols = _read_symbol_tables(file_paths)
+    if len(call_counts_files) == 0 or symbols is None:
+        return None
+    return (
+        pl.concat([pl.read_ndjson(f) for f in call_counts_files])
+        .join(symbols, on=["process_id", "function_id"], how="left")
+        .group_by("function")
+        .agg(pl.col("num_calls").sum())
+    )
+
+
+def _resolve_meta_vars(events: pl.DataFrame, file_paths: list[str]):
+    """Events only carry the version of meta_vars, rebuild the values of the versions the events refer to
+    from the context change records and join them back as `meta_vars.*` columns."""
+    if "context_version" not in events.columns:
+        return events
+    context_files = _find_run_files(file_paths, "context")
+    if len(context_files) == 0:
+        logger.warning(
+            "No context file found for the trace, meta_vars cannot be resolved."
+        )
+        return events
+
+    records = []
+    for context_file in context_files:
+        with open(context_file, "r") as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    records.sort(key=lambda r: (r["process_id"], r["context_version"]))
+
+    # the values are only materialized for the versions some event was traced at, not for every change
+    used_versions = set(
+        events.select("process_id", "context_version").unique().iter_rows()
+    )
+    contexts = []
+    current: dict = {}
+    current_pid = None
+    for record in records:
+        if record["process_id"] != current_pid:
+            current_pid = record["process_id"]
+            current = {}
+        current.update(record["meta_vars"])
+        if (record["process_id"], record["context_version"]) in used_versions:
+            contexts.append(
+                {
+                    "process_id": record["process_id"],
+                    "context_version": record["context_version"],
+                    **{
+                        f"meta_vars.{k}": v for k, v in current.items() if v is not None
+                    },
+                }
+            )
+    context_df = pl.DataFrame(contexts, infer_schema_length=None)
+    if context_df.width <= 2:
+        # meta_vars was never set
+        return events
+    return events.join(context_df, on=["process_id", "context_version"], how="left")
+
+
+def _resolve_wall_time(events: pl.DataFrame, file_paths: list[str]):
+    """Rebuild the wall clock time of the events (`wall_time` column) from the monotonic `time` and the
+    (monotonic, wall clock) anchor of their process."""
+    if "time" not in events.columns or not events.schema["time"].is_integer():
+        # older traces already carry a unix timestamp in `time`
+        return events
+    clock_files = _find_run_files(file_paths, "clock")
+    if len(clock_files) == 0:
+        logger.warning(
+            "No clock anchor found for the trace, the wall time cannot be rebuilt."
         )
-    else:
-        events = pl.read_ndjson(file_path)
-    return Trace(unnest_all(events))
+        return events
+    anchors = pl.concat([pl.read_ndjson(f) for f in clock_files]).unique(
+        subset=["process_id"]
+    )
+    return (
+        events.join(anchors, on="process_id", how="left")
+        .with_columns(
+            (pl.col("wall_ns") + pl.col("time") - pl.col("monotonic_ns"))
+            .cast(pl.Datetime("ns"))
+            .alias("wall_time")
+        )
+        .drop(["wall_ns", "monotonic_ns"])
+    )
+
+
+def read_trace_manifest(manifest_path: str) -> pl.DataFrame:
+    """Reads the manifest of a run: one row per trace segment with its kind, process_id, segment number,
+    paths, complete, num_events, num_bytes, time_range and step_range ([min, max] or null).
+
+    A segment whose process died before closing it is not `complete`: it has no counts or ranges, and its
+    paths are the files found on disk for it. The paths are made relative to the current directory.
+    """
+    manifest_dir = os.path.dirname(manifest_path)
+    segments = {}
+    with open(manifest_path, "r") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                # the record appended when the segment is closed replaces the one of its opening
+                segments[(record["kind"], record["process_id"], record["segment"])] = (
+                    record
+                )
+    records = list(segments.values())
+    for record in records:
+        record["paths"] = [os.path.join(manifest_dir, p) for p in record["paths"]]
+        if not record.get("complete", True):
+            record["paths"] = _find_open_segment_files(record["paths"])
+    return pl.DataFrame(records, infer_schema_length=None)
+
+
+def _find_open_segment_files(paths: list[str]) -> list[str]:
+    """Files of a segment that was not closed. The columnar writers may have started more parts since the
+    segment was opened, and converted the closed parts to parquet, so the parts are looked up on disk.
+    """
+    found = []
+    for path in paths:
+        match = re.fullmatch(r"(.*)_0\.arrows", path)
+        if match is None:
+            if os.path.exists(path):
+                found.append(path)
+            continue
+        parts = {}
+        for part_path in glob.glob(f"{glob.escape(match.group(1))}_*"):
+            part_match = re.fullmatch(
+                re.escape(match.group(1)) + r"_(\d+)\.(arrows|parquet)", part_path
+            )
+            if part_match is None:
+                continue
+            part = int(part_match.group(1))
+            # a part that was being converted is complete in both files, the parquet one is kept
+            if part not in parts or part_match.group(2) == "parquet":
+                parts[part] = part_path
+        found.extend(parts[part] for part in sorted(parts))
+    return found
+
+
+def _overlaps(value_range: list | None, query_range: tuple | None) -> bool:
+    if value_range is None or query_range is None:
+        return True
+    low, high = query_range
+    return (high is None or value_range[0] <= high) and (
+        low is None or value_range[1] >= low
+    )
+
+
+def _expand_manifests(
+    file_paths: list[str], time_range: tuple | None, step_range: tuple | None
+) -> list[str]:
+    """Replace the run manifests in file_paths by the trace segments they list that overlap the ranges."""
+    expanded = []
+    for file_path in file_paths:
+        if "_mldaikon_manifest_" not in os.path.basename(file_path):
+            expanded.append(file_path)
+            continue
+        for segment in read_trace_manifest(file_path).iter_rows(named=True):
+            # a segment that was not closed has no ranges, it overlaps any range
+            if _overlaps(segment.get("time_range"), time_range) and _overlaps(
+                segment.get("step_range"), step_range
+            ):
+                expanded.extend(segment["paths"])
+    return expanded
+
+
+def _filter_range(events: pl.DataFrame, column: str, value_range: tuple | None):
+    if value_range is None or column not in events.columns:
+        return events
+    low, high = value_range
+    if low is not None:
+        events = events.filter(pl.col(column) >= low)
+    if high is not None:
+        events = events.filter(pl.col(column) <= high)
+    return events
+
+
+def read_trace_file(
+    file_path: str | list[str],
+    wall_time: bool = False,
+    time_range: tuple | None = None,
+    step_range: tuple | None = None,
+) -> Trace:
+    """Reads the trace file and returns the trace instance.
+
+    `time` is a monotonic timestamp in ns, with `wall_time` a `wall_time` datetime column is rebuilt from
+    the clock anchors of the processes.
+    `time_range` and `step_range` are inclusive (low, high) bounds (None for unbounded) on `time` and
+    `meta_vars.step`, the chunks of compressed traces that are out of range are not decompressed.
+    A run manifest (`*_mldaikon_manifest_*.log`) can be given instead of the trace files, only the
+    segments that overlap the ranges are then read.
+    """
+    file_paths = file_path if isinstance(file_path, list) else [file_path]
+    file_paths = _expand_manifests(file_paths, time_range, step_range)
+    # unnest each file first, columnar files are already flat while NDJSON files are nested
+    events = pl.concat(
+        [unnest_all(_read_events(f, time_range, step_range)) for f in file_paths],
+        how="diagonal_relaxed",
+    )
+    events = _resolve_function_names(events, file_paths)
+    events = _resolve_tracebacks(events, file_paths)
+    events = _resolve_meta_vars(events, file_paths)
+    events = _filter_range(events, "time", time_range)
+    events = _filter_range(events, "meta_vars.step", step_range)
+    if wall_time:
+        events = _resolve_wall_time(events, file_paths)
+    trace = Trace(events)
+    trace.call_counts = _read_call_counts(file_paths)
+    return trace
+
+
+def read_api_stats(file_path: str | list[str]) -> pl.DataFrame:
+    """Reads the statistics written by the "stats" tracing mode.
+
+    The dumps of all processes are summed up per (function, parent_function, step). `histogram[i]` is
+    the number of calls that took [2^(i-1), 2^i) nanoseconds.
+    """
+    file_paths = file_path if isinstance(file_path, list) else [file_path]
+    names: dict[tuple, str] = {}
+    symbols = _read_symbol_tables(file_paths)
+    if symbols is not None:
+        for process_id, function_id, function in symbols.select(
+            "process_id", "function_id", "function"
+        ).iter_rows():
+            names[(process_id, function_id)] = function
+
+    stats: dict[tuple, dict] = {}
+    for stats_file in file_paths:
+        with open(stats_file, "r") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                pid = record["process_id"]
+                function = names.get((pid, record["function_id"]))
+                parent_function = names.get((pid, record["parent_function_id"]))
+                key = (function, parent_function, record["step"])
+                if key not in stats:
+                    stats[key] = {
+                        "function": function,
+                        "parent_function": parent_function,
+                        "step": record["step"],
+                        "num_calls": 0,
+                        "num_exceptions": 0,
+                        "total_ns": 0,
+                        "min_ns": record["min_ns"],
+                        "max_ns": record["max_ns"],
+                        "histogram": [],
+                    }
+                entry = stats[key]
+                entry["num_calls"] += record["num_calls"]
+                entry["num_exceptions"] += record["num_exceptions"]
+                entry["total_ns"] += record["total_ns"]
+                entry["min_ns"] = min(entry["min_ns"], record["min_ns"])
+                entry["max_ns"] = max(entry["max_ns"], record["max_ns"])
+                histogram = entry["histogram"]
+                if len(record["histogram"]) > len(histogram):
+                    histogram.extend([0] * (len(record["histogram"]) - len(histogram)))
+                for bucket, count in enumerate(record["histogram"]):
+                    histogram[bucket] += count
+
+    return pl.DataFrame(list(stats.values()), infer_schema_length=None)
@@ -16,4 +16,8 @@ setup(
         "tqdm",
         "deepdiff",
     ],
+    extras_require={
+        "columnar": ["pyarrow"],
+        "compression": ["zstandard", "lz4"],
+    },
 )
@@ -0,0 +1,125 @@
+import glob
+import json
+import os
+import subprocess
+import sys
+import textwrap
+import threading
+
+import pytest
+
+from mldaikon.instrumentor.async_writer import AsyncTraceWriter
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+
+
+def test_events_are_written_in_order():
+    written = []
+    writer = AsyncTraceWriter(8, "block", 1, 0.01)
+    for t in range(100):
+        writer.push((lambda trace, level: written.append(trace), t, None))
+    writer.close()
+    assert written == list(range(100))
+    assert writer.num_dropped == 0
+
+
+def _blocked_writer(policy: str, sample_every: int = 1):
+    """A writer whose thread is stuck writing the first event until the gate is set."""
+    gate = threading.Event()
+    started = threading.Event()
+    written = []
+
+    def write(trace, level):
+        if trace == 0:
+            started.set()
+            gate.wait()
+        written.append(trace)
+
+    writer = AsyncTraceWriter(2, policy, sample_every, 0.01)
+    writer.push((write, 0, None))
+    assert started.wait(5)
+    return writer, write, gate, written
+
+
+def test_drop_policy_drops_events_when_full():
+    writer, write, gate, written = _blocked_writer("drop")
+    for t in range(1, 6):
+        writer.push((write, t, None))
+    gate.set()
+    writer.close()
+    assert written == [0, 1, 2]
+    assert writer.num_dropped == 3
+
+
+def test_sample_policy_keeps_one_in_n_events_when_full():
+    writer, write, gate, written = _blocked_writer("sample", 2)
+    for t in range(1, 5):
+        # 1 and 2 fit in the ring, 3 is dropped and 4 waits for room
+        if t == 4:
+            threading.Timer(0.1, gate.set).start()
+        writer.push((write, t, None))
+    writer.close()
+    assert written == [0, 1, 2, 4]
+    assert writer.num_dropped == 1
+
+
+def test_unknown_policy_is_rejected():
+    with pytest.raises(ValueError):
+        AsyncTraceWriter(2, "spill", 1, 0.01)
+
+
+def test_wake_drains_before_the_flush_interval():
+    written = threading.Event()
+    writer = AsyncTraceWriter(8, "block", 1, 60)
+    writer.push((lambda trace, level: written.set(), 0, None))
+    writer.wake()
+    assert written.wait(5)
+    writer.close()
+
+
+TRACED_MODULE = """
+def fail():
+    raise RuntimeError("boom")
+"""
+
+SCRIPT = """
+import os
+import sys
+
+os.environ["MAIN_SCRIPT_NAME"] = "run"
+import asyncmod
+from mldaikon.instrumentor.tracer import Instrumentor
+
+tracer_excepthook = sys.excepthook
+
+
+def excepthook(*exc_info):
+    tracer_excepthook(*exc_info)
+    # leave without running atexit, like the programs that hard-exit on errors
+    os._exit(1)
+
+
+sys.excepthook = excepthook
+Instrumentor(asyncmod).instrument()
+for _ in range(3):
+    try:
+        asyncmod.fail()
+    except RuntimeError:
+        pass
+asyncmod.fail()
+"""
+
+
+def test_uncaught_exception_writes_the_pending_events(tmp_path):
+    (tmp_path / "asyncmod.py").write_text(textwrap.dedent(TRACED_MODULE))
+    (tmp_path / "run.py").write_text(textwrap.dedent(SCRIPT))
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join([PACKAGE_ROOT, str(tmp_path)]),
+        ML_DAIKON_ASYNC_TRACE="1",
+    )
+    result = subprocess.run([sys.executable, "run.py"], cwd=tmp_path, env=env)
+    assert result.returncode != 0
+    with open(glob.glob(str(tmp_path / "run_mldaikon_trace_API_*.log"))[0]) as f:
+        types = [json.loads(line)["type"] for line in f]
+    assert types.count("function_call (post) (exception)") == 4
@@ -0,0 +1,89 @@
+import glob
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+
+TRACED_MODULE = """
+def leaf():
+    pass
+
+
+def middle():
+    leaf()
+    leaf()
+
+
+def outer():
+    middle()
+    leaf()
+"""
+
+SCRIPT = """
+import os
+
+os.environ["MAIN_SCRIPT_NAME"] = "run"
+import depthmod
+from mldaikon.instrumentor.tracer import Instrumentor
+
+Instrumentor(depthmod).instrument()
+for _ in range(2):
+    depthmod.outer()
+"""
+
+
+def _read_trace(tmp_path, **env_vars):
+    pytest.importorskip("polars")
+    from mldaikon.ml_daikon_trace import read_trace_file
+
+    (tmp_path / "depthmod.py").write_text(textwrap.dedent(TRACED_MODULE))
+    (tmp_path / "run.py").write_text(textwrap.dedent(SCRIPT))
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join([PACKAGE_ROOT, str(tmp_path)]),
+        **env_vars,
+    )
+    subprocess.run([sys.executable, "run.py"], cwd=tmp_path, env=env, check=True)
+    return read_trace_file(glob.glob(str(tmp_path / "run_mldaikon_trace_API_*.log")))
+
+
+def _traced_calls(trace) -> dict[str, int]:
+    calls = trace.events.filter(trace.events["type"] == "function_call (pre)")
+    return dict(calls["function"].value_counts().iter_rows())
+
+
+def _call_counts(trace) -> dict[str, int]:
+    return dict(trace.call_counts.select("function", "num_calls").iter_rows())
+
+
+ALL_CALLS = {"depthmod.outer": 2, "depthmod.middle": 2, "depthmod.leaf": 6}
+
+
+def test_all_calls_are_traced_by_default(tmp_path):
+    trace = _read_trace(tmp_path)
+    assert _traced_calls(trace) == ALL_CALLS
+    # the calls are only counted when some of them are not traced
+    assert trace.call_counts is None
+
+
+def test_outermost_calls(tmp_path):
+    trace = _read_trace(tmp_path, ML_DAIKON_CALL_DEPTH_MODE="outermost")
+    assert _traced_calls(trace) == {"depthmod.outer": 2}
+    assert _call_counts(trace) == ALL_CALLS
+
+
+def test_max_depth(tmp_path):
+    trace = _read_trace(
+        tmp_path, ML_DAIKON_CALL_DEPTH_MODE="max_depth", ML_DAIKON_MAX_CALL_DEPTH="1"
+    )
+    # the leaf calls of outer are at depth 1, the ones of middle at depth 2
+    assert _traced_calls(trace) == {
+        "depthmod.outer": 2,
+        "depthmod.middle": 2,
+        "depthmod.leaf": 2,
+    }
+    assert _call_counts(trace) == ALL_CALLS
@@ -0,0 +1,60 @@
+import json
+
+import pytest
+
+from mldaikon.instrumentor.trace_writer import (
+    ChunkedTraceWriter,
+    read_chunk_headers,
+    read_chunked_trace,
+)
+
+
+def _times(content: bytes) -> list[int]:
+    return [json.loads(line)["time"] for line in content.decode().splitlines()]
+
+
+def _write(path: str, codec: str, num_events: int) -> ChunkedTraceWriter:
+    # the context version of the events is their step
+    writer = ChunkedTraceWriter(path, codec, 4, lambda low, high: (low, high))
+    for t in range(num_events):
+        writer.write({"type": "function_call (pre)", "time": t, "context_version": t})
+    writer.close()
+    return writer
+
+
+@pytest.mark.parametrize("codec", ["zstd", "lz4"])
+def test_chunked_trace_round_trip(tmp_path, codec):
+    pytest.importorskip("zstandard" if codec == "zstd" else "lz4")
+    path = str(tmp_path / "trace.chunks")
+    _write(path, codec, 10)
+
+    read_codec, chunks = read_chunk_headers(path)
+    assert read_codec == codec
+    assert [chunk["num_events"] for chunk in chunks] == [4, 4, 2]
+    assert [chunk["time_range"] for chunk in chunks] == [(0, 3), (4, 7), (8, 9)]
+    assert [chunk["step_range"] for chunk in chunks] == [(0, 3), (4, 7), (8, 9)]
+    assert _times(read_chunked_trace(path)) == list(range(10))
+
+
+def test_chunks_out_of_range_are_skipped(tmp_path):
+    pytest.importorskip("zstandard")
+    path = str(tmp_path / "trace.chunks")
+    _write(path, "zstd", 10)
+    assert _times(read_chunked_trace(path, time_range=(5, 6))) == [4, 5, 6, 7]
+    assert _times(read_chunked_trace(path, step_range=(None, 3))) == [0, 1, 2, 3]
+
+
+def test_truncated_last_chunk_is_ignored(tmp_path):
+    pytest.importorskip("zstandard")
+    path = str(tmp_path / "trace.chunks")
+    writer = _write(path, "zstd", 10)
+    with open(path, "r+b") as f:
+        f.truncate(writer.num_bytes() - 1)
+    assert _times(read_chunked_trace(path)) == list(range(8))
+
+
+def test_not_a_chunked_trace(tmp_path):
+    path = tmp_path / "trace.log"
+    path.write_text('{"time": 0}\n')
+    with pytest.raises(ValueError):
+        read_chunk_headers(str(path))
@@ -0,0 +1,133 @@
+import json
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from mldaikon.instrumentor import collector
+from mldaikon.instrumentor.collector import CollectorTraceSink, TraceCollector
+
+
+def _event(t: int) -> dict:
+    return {"type": "function_call (pre)", "function_id": 0, "time": t, "seq": t}
+
+
+def test_collector_merges_events_of_all_processes(tmp_path):
+    pl = pytest.importorskip("polars")
+    pytest.importorskip("pyarrow")
+    socket_path = str(tmp_path / "collector.sock")
+    trace_collector = TraceCollector(socket_path, "parquet", 16, 1000, 60)
+    server = threading.Thread(target=trace_collector.serve)
+    server.start()
+    while not os.path.exists(socket_path):
+        pass
+
+    file_base = str(tmp_path / "run_trace_API")
+    sinks = [
+        CollectorTraceSink(socket_path, "trace_API", file_base, 2, 60) for _ in range(2)
+    ]
+    for t in range(10):
+        sinks[t % 2].write(_event(t))
+    for sink in sinks:
+        sink.close()
+    trace_collector.stop()
+    server.join(timeout=10)
+
+    events = pl.read_parquet(f"{file_base}_collected_0.parquet")
+    assert events["time"].to_list() == list(range(10))
+    assert {"rank", "worker_id"} <= set(events.columns)
+
+
+def test_silent_connections_do_not_hold_the_merge_back(tmp_path):
+    pytest.importorskip("pyarrow")
+    socket_path = str(tmp_path / "collector.sock")
+    trace_collector = TraceCollector(socket_path, "parquet", 16, 1000, 0.5)
+    server = threading.Thread(target=trace_collector.serve)
+    server.start()
+    while not os.path.exists(socket_path):
+        pass
+
+    file_base = str(tmp_path / "run_trace_API")
+    silent = CollectorTraceSink(socket_path, "trace_API", file_base, 1, 60)
+    silent.write(_event(0))
+    busy = CollectorTraceSink(socket_path, "trace_API", file_base, 1, 60)
+    for t in range(1, 5):
+        busy.write(_event(t))
+    # events 1-4 wait for the silent connection until its watermark expires
+    deadline = time.monotonic() + 10
+    while trace_collector._num_pending and time.monotonic() < deadline:
+        time.sleep(0.05)
+    num_pending = trace_collector._num_pending
+
+    silent.close()
+    busy.close()
+    trace_collector.stop()
+    server.join(timeout=10)
+    assert num_pending == 0
+
+
+def _listen(socket_path: str) -> socket.socket:
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen()
+    return server
+
+
+def test_sink_does_not_reenter_itself(tmp_path):
+    server = _listen(str(tmp_path / "collector.sock"))
+    sink = CollectorTraceSink(
+        str(tmp_path / "collector.sock"), "trace_API", str(tmp_path / "t"), 1, 60
+    )
+
+    # traced code called while the sink sends a batch records an event, which must not deadlock the sink
+    class TracedSocket:
+        def __init__(self, sock):
+            self.sock = sock
+
+        def sendall(self, data):
+            sink.write(_event(-1))
+            return self.sock.sendall(data)
+
+        def close(self):
+            self.sock.close()
+
+    sink._socket = TracedSocket(sink._socket)
+    writer = threading.Thread(target=sink.write, args=(_event(0),))
+    writer.start()
+    writer.join(timeout=5)
+    assert not writer.is_alive()
+    sink.close()
+    server.close()
+
+
+def test_worker_id_is_read_without_calling_traced_code(monkeypatch):
+    torch_data = pytest.importorskip("torch.utils.data")
+
+    def get_worker_info():
+        raise AssertionError("get_worker_info may be instrumented")
+
+    monkeypatch.setattr(torch_data, "get_worker_info", get_worker_info)
+    assert collector._get_worker_id() is None
+
+
+def test_sink_falls_back_to_a_local_file_without_the_collector(tmp_path):
+    socket_path = str(tmp_path / "collector.sock")
+    server = _listen(socket_path)
+    file_base = str(tmp_path / "run_trace_API")
+    sink = CollectorTraceSink(socket_path, "trace_API", file_base, 1, 60)
+    connection, _ = server.accept()
+    connection.close()
+    server.close()
+
+    # the events are not lost and no error reaches the traced program
+    for t in range(5):
+        sink.write(_event(t))
+    sink.close()
+
+    with open(f"{file_base}.log") as f:
+        times = [json.loads(line)["time"] for line in f]
+    # the first event may have been sent before the collector was gone
+    assert times[-4:] == [1, 2, 3, 4]
+    assert sink.paths() == [f"{file_base}.log"]
@@ -0,0 +1,93 @@
+import glob
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+from mldaikon.instrumentor.flight_recorder import FlightRecorder
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+
+
+def _record_steps(recorder: FlightRecorder, num_steps: int, events_per_step: int):
+    for step in range(num_steps):
+        for i in range(events_per_step):
+            recorder.record("trace_API", {"step": step, "i": i}, step)
+
+
+def test_only_the_last_steps_are_kept():
+    recorder = FlightRecorder(2, 1 << 20, 3)
+    _record_steps(recorder, 5, 4)
+    recorder.record("trace_VAR", {"step": 4, "i": 0}, 4)
+    assert recorder.steps() == [3, 4]
+
+    events = recorder.drain()
+    api_events = [(e["step"], e["i"]) for kind, e in events if kind == "trace_API"]
+    assert api_events == [(step, i) for step in (3, 4) for i in range(4)]
+    assert [e for kind, e in events if kind == "trace_VAR"] == [{"step": 4, "i": 0}]
+    assert recorder.num_dropped == 0
+    # the ring starts over
+    assert recorder.drain() == []
+
+
+def test_oldest_chunks_are_dropped_above_max_bytes():
+    recorder = FlightRecorder(100, 1, 2)
+    _record_steps(recorder, 1, 6)
+    # every chunk is above max_bytes, only the last one is kept
+    assert [e["i"] for _, e in recorder.drain()] == [4, 5]
+    assert recorder.num_dropped == 4
+
+
+TRACED_MODULE = """
+def train_step(step):
+    if step == 5:
+        raise RuntimeError("diverged")
+"""
+
+SCRIPT = """
+import os
+
+os.environ["MAIN_SCRIPT_NAME"] = "run"
+import flightmod
+from mldaikon.instrumentor.tracer import Instrumentor, meta_vars
+
+Instrumentor(flightmod).instrument()
+for step in range({num_steps}):
+    meta_vars["step"] = step
+    try:
+        flightmod.train_step(step)
+    except RuntimeError:
+        pass
+"""
+
+
+def _run(tmp_path, num_steps: int) -> list[str]:
+    (tmp_path / "flightmod.py").write_text(textwrap.dedent(TRACED_MODULE))
+    (tmp_path / "run.py").write_text(
+        textwrap.dedent(SCRIPT).format(num_steps=num_steps)
+    )
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join([PACKAGE_ROOT, str(tmp_path)]),
+        ML_DAIKON_FLIGHT_RECORDER="1",
+        ML_DAIKON_FLIGHT_RECORDER_STEPS="2",
+        ML_DAIKON_FLIGHT_RECORDER_TRIGGERS="exception",
+    )
+    subprocess.run([sys.executable, "run.py"], cwd=tmp_path, env=env, check=True)
+    return glob.glob(str(tmp_path / "run_mldaikon_trace_API_*.log"))
+
+
+def test_nothing_is_written_without_a_trigger(tmp_path):
+    trace_files = _run(tmp_path, 5)
+    assert all(os.path.getsize(path) == 0 for path in trace_files)
+
+
+def test_an_exception_writes_the_last_steps(tmp_path):
+    pytest.importorskip("polars")
+    from mldaikon.ml_daikon_trace import read_trace_file
+
+    events = read_trace_file(_run(tmp_path, 8)).events
+    assert events["meta_vars.step"].to_list() == [4, 4, 5, 5]
+    assert events["type"].to_list()[-1] == "function_call (post) (exception)"
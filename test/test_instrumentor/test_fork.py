@@ -0,0 +1,81 @@
+import glob
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+
+TRACED_MODULE = """
+import os
+
+
+def child_work():
+    return 1
+
+
+def fork_and_wait():
+    pid = os.fork()
+    if pid == 0:
+        child_work()
+        from mldaikon.instrumentor.tracer import close_trace_writers
+
+        close_trace_writers()
+        os._exit(0)
+    os.waitpid(pid, 0)
+"""
+
+SCRIPT = """
+import os
+
+os.environ["MAIN_SCRIPT_NAME"] = "run"
+import forkmod
+from mldaikon.instrumentor.tracer import Instrumentor
+
+Instrumentor(forkmod).instrument()
+forkmod.fork_and_wait()
+print(os.getpid())
+"""
+
+
+def _read_trace(path: str) -> list[dict]:
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="os.fork is not available")
+def test_child_forked_in_a_traced_call_starts_at_depth_0(tmp_path):
+    (tmp_path / "forkmod.py").write_text(textwrap.dedent(TRACED_MODULE))
+    (tmp_path / "run.py").write_text(textwrap.dedent(SCRIPT))
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join([PACKAGE_ROOT, str(tmp_path)]),
+        ML_DAIKON_CALL_DEPTH_MODE="outermost",
+    )
+    parent_pid = int(
+        subprocess.run(
+            [sys.executable, "run.py"],
+            cwd=tmp_path,
+            env=env,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+    )
+
+    traces = {}
+    for path in glob.glob(str(tmp_path / "run_mldaikon_trace_API_*.log")):
+        events = _read_trace(path)
+        traces[events[0]["process_id"]] = events
+    assert len(traces) == 2
+    child_events = [events for pid, events in traces.items() if pid != parent_pid][0]
+    # the call of the parent the child was forked in is not the parent of the child's own calls
+    assert [event["type"] for event in child_events] == [
+        "function_call (pre)",
+        "function_call (post)",
+    ]
+    assert all(event["call_depth"] == 0 for event in child_events)
+    assert all(event["parent_call_id"] is None for event in child_events)
@@ -0,0 +1,141 @@
+import glob
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+
+
+def _write_modules(root):
+    package = root / "hookpkg"
+    package.mkdir()
+    # ops is imported while hookpkg is still executing
+    (package / "__init__.py").write_text(
+        textwrap.dedent(
+            """
+            from hookpkg import ops
+
+
+            def top(x):
+                return ops.scale(x)
+            """
+        )
+    )
+    (package / "ops.py").write_text("def scale(x):\n    return 2 * x\n")
+    (package / "late.py").write_text("def shift(x):\n    return x + 1\n")
+    (root / "otherpkg.py").write_text("def other(x):\n    return x\n")
+
+
+HOOK_FIRST = """
+from mldaikon.instrumentor.import_hook import install_import_hook
+
+install_import_hook(["hookpkg"])
+import hookpkg
+import hookpkg.late
+import otherpkg
+"""
+
+TWO_PATHS = """
+from mldaikon.instrumentor.import_hook import install_import_hook
+from mldaikon.instrumentor.tracer import Instrumentor
+
+install_import_hook(["hookpkg"])
+import hookpkg
+import hookpkg.late
+import hookpkg.ops
+import otherpkg
+
+Instrumentor(hookpkg).instrument()
+Instrumentor(hookpkg.ops).instrument()
+"""
+
+IMPORTED_FIRST = """
+import hookpkg
+import hookpkg.late
+import otherpkg
+from mldaikon.instrumentor.import_hook import install_import_hook
+
+install_import_hook(["hookpkg"])
+"""
+
+SCRIPT = """
+import json
+import os
+
+os.environ["MAIN_SCRIPT_NAME"] = "run"
+{setup}
+hookpkg.top(1)
+hookpkg.late.shift(1)
+otherpkg.other(1)
+loaders = {{
+    "hookpkg": type(hookpkg.__spec__.loader).__name__,
+    "otherpkg": type(otherpkg.__spec__.loader).__name__,
+}}
+with open("loaders.json", "w") as f:
+    json.dump(loaders, f)
+"""
+
+
+def _run(tmp_path, setup: str) -> tuple[list[tuple[str, str]], list[str], dict]:
+    """Run the script, return the instrumented targets, the traced functions and the loaders of the modules."""
+    _write_modules(tmp_path)
+    (tmp_path / "run.py").write_text(
+        textwrap.dedent(SCRIPT).format(setup=textwrap.dedent(setup))
+    )
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([PACKAGE_ROOT, str(tmp_path)]))
+    subprocess.run([sys.executable, "run.py"], cwd=tmp_path, env=env, check=True)
+    with open(
+        glob.glob(str(tmp_path / "run_mldaikon_instrumentation_report_*.json"))[0]
+    ) as f:
+        targets = [
+            (target["target"], target["method"]) for target in json.load(f)["targets"]
+        ]
+    with open(glob.glob(str(tmp_path / "run_mldaikon_functions_*.log"))[0]) as f:
+        names = {
+            record["function_id"]: record["function"] for record in map(json.loads, f)
+        }
+    with open(glob.glob(str(tmp_path / "run_mldaikon_trace_API_*.log"))[0]) as f:
+        functions = [
+            names[event["function_id"]]
+            for event in map(json.loads, f)
+            if event["type"] == "function_call (pre)"
+        ]
+    with open(tmp_path / "loaders.json") as f:
+        loaders = json.load(f)
+    return targets, functions, loaders
+
+
+def test_submodules_imported_by_their_parent_are_walked_with_it(tmp_path):
+    targets, functions, loaders = _run(tmp_path, HOOK_FIRST)
+    # hookpkg.ops is imported while hookpkg executes, it is covered by the walk of hookpkg
+    assert targets == [("hookpkg", "walk"), ("hookpkg.late", "walk")]
+    # every call is traced once
+    assert functions == ["hookpkg.top", "hookpkg.ops.scale", "hookpkg.late.shift"]
+    assert loaders["hookpkg"] == "_TracingLoader"
+
+
+def test_modules_reached_twice_are_walked_once(tmp_path):
+    targets, functions, _ = _run(tmp_path, TWO_PATHS)
+    assert targets == [
+        ("hookpkg", "walk"),
+        ("hookpkg.late", "walk"),
+        ("hookpkg", "already_instrumented"),
+        ("hookpkg.ops", "already_instrumented"),
+    ]
+    assert functions == ["hookpkg.top", "hookpkg.ops.scale", "hookpkg.late.shift"]
+
+
+def test_modules_imported_before_the_hook_are_instrumented_by_it(tmp_path):
+    targets, functions, loaders = _run(tmp_path, IMPORTED_FIRST)
+    # only the outermost module is walked, its walk covers the imported submodules
+    assert targets == [("hookpkg", "walk")]
+    assert functions == ["hookpkg.top", "hookpkg.ops.scale", "hookpkg.late.shift"]
+    assert loaders["hookpkg"] != "_TracingLoader"
+
+
+def test_other_modules_are_imported_untouched(tmp_path):
+    _, functions, loaders = _run(tmp_path, HOOK_FIRST)
+    assert not any(name.startswith("otherpkg") for name in functions)
+    assert loaders["otherpkg"] != "_TracingLoader"
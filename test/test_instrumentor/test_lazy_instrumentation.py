@@ -0,0 +1,146 @@
+import glob
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+
+
+def _write_package(root):
+    package = root / "lazypkg"
+    package.mkdir()
+    (package / "__init__.py").write_text("from lazypkg import custom, ops\n")
+    (package / "ops.py").write_text(
+        textwrap.dedent(
+            """
+            class Layer:
+                def forward(self, x):
+                    return scale(x)
+
+
+            def scale(x):
+                return 2 * x
+
+
+            def unused(x):
+                return x
+            """
+        )
+    )
+    # a module with its own class, like the torch._ops namespaces
+    (package / "custom.py").write_text(
+        textwrap.dedent(
+            """
+            import sys
+            import types
+
+
+            class CustomModule(types.ModuleType):
+                pass
+
+
+            def double(x):
+                return 2 * x
+
+
+            sys.modules[__name__].__class__ = CustomModule
+            """
+        )
+    )
+
+
+SCRIPT = """
+import json
+import os
+
+os.environ["MAIN_SCRIPT_NAME"] = "run"
+import lazypkg
+from mldaikon.instrumentor.tracer import Instrumentor
+
+Instrumentor(lazypkg).instrument()
+
+
+def is_wrapped(func):
+    return hasattr(func, "__wrapped__")
+
+
+checks = {"package_class": type(lazypkg).__name__}
+ops = lazypkg.ops
+checks["submodule_class"] = type(ops).__name__
+checks["wrapped_before_lookup"] = is_wrapped(vars(ops)["scale"])
+scale = ops.scale
+checks["wrapped_on_lookup"] = is_wrapped(scale)
+checks["cached_in_module"] = vars(ops)["scale"] is scale and ops.scale is scale
+checks["custom_class"] = type(lazypkg.custom).__name__
+checks["custom_wrapped_before_lookup"] = is_wrapped(vars(lazypkg.custom)["double"])
+
+ops.Layer().forward(1)
+ops.scale(2)
+lazypkg.custom.double(3)
+checks["unused_wrapped"] = is_wrapped(vars(ops)["unused"])
+with open("checks.json", "w") as f:
+    json.dump(checks, f)
+"""
+
+
+def _run(tmp_path, mode: str) -> tuple[dict, list[tuple[str, str]]]:
+    """Run the script in the instrumentation mode, return its checks and the (function, type) of the events."""
+    cwd = tmp_path / mode
+    cwd.mkdir()
+    (cwd / "run.py").write_text(textwrap.dedent(SCRIPT))
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join([PACKAGE_ROOT, str(tmp_path)]),
+        ML_DAIKON_INSTRUMENTATION_MODE=mode,
+    )
+    subprocess.run([sys.executable, "run.py"], cwd=cwd, env=env, check=True)
+    with open(cwd / "checks.json") as f:
+        checks = json.load(f)
+    with open(glob.glob(str(cwd / "run_mldaikon_functions_*.log"))[0]) as f:
+        names = {
+            record["function_id"]: record["function"] for record in map(json.loads, f)
+        }
+    with open(glob.glob(str(cwd / "run_mldaikon_trace_API_*.log"))[0]) as f:
+        events = [
+            (names[event["function_id"]], event["type"]) for event in map(json.loads, f)
+        ]
+    return checks, events
+
+
+def test_attributes_are_wrapped_on_their_first_lookup(tmp_path):
+    _write_package(tmp_path)
+    checks, _ = _run(tmp_path, "lazy")
+    assert checks["package_class"] == "LazyInstrumentedModule"
+    # the submodule gets the lazy class when it is looked up on its parent
+    assert checks["submodule_class"] == "LazyInstrumentedModule"
+    assert not checks["wrapped_before_lookup"]
+    assert checks["wrapped_on_lookup"]
+    # the wrapper replaces the function in the module, later lookups return it
+    assert checks["cached_in_module"]
+    assert not checks["unused_wrapped"]
+
+
+def test_modules_with_their_own_class_are_instrumented_eagerly(tmp_path):
+    _write_package(tmp_path)
+    checks, _ = _run(tmp_path, "lazy")
+    assert checks["custom_class"] == "CustomModule"
+    assert checks["custom_wrapped_before_lookup"]
+
+
+def test_lazy_mode_traces_like_the_eager_mode(tmp_path):
+    _write_package(tmp_path)
+    _, eager_events = _run(tmp_path, "eager")
+    _, lazy_events = _run(tmp_path, "lazy")
+    assert lazy_events == eager_events
+    assert [name for name, _ in eager_events] == [
+        "lazypkg.ops.forward",
+        "lazypkg.ops.scale",
+        "lazypkg.ops.scale",
+        "lazypkg.ops.forward",
+        "lazypkg.ops.scale",
+        "lazypkg.ops.scale",
+        "lazypkg.custom.double",
+        "lazypkg.custom.double",
+    ]
@@ -0,0 +1,84 @@
+import sys
+
+import pytest
+
+from mldaikon.instrumentor.monitoring import (
+    HAS_SYS_MONITORING,
+    MonitoringBackend,
+    make_monitoring_backend,
+)
+
+requires_sys_monitoring = pytest.mark.skipif(
+    not HAS_SYS_MONITORING, reason="sys.monitoring requires Python 3.12+"
+)
+
+
+def traced(x, y=1):
+    if x < 0:
+        raise ValueError(x)
+    return x + y
+
+
+def not_traced(x):
+    return traced(x)
+
+
+class Recorder:
+    def __init__(self):
+        self.calls = []
+
+    def begin_call(self, func_id):
+        self.calls.append(("begin", func_id))
+        return func_id
+
+    def end_call(self, call, exception=None, args=None, kwargs=None):
+        self.calls.append(("end", call, type(exception).__name__, args))
+
+
+@pytest.fixture
+def backend():
+    recorder = Recorder()
+    backend = make_monitoring_backend(recorder.begin_call, recorder.end_call)
+    assert backend is not None
+    backend.recorder = recorder
+    yield backend
+    backend.stop()
+
+
+def test_calls_of_registered_functions_are_recorded(backend):
+    assert backend.add_function(traced, 7)
+    # builtins have no code object
+    assert not backend.add_function(len, 8)
+    backend.start()
+    not_traced(1)
+    backend.stop()
+    assert backend.recorder.calls == [("begin", 7), ("end", 7, "NoneType", None)]
+
+
+@requires_sys_monitoring
+def test_unwound_calls_get_the_exception_and_the_arguments(backend):
+    backend.add_function(traced, 7)
+    backend.start()
+    with pytest.raises(ValueError):
+        not_traced(-1)
+    backend.stop()
+    assert backend.recorder.calls == [("begin", 7), ("end", 7, "ValueError", (-1, 1))]
+
+
+@requires_sys_monitoring
+def test_falls_back_to_the_wrapper_backend_if_the_tool_id_is_taken():
+    tool_id = sys.monitoring.PROFILER_ID
+    sys.monitoring.use_tool_id(tool_id, "another profiler")
+    try:
+        assert (
+            make_monitoring_backend(Recorder().begin_call, Recorder().end_call) is None
+        )
+    finally:
+        sys.monitoring.free_tool_id(tool_id)
+
+
+def test_reset_stacks_forgets_the_active_calls(backend):
+    backend.get_stack().append(7)
+    backend.reset_stacks()
+    assert backend.get_stack() == []
+    assert isinstance(backend, MonitoringBackend)
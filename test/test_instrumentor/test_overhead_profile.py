@@ -0,0 +1,153 @@
+import glob
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+from mldaikon.instrumentor.overhead_profile import (
+    InstrumentationProfile,
+    build_exclusion_list,
+    load_exclusion_list,
+)
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+
+
+def _record(function: str, names: list[str], num_calls: int, overhead_ms: int):
+    return {
+        "function": function,
+        "names": names,
+        "num_calls": num_calls,
+        "overhead_ns": overhead_ms * 1_000_000,
+    }
+
+
+def test_to_dict_names_the_wrapped_functions():
+    profile = InstrumentationProfile()
+    profile.record(0, 10)
+    profile.record(0, 30)
+    profile.record(1, 5)
+    # func_id 1 is traced without being wrapped (e.g. by a torch op mode)
+    functions = profile.to_dict(["m.f", "m.g"], {0: {"m.A.f", "m.B.f"}})["functions"]
+    assert functions == [
+        {
+            "function": "m.f",
+            "names": ["m.A.f", "m.B.f"],
+            "num_calls": 2,
+            "overhead_ns": 40,
+        },
+        {"function": "m.g", "names": [], "num_calls": 1, "overhead_ns": 5},
+    ]
+
+
+def test_the_most_expensive_functions_are_excluded_until_the_budget_is_met():
+    # two processes, 1000 ms of run time of which 400 ms of tracing overhead
+    profiles = [
+        {
+            "wall_ns": 500_000_000,
+            "functions": [
+                _record("m.f", ["m.A.f"], 10, 150),
+                _record("m.g", ["m.g"], 10, 30),
+            ],
+        },
+        {
+            "wall_ns": 500_000_000,
+            "functions": [
+                _record("m.f", ["m.B.f"], 10, 150),
+                _record("m.op", [], 10, 50),
+                _record("m.h", ["m.h"], 10, 20),
+            ],
+        },
+    ]
+    # 600 ms without the tracing, 90 ms allowed: f (300 ms) goes, op (50 ms) cannot be excluded, g (30 ms) goes
+    exclusions = build_exclusion_list(profiles, 0.15)
+    assert [entry["function"] for entry in exclusions["excluded"]] == ["m.f", "m.g"]
+    assert exclusions["excluded"][0]["num_calls"] == 20
+    assert exclusions["baseline_ms"] == 600
+    assert exclusions["remaining_overhead_ms"] == 70
+    assert exclusions["exclude"] == [r"re:m\.A\.f$", r"re:m\.B\.f$", r"re:m\.g$"]
+
+    assert build_exclusion_list(profiles, 1.0)["exclude"] == []
+
+
+def test_load_exclusion_list(tmp_path):
+    path = tmp_path / "exclude.json"
+    path.write_text(json.dumps({"budget": 0.1, "exclude": ["re:m\\.g$"]}))
+    assert load_exclusion_list(str(path)) == ["re:m\\.g$"]
+    path.write_text(json.dumps(["torch.fx"]))
+    assert load_exclusion_list(str(path)) == ["torch.fx"]
+
+
+TRACED_MODULE = """
+class Model:
+    def hot(self):
+        pass
+
+
+def cold():
+    pass
+"""
+
+SCRIPT = """
+import os
+
+os.environ["MAIN_SCRIPT_NAME"] = "run"
+import profmod
+from mldaikon.instrumentor.tracer import Instrumentor
+
+Instrumentor(profmod).instrument()
+model = profmod.Model()
+for _ in range(200):
+    model.hot()
+profmod.cold()
+"""
+
+
+def _run(tmp_path, **env_vars):
+    (tmp_path / "profmod.py").write_text(textwrap.dedent(TRACED_MODULE))
+    (tmp_path / "run.py").write_text(textwrap.dedent(SCRIPT))
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join([PACKAGE_ROOT, str(tmp_path)]),
+        **env_vars,
+    )
+    subprocess.run([sys.executable, "run.py"], cwd=tmp_path, env=env, check=True)
+
+
+def test_profile_and_exclude(tmp_path):
+    profile_dir = tmp_path / "profile"
+    profile_dir.mkdir()
+    _run(profile_dir, ML_DAIKON_INSTRUMENTATION_PROFILE="1")
+    profile_files = glob.glob(
+        str(profile_dir / "run_mldaikon_instrumentation_profile_*.json")
+    )
+    assert len(profile_files) == 1
+    with open(profile_files[0]) as f:
+        profile = json.load(f)
+    functions = {
+        record["function"]: (record["num_calls"], record["names"])
+        for record in profile["functions"]
+    }
+    assert functions == {
+        "profmod.hot": (200, ["profmod.Model.hot"]),
+        "profmod.cold": (1, ["profmod.cold"]),
+    }
+
+    # only the hot function is over the budget
+    profile["functions"] = [
+        record for record in profile["functions"] if record["function"] == "profmod.hot"
+    ]
+    exclude_file = tmp_path / "exclude.json"
+    exclude_file.write_text(json.dumps(build_exclusion_list([profile], 0.0)))
+
+    run_dir = tmp_path / "run"
+    run_dir.mkdir()
+    _run(run_dir, ML_DAIKON_INSTRUMENTATION_EXCLUDE_FILE=str(exclude_file))
+    with open(glob.glob(str(run_dir / "run_mldaikon_trace_API_*.log"))[0]) as f:
+        events = [json.loads(line) for line in f]
+    with open(glob.glob(str(run_dir / "run_mldaikon_functions_*.log"))[0]) as f:
+        names = {
+            record["function_id"]: record["function"] for record in map(json.loads, f)
+        }
+    assert {names[event["function_id"]] for event in events} == {"profmod.cold"}
@@ -0,0 +1,129 @@
+import glob
+import importlib
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+pytest.importorskip("torch")
+
+from mldaikon.instrumentor.plan_cache import (  # noqa: E402
+    code_fingerprint,
+    load_plan,
+    plan_cache_key,
+    save_plan,
+)
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+
+
+def _write_package(root):
+    package = root / "cachepkg"
+    package.mkdir()
+    (package / "__init__.py").write_text("from cachepkg import ops\n")
+    (package / "ops.py").write_text(
+        textwrap.dedent(
+            """
+            class Layer:
+                def forward(self, x):
+                    return scale(x)
+
+
+            def scale(x):
+                return 2 * x
+
+
+            # looked up by the walk after `scale` is wrapped, like the lazy attributes of torch
+            def __getattr__(name):
+                if name == "value":
+                    return scale(1)
+                raise AttributeError(name)
+
+
+            def __dir__():
+                return [*globals(), "value"]
+            """
+        )
+    )
+    return package
+
+
+def test_plan_round_trip(tmp_path):
+    key = plan_cache_key("torch", {"instrumentation_include": []})
+    assert load_plan(str(tmp_path), key) is None
+    save_plan(str(tmp_path), key, [""], [["", "relu", "wrapper"]], ["nn"])
+    plan = load_plan(str(tmp_path), key)
+    assert plan is not None
+    assert plan["functions"] == [["", "relu", "wrapper"]]
+    assert plan["instrumented_before"] == ["nn"]
+    other_key = plan_cache_key("torch", {"instrumentation_include": ["torch.nn"]})
+    assert load_plan(str(tmp_path), other_key) is None
+
+
+def test_code_fingerprint_changes_with_the_code(tmp_path, monkeypatch):
+    package = _write_package(tmp_path)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    importlib.import_module("cachepkg")
+    try:
+        fingerprint = code_fingerprint("cachepkg")
+        assert code_fingerprint("cachepkg.ops") == fingerprint
+        (package / "ops.py").write_text("def scale(x):\n    return 3 * x\n")
+        assert code_fingerprint("cachepkg") != fingerprint
+    finally:
+        for name in ["cachepkg", "cachepkg.ops"]:
+            sys.modules.pop(name, None)
+
+
+SCRIPT = """
+import os
+import sys
+
+os.environ["MAIN_SCRIPT_NAME"] = "run"
+import cachepkg
+from mldaikon.instrumentor.tracer import Instrumentor
+
+for target in sys.argv[1:]:
+    Instrumentor(cachepkg if target == "cachepkg" else cachepkg.ops).instrument()
+cachepkg.ops.Layer().forward(1)
+"""
+
+
+def _run(tmp_path, run_dir: str, *targets: str) -> tuple[list[str], list[str]]:
+    cwd = tmp_path / run_dir
+    cwd.mkdir()
+    (cwd / "run.py").write_text(textwrap.dedent(SCRIPT))
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join([PACKAGE_ROOT, str(tmp_path)]),
+        ML_DAIKON_PLAN_CACHE="1",
+        ML_DAIKON_PLAN_CACHE_DIR=str(tmp_path / "cache"),
+    )
+    subprocess.run([sys.executable, "run.py", *targets], cwd=cwd, env=env, check=True)
+    with open(glob.glob(str(cwd / "*_instrumentation_report_*.json"))[0]) as f:
+        methods = [target["method"] for target in json.load(f)["targets"]]
+    with open(glob.glob(str(cwd / "run_mldaikon_trace_API_*.log"))[0]) as f:
+        events = [json.loads(line)["type"] for line in f]
+    return methods, events
+
+
+def test_cached_plan_traces_like_a_fresh_walk(tmp_path):
+    _write_package(tmp_path)
+    methods, fresh_events = _run(tmp_path, "fresh", "cachepkg")
+    assert methods == ["walk"]
+    methods, cached_events = _run(tmp_path, "cached", "cachepkg")
+    assert methods == ["plan"]
+    assert cached_events == fresh_events
+    assert len(fresh_events) == 4
+
+
+def test_plan_relying_on_another_target_is_not_applied_alone(tmp_path):
+    _write_package(tmp_path)
+    # cachepkg.ops is instrumented first, the walk of cachepkg does not enter it
+    methods, _ = _run(tmp_path, "both", "cachepkg.ops", "cachepkg")
+    assert methods == ["walk", "walk"]
+    methods, events = _run(tmp_path, "alone", "cachepkg")
+    assert methods == ["walk"]
+    assert len(events) == 4
@@ -0,0 +1,59 @@
+from mldaikon.instrumentor.rules import InstrumentationRules
+
+
+def test_no_rules_instrument_everything():
+    rules = InstrumentationRules([], [])
+    assert rules.should_instrument("torch.nn.functional.relu")
+    assert rules.should_visit("torch.nn")
+
+
+def test_exclude_prefix():
+    rules = InstrumentationRules([], ["torch.fx", "torch._dynamo"])
+    assert not rules.should_visit("torch.fx")
+    assert not rules.should_instrument("torch.fx.graph.Graph.create_node")
+    # prefixes match characters, not module boundaries
+    assert not rules.should_instrument("torch.fxx.f")
+    assert rules.should_visit("torch.f")
+    assert rules.should_instrument("torch.nn.functional.relu")
+
+
+def test_exclude_glob_and_regex():
+    rules = InstrumentationRules([], ["torch.optim.*.zero_grad", r"re:.*\._[a-z]"])
+    assert not rules.should_instrument("torch.optim.sgd.SGD.zero_grad")
+    assert rules.should_instrument("torch.optim.sgd.SGD.step")
+    assert not rules.should_instrument("torch.nn.Module._apply")
+    assert rules.should_instrument("torch.nn.Module.apply")
+
+
+def test_include_rules_restrict_the_instrumented_functions():
+    rules = InstrumentationRules(["torch.nn.functional.relu", "torch.optim.*.step"], [])
+    assert rules.should_instrument("torch.nn.functional.relu")
+    assert rules.should_instrument("torch.optim.adam.Adam.step")
+    assert not rules.should_instrument("torch.nn.functional.gelu")
+    assert not rules.should_instrument("torch.optim.adam.Adam.zero_grad")
+
+
+def test_include_rules_only_walk_the_containers_that_may_hold_a_match():
+    rules = InstrumentationRules(["torch.nn.functional.relu", "torch.optim.*.step"], [])
+    assert rules.should_visit("torch")
+    assert rules.should_visit("torch.nn")
+    assert rules.should_visit("torch.nn.functional")
+    assert not rules.should_visit("torch.nn.modules")
+    assert rules.should_visit("torch.optim.adam")
+    assert rules.should_visit("torch.optim.adam.Adam")
+    assert not rules.should_visit("torch.fx")
+    assert not rules.should_visit("numpy")
+
+
+def test_include_regex_walks_every_container():
+    rules = InstrumentationRules([r"re:torch\.nn\..*_fn$"], [])
+    assert rules.should_visit("numpy")
+    assert rules.should_instrument("torch.nn.init.uniform_fn")
+    assert not rules.should_instrument("torch.nn.init.uniform_")
+
+
+def test_exclude_wins_over_include():
+    rules = InstrumentationRules(["torch.nn"], ["torch.nn.modules"])
+    assert rules.should_instrument("torch.nn.functional.relu")
+    assert not rules.should_visit("torch.nn.modules")
+    assert not rules.should_instrument("torch.nn.modules.linear.Linear.forward")
@@ -0,0 +1,180 @@
+import collections
+import glob
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+from mldaikon.instrumentor.sampling import (
+    FirstNThenEveryKPolicy,
+    ReservoirPolicy,
+    StepWindowPolicy,
+    make_sampling_policy,
+)
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+
+
+def test_first_n_then_every_k():
+    policy = FirstNThenEveryKPolicy(2, 3)
+    decisions = [policy.sample(0, False, None) for _ in range(8)]
+    assert decisions == [True, True, True, False, False, True, False, False]
+    # every API has its own count
+    assert policy.sample(1, False, None) is True
+    # calls inside a call whose nested calls are kept are traced, and counted
+    assert policy.sample(0, True, None) is True
+    assert policy.num_calls == {0: 9, 1: 1}
+
+
+def test_step_window():
+    policy = StepWindowPolicy(1)
+    assert [policy.sample(0, False, 0) for _ in range(2)] == [True, False]
+    assert [policy.sample(0, False, 1) for _ in range(2)] == [True, False]
+
+
+def test_reservoir_keeps_size_calls_per_step():
+    policy = ReservoirPolicy(2)
+    for i in range(10):
+        buffer = policy.sample(0, False, 0)
+        if buffer is not False:
+            buffer.append(({"call": i}, None))
+    assert not policy.has_pending
+    # the reservoir of step 0 is written once the step changes
+    policy.sample(0, False, 1)
+    assert policy.has_pending
+    written = []
+    policy.flush(lambda trace, level: written.append(trace))
+    assert len(written) == 2
+    assert len({trace["call"] for trace in written}) == 2
+
+
+def test_make_sampling_policy():
+    assert make_sampling_policy("all", 1, 1, 1) is None
+    assert isinstance(make_sampling_policy("reservoir", 1, 1, 1), ReservoirPolicy)
+    with pytest.raises(ValueError):
+        make_sampling_policy("every_other", 1, 1, 1)
+
+
+TRACED_MODULE = """
+def inner():
+    pass
+
+
+def outer():
+    for _ in range(100):
+        inner()
+"""
+
+SCRIPT = """
+import os
+
+os.environ["MAIN_SCRIPT_NAME"] = "run"
+import sampledmod
+from mldaikon.instrumentor.tracer import Instrumentor
+
+Instrumentor(sampledmod).instrument()
+for _ in range(3):
+    sampledmod.outer()
+"""
+
+
+def _traced_calls(tmp_path, **env_vars) -> collections.Counter:
+    (tmp_path / "sampledmod.py").write_text(textwrap.dedent(TRACED_MODULE))
+    (tmp_path / "run.py").write_text(textwrap.dedent(SCRIPT))
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join([PACKAGE_ROOT, str(tmp_path)]),
+        ML_DAIKON_SAMPLING_POLICY="first_n_then_k",
+        **env_vars,
+    )
+    subprocess.run([sys.executable, "run.py"], cwd=tmp_path, env=env, check=True)
+    names = {}
+    with open(glob.glob(str(tmp_path / "run_mldaikon_functions_*.log"))[0]) as f:
+        for line in f:
+            record = json.loads(line)
+            names[record["function_id"]] = record["function"]
+    calls: collections.Counter = collections.Counter()
+    with open(glob.glob(str(tmp_path / "run_mldaikon_trace_API_*.log"))[0]) as f:
+        for line in f:
+            event = json.loads(line)
+            if event["type"] == "function_call (pre)":
+                calls[names[event["function_id"]]] += 1
+    return calls
+
+
+def test_nested_calls_are_sampled_by_their_own_api(tmp_path):
+    # SAMPLING_FIRST_N = 100 and SAMPLING_EVERY_K = 100: of the 300 calls of inner, the first 100 and then
+    # 2 of the other 200
+    assert _traced_calls(tmp_path) == {"sampledmod.outer": 3, "sampledmod.inner": 102}
+
+
+def test_nested_calls_can_be_kept(tmp_path):
+    calls = _traced_calls(tmp_path, ML_DAIKON_SAMPLING_KEEP_NESTED="1")
+    assert calls == {"sampledmod.outer": 3, "sampledmod.inner": 300}
+
+
+NESTED_MODULE = """
+def inner():
+    pass
+
+
+def middle(call_inner):
+    if call_inner:
+        inner()
+
+
+def outer():
+    middle(True)
+"""
+
+NESTED_SCRIPT = """
+import os
+
+os.environ["MAIN_SCRIPT_NAME"] = "run"
+import nestedmod
+from mldaikon.instrumentor.tracer import Instrumentor
+
+Instrumentor(nestedmod).instrument()
+# the first SAMPLING_FIRST_N calls of middle and the next one, the next 99 ones are sampled out
+for _ in range(101):
+    nestedmod.middle(False)
+for _ in range(3):
+    nestedmod.outer()
+"""
+
+
+def test_calls_under_a_sampled_out_call_are_contained_in_its_parent(tmp_path):
+    pytest.importorskip("polars")
+    from mldaikon.invariant.contain_relation import (
+        collect_contained_functions,
+        events_scanner,
+    )
+    from mldaikon.ml_daikon_trace import read_trace_file
+
+    (tmp_path / "nestedmod.py").write_text(textwrap.dedent(NESTED_MODULE))
+    (tmp_path / "run.py").write_text(textwrap.dedent(NESTED_SCRIPT))
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join([PACKAGE_ROOT, str(tmp_path)]),
+        ML_DAIKON_SAMPLING_POLICY="first_n_then_k",
+    )
+    subprocess.run([sys.executable, "run.py"], cwd=tmp_path, env=env, check=True)
+    events = read_trace_file(
+        glob.glob(str(tmp_path / "run_mldaikon_trace_API_*.log"))
+    ).events
+
+    contained = collect_contained_functions(events)
+    outer_calls = 0
+    for idx, event in enumerate(events.iter_rows(named=True)):
+        if event["type"] != "function_call (pre)":
+            continue
+        scanned = events_scanner(events.slice(idx, None), event["function"])
+        assert contained[(event["process_id"], event["func_call_id"])] == scanned
+        if event["function"] == "nestedmod.outer":
+            outer_calls += 1
+            # middle (calls 102 to 104) is not traced, the call of inner it made is
+            assert scanned == {"nestedmod.outer", "nestedmod.inner"}
+    assert outer_calls == 3
@@ -0,0 +1,158 @@
+import glob
+import json
+import os
+
+import pytest
+
+from mldaikon.instrumentor.trace_writer import NDJSONTraceWriter, SegmentedTraceWriter
+
+
+def _segmented_writer(tmp_path, max_bytes: int, step_interval: int):
+    return SegmentedTraceWriter(
+        str(tmp_path / "run_mldaikon_trace_API_t_1"),
+        lambda base: NDJSONTraceWriter(f"{base}.log"),
+        "trace_API",
+        max_bytes,
+        step_interval,
+        # the context version of the events is their step
+        lambda version: version,
+        str(tmp_path / "run_mldaikon_manifest_t.log"),
+    )
+
+
+def _event(t: int, step: int) -> dict:
+    return {"type": "function_call (pre)", "time": t, "context_version": step}
+
+
+def _read_manifest(tmp_path) -> list[dict]:
+    with open(tmp_path / "run_mldaikon_manifest_t.log") as f:
+        return [json.loads(line) for line in f]
+
+
+def _finished_segments(tmp_path) -> list[dict]:
+    return [segment for segment in _read_manifest(tmp_path) if segment["complete"]]
+
+
+def test_segments_rotate_by_step(tmp_path):
+    writer = _segmented_writer(tmp_path, 0, 2)
+    for t in range(8):
+        writer.write(_event(t, t // 2))
+    writer.close()
+
+    segments = _finished_segments(tmp_path)
+    assert [segment["paths"] for segment in segments] == [
+        ["run_mldaikon_trace_API_t_1.log"],
+        ["run_mldaikon_trace_API_t_1_seg1.log"],
+    ]
+    assert [segment["step_range"] for segment in segments] == [[0, 1], [2, 3]]
+    assert [segment["time_range"] for segment in segments] == [[0, 3], [4, 7]]
+    assert [segment["num_events"] for segment in segments] == [4, 4]
+
+
+def test_segments_rotate_by_size(tmp_path):
+    writer = _segmented_writer(tmp_path, 1, 0)
+    # the size is checked every _ROTATION_CHECK_EVERY events
+    for t in range(600):
+        writer.write(_event(t, 0))
+    writer.close()
+    assert [segment["num_events"] for segment in _finished_segments(tmp_path)] == [
+        256,
+        256,
+        88,
+    ]
+
+
+def test_manifest_selects_the_segments_of_a_step_range(tmp_path):
+    pytest.importorskip("polars")
+    from mldaikon.ml_daikon_trace import read_trace_file
+
+    writer = _segmented_writer(tmp_path, 0, 2)
+    for t in range(8):
+        writer.write(_event(t, t // 2))
+    writer.close()
+
+    manifest = str(tmp_path / "run_mldaikon_manifest_t.log")
+    assert read_trace_file(manifest).events["time"].to_list() == list(range(8))
+    # only the segment of steps 2-3 is read
+    events = read_trace_file(manifest, step_range=(2, 3)).events
+    assert events["time"].to_list() == [4, 5, 6, 7]
+
+
+def test_open_segments_are_listed_in_the_manifest(tmp_path):
+    pytest.importorskip("polars")
+    from mldaikon.ml_daikon_trace import read_trace_file
+
+    writer = _segmented_writer(tmp_path, 0, 2)
+    for t in range(6):
+        writer.write(_event(t, t // 2))
+
+    # the process dies in the second segment, it is listed since it was opened
+    segments = _read_manifest(tmp_path)
+    assert [(s["segment"], s["complete"]) for s in segments] == [
+        (0, False),
+        (0, True),
+        (1, False),
+    ]
+    manifest = str(tmp_path / "run_mldaikon_manifest_t.log")
+    assert read_trace_file(manifest).events["time"].to_list() == list(range(6))
+    # the open segment has no step range, it is read for any range
+    events = read_trace_file(manifest, step_range=(2, 2)).events
+    assert events["time"].to_list() == [4, 5]
+
+
+def _columnar_segmented_writer(tmp_path):
+    pytest.importorskip("pyarrow")
+    from mldaikon.instrumentor.trace_writer import ColumnarTraceWriter
+
+    return SegmentedTraceWriter(
+        str(tmp_path / "run_mldaikon_trace_API_t_1"),
+        lambda base: ColumnarTraceWriter(base, "parquet", 2),
+        "trace_API",
+        0,
+        0,
+        lambda version: version,
+        str(tmp_path / "run_mldaikon_manifest_t.log"),
+    )
+
+
+def test_interrupted_parquet_segments_can_be_read(tmp_path):
+    pytest.importorskip("polars")
+    from mldaikon.ml_daikon_trace import read_trace_file
+
+    writer = _columnar_segmented_writer(tmp_path)
+    for t in range(4):
+        writer.write(_event(t, 0))
+    # a new column starts a second part
+    writer.write(dict(_event(4, 0), exception="boom"))
+    writer.write(dict(_event(5, 0), exception="boom"))
+    writer.write(_event(6, 0))
+
+    # the open part is an Arrow IPC stream, the process dies while writing a block to it
+    with open(tmp_path / "run_mldaikon_trace_API_t_1_1.arrows", "ab") as f:
+        f.write(b"\xff\xff\xff\xff\x10\x00")
+    assert sorted(os.listdir(tmp_path)) == [
+        "run_mldaikon_manifest_t.log",
+        "run_mldaikon_trace_API_t_1_0.parquet",
+        "run_mldaikon_trace_API_t_1_1.arrows",
+    ]
+    manifest = str(tmp_path / "run_mldaikon_manifest_t.log")
+    # the buffered event 6 is lost, the flushed blocks are read
+    events = read_trace_file(manifest).events
+    assert events["time"].to_list() == list(range(6))
+
+
+def test_closed_parquet_segments_are_converted(tmp_path):
+    pytest.importorskip("polars")
+    from mldaikon.ml_daikon_trace import read_trace_file
+
+    writer = _columnar_segmented_writer(tmp_path)
+    for t in range(5):
+        writer.write(_event(t, 0))
+    writer.close()
+
+    assert _read_manifest(tmp_path)[-1]["paths"] == [
+        "run_mldaikon_trace_API_t_1_0.parquet"
+    ]
+    assert not glob.glob(str(tmp_path / "*.arrows"))
+    manifest = str(tmp_path / "run_mldaikon_manifest_t.log")
+    assert read_trace_file(manifest).events["time"].to_list() == list(range(5))
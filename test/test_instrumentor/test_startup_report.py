@@ -0,0 +1,69 @@
+import glob
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+from mldaikon.instrumentor.startup_report import OWNER_COLUMNS, InstrumentationReport
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+
+
+def test_report_times_owners_with_and_without_nested_ones():
+    report = InstrumentationReport()
+    report.begin_owner("pkg", "module")
+    report.record("pkg", "wrapped")
+    report.record("pkg", "visited")
+    report.begin_owner("pkg.Cls", "class")
+    report.record("pkg.Cls", "wrapped")
+    report.record("pkg.Cls", "magic")
+    report.end_owner()
+    report.record("pkg", "magic")
+    report.end_owner()
+    report.add_target("pkg", "walk", 2, 5_000_000)
+
+    result = report.to_dict()
+    assert result["targets"] == [
+        {"target": "pkg", "method": "walk", "ms": 5.0, "wrapped": 2}
+    ]
+    assert result["attributes_scanned"] == 5
+    assert result["functions_wrapped"] == 2
+    assert result["skipped"] == {"magic": 2}
+    owners = {row[0]: dict(zip(OWNER_COLUMNS, row)) for row in result["owners"]}
+    assert owners["pkg"]["total_ms"] >= owners["pkg.Cls"]["total_ms"]
+    assert owners["pkg"]["self_ms"] <= owners["pkg"]["total_ms"]
+    # the owner with the highest total time first
+    assert result["owners"][0][0] == "pkg"
+    assert len(report.to_dict(max_owners=1)["owners"]) == 1
+
+
+SCRIPT = """
+import os
+
+os.environ["MAIN_SCRIPT_NAME"] = "run"
+import reportmod
+import reportmod2
+from mldaikon.instrumentor.tracer import Instrumentor
+
+Instrumentor(reportmod).instrument()
+Instrumentor(reportmod2).instrument()
+assert not [name for name in os.listdir(".") if "_instrumentation_report_" in name]
+"""
+
+
+def test_report_is_written_once_at_exit(tmp_path):
+    for name in ["reportmod", "reportmod2"]:
+        (tmp_path / f"{name}.py").write_text("def f():\n    pass\n")
+    (tmp_path / "run.py").write_text(textwrap.dedent(SCRIPT))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([PACKAGE_ROOT, str(tmp_path)]))
+    subprocess.run([sys.executable, "run.py"], cwd=tmp_path, env=env, check=True)
+
+    reports = glob.glob(str(tmp_path / "run_mldaikon_instrumentation_report_*.json"))
+    assert len(reports) == 1
+    with open(reports[0]) as f:
+        report = json.load(f)
+    assert [target["target"] for target in report["targets"]] == [
+        "reportmod",
+        "reportmod2",
+    ]
@@ -0,0 +1,100 @@
+import glob
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+from mldaikon.instrumentor.stats import APIStatsCollector
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+
+
+def test_calls_are_aggregated_per_function_parent_and_step():
+    collector = APIStatsCollector(60.0)
+    collector.record(1, None, 0, 3, False)
+    collector.record(1, None, 0, 10, True)
+    collector.record(1, None, 1, 5, False)
+    collector.record(2, 1, 0, 0, False)
+
+    stats = {
+        (r["function_id"], r["parent_function_id"], r["step"]): r
+        for r in collector.pop_stats()
+    }
+    assert set(stats) == {(1, None, 0), (1, None, 1), (2, 1, 0)}
+    entry = stats[(1, None, 0)]
+    assert entry["num_calls"] == 2
+    assert entry["num_exceptions"] == 1
+    assert entry["total_ns"] == 13
+    assert (entry["min_ns"], entry["max_ns"]) == (3, 10)
+    # 3 ns falls in bucket 2 ([2, 4)), 10 ns in bucket 4 ([8, 16))
+    assert entry["histogram"] == [0, 0, 1, 0, 1]
+    # a duration of 0 goes to bucket 0
+    assert stats[(2, 1, 0)]["histogram"] == [1]
+
+
+def test_pop_stats_resets_the_counters():
+    collector = APIStatsCollector(60.0)
+    collector.record(1, None, None, 1, False)
+    assert len(collector.pop_stats()) == 1
+    assert collector.pop_stats() == []
+
+
+TRACED_MODULE = """
+def inner(x):
+    if x < 0:
+        raise ValueError(x)
+
+
+def outer():
+    for x in range(-2, 8):
+        try:
+            inner(x)
+        except ValueError:
+            pass
+"""
+
+SCRIPT = """
+import os
+
+os.environ["MAIN_SCRIPT_NAME"] = "run"
+import statsmod
+from mldaikon.instrumentor.tracer import Instrumentor
+
+Instrumentor(statsmod).instrument()
+for _ in range(3):
+    statsmod.outer()
+"""
+
+
+def test_stats_mode_writes_one_record_per_api_and_parent(tmp_path):
+    (tmp_path / "statsmod.py").write_text(textwrap.dedent(TRACED_MODULE))
+    (tmp_path / "run.py").write_text(textwrap.dedent(SCRIPT))
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join([PACKAGE_ROOT, str(tmp_path)]),
+        ML_DAIKON_API_TRACE_MODE="stats",
+    )
+    subprocess.run([sys.executable, "run.py"], cwd=tmp_path, env=env, check=True)
+
+    # no per-call events are written
+    assert not glob.glob(str(tmp_path / "run_mldaikon_trace_API_*.log"))
+    names = {}
+    with open(glob.glob(str(tmp_path / "run_mldaikon_functions_*.log"))[0]) as f:
+        for line in f:
+            record = json.loads(line)
+            names[record["function_id"]] = record["function"]
+    with open(glob.glob(str(tmp_path / "run_mldaikon_api_stats_*.log"))[0]) as f:
+        records = [json.loads(line) for line in f]
+
+    stats = {
+        (
+            names[r["function_id"]],
+            names.get(r["parent_function_id"]),
+        ): (r["num_calls"], r["num_exceptions"])
+        for r in records
+    }
+    assert stats == {
+        ("statsmod.outer", None): (3, 0),
+        ("statsmod.inner", "statsmod.outer"): (30, 6),
+    }
@@ -0,0 +1,49 @@
+import glob
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("polars")
+
+from mldaikon.ml_daikon_trace import read_trace_file  # noqa: E402
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+
+SCRIPT = """
+import os
+
+os.environ["MAIN_SCRIPT_NAME"] = "run"
+import torch
+
+import opsmod
+from mldaikon.instrumentor.tracer import Instrumentor
+
+Instrumentor(opsmod).instrument()
+# ops without tensor arguments first, so that the first rows of the trace have no tensor summaries
+for _ in range(120):
+    torch.empty(3)
+torch.ones(4, 3).add_(1)
+"""
+
+
+def test_tensor_summaries_round_trip_in_dispatch_mode(tmp_path):
+    (tmp_path / "opsmod.py").write_text("def noop():\n    pass\n")
+    (tmp_path / "run.py").write_text(textwrap.dedent(SCRIPT))
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join([PACKAGE_ROOT, str(tmp_path)]),
+        ML_DAIKON_TRACE_TORCH_OPS="dispatch",
+    )
+    subprocess.run([sys.executable, "run.py"], cwd=tmp_path, env=env, check=True)
+
+    trace_files = glob.glob(str(tmp_path / "run_mldaikon_trace_API_*.log"))
+    events = read_trace_file(trace_files).events
+    add_calls = events.filter(
+        (events["function"] == "aten.add_.Tensor")
+        & (events["type"] == "function_call (pre)")
+    )
+    assert add_calls["tensors"].to_list() == [["torch.float32[4, 3]@cpu"]]
@@ -0,0 +1,242 @@
+import glob
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+pl = pytest.importorskip("polars")
+
+from mldaikon.instrumentor.trace_writer import (  # noqa: E402
+    CHUNKED_TRACE_EXT,
+    ChunkedTraceWriter,
+    NDJSONTraceWriter,
+)
+from mldaikon.ml_daikon_trace import read_trace_file  # noqa: E402
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+
+
+def _events() -> list[dict]:
+    events: list[dict] = [
+        {
+            "type": "function_call (pre)" if t % 2 == 0 else "function_call (post)",
+            "function_id": 0,
+            "func_call_id": t // 2,
+            "process_id": 1,
+            "time": t,
+        }
+        for t in range(150)
+    ]
+    # fields only some events carry, past the rows polars infers the schema from by default
+    events.append(
+        {
+            "type": "function_call (post) (exception)",
+            "function_id": 0,
+            "func_call_id": 75,
+            "process_id": 1,
+            "time": 150,
+            "exception": "RuntimeError",
+            "exception_msg": "boom",
+        }
+    )
+    return events
+
+
+def test_fields_of_late_events_are_read(tmp_path):
+    path = str(tmp_path / "run_trace_API.log")
+    writer = NDJSONTraceWriter(path)
+    for event in _events():
+        writer.write(event)
+    writer.close()
+
+    events = read_trace_file(path).events
+    assert events["exception"].to_list()[-1] == "RuntimeError"
+    assert events["exception_msg"].null_count() == 150
+
+
+def test_fields_of_late_events_are_read_from_chunked_traces(tmp_path):
+    pytest.importorskip("zstandard")
+    path = str(tmp_path / f"run_trace_API{CHUNKED_TRACE_EXT}")
+    writer = ChunkedTraceWriter(path, "zstd", 1000)
+    for event in _events():
+        writer.write(event)
+    writer.close()
+
+    events = read_trace_file(path).events
+    assert events["exception"].to_list()[-1] == "RuntimeError"
+
+
+CONTEXT_MODULE = """
+def work():
+    pass
+"""
+
+CONTEXT_SCRIPT = """
+import os
+
+os.environ["MAIN_SCRIPT_NAME"] = "run"
+import ctxmod
+from mldaikon.instrumentor.tracer import Instrumentor, close_trace_writers, meta_vars
+
+Instrumentor(ctxmod).instrument()
+meta_vars["step"] = 0
+meta_vars["stage"] = "train"
+ctxmod.work()
+meta_vars["step"] = 1
+del meta_vars["stage"]
+ctxmod.work()
+# versions no event is traced at
+meta_vars["stage"] = "eval"
+meta_vars["stage"] = "train"
+pid = os.fork()
+if pid == 0:
+    ctxmod.work()
+    meta_vars["step"] = 10
+    ctxmod.work()
+    close_trace_writers()
+    os._exit(0)
+os.waitpid(pid, 0)
+meta_vars["step"] = 2
+ctxmod.work()
+"""
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="os.fork is not available")
+def test_meta_vars_are_joined_back_at_the_version_of_every_event(tmp_path):
+    (tmp_path / "ctxmod.py").write_text(textwrap.dedent(CONTEXT_MODULE))
+    (tmp_path / "run.py").write_text(textwrap.dedent(CONTEXT_SCRIPT))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([PACKAGE_ROOT, str(tmp_path)]))
+    subprocess.run([sys.executable, "run.py"], cwd=tmp_path, env=env, check=True)
+
+    events = (
+        read_trace_file(glob.glob(str(tmp_path / "run_mldaikon_trace_API_*.log")))
+        .events.filter(pl.col("type") == "function_call (pre)")
+        .select("process_id", "meta_vars.step", "meta_vars.stage")
+    )
+    contexts: dict[int, list[tuple]] = {}
+    for process_id, step, stage in events.iter_rows():
+        contexts.setdefault(process_id, []).append((step, stage))
+    assert sorted(contexts.values()) == [
+        # the parent, the stage deleted at step 1
+        [(0, "train"), (1, None), (2, "train")],
+        # the child starts from the meta_vars of the parent at the fork
+        [(1, "train"), (10, "train")],
+    ]
+
+
+SYMBOL_MODULE = """
+def outer():
+    return inner()
+
+
+def inner():
+    pass
+
+
+def never_called():
+    pass
+
+
+def child_only():
+    pass
+"""
+
+SYMBOL_SCRIPT = """
+import os
+
+os.environ["MAIN_SCRIPT_NAME"] = "run"
+import symmod
+from mldaikon.instrumentor.tracer import Instrumentor, close_trace_writers
+
+Instrumentor(symmod).instrument()
+symmod.outer()
+pid = os.fork()
+if pid == 0:
+    symmod.child_only()
+    symmod.inner()
+    close_trace_writers()
+    os._exit(0)
+os.waitpid(pid, 0)
+symmod.inner()
+"""
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="os.fork is not available")
+def test_function_ids_are_resolved_from_the_symbol_tables_of_the_processes(
+    tmp_path,
+):
+    (tmp_path / "symmod.py").write_text(textwrap.dedent(SYMBOL_MODULE))
+    (tmp_path / "run.py").write_text(textwrap.dedent(SYMBOL_SCRIPT))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([PACKAGE_ROOT, str(tmp_path)]))
+    subprocess.run([sys.executable, "run.py"], cwd=tmp_path, env=env, check=True)
+
+    # a process only lists the functions it called
+    symbol_tables = []
+    for path in glob.glob(str(tmp_path / "run_mldaikon_functions_*.log")):
+        with open(path) as f:
+            symbol_tables.append(sorted(json.loads(line)["function"] for line in f))
+    assert sorted(symbol_tables) == [
+        ["symmod.child_only", "symmod.inner"],
+        ["symmod.inner", "symmod.outer"],
+    ]
+
+    events = (
+        read_trace_file(glob.glob(str(tmp_path / "run_mldaikon_trace_API_*.log")))
+        .events.filter(pl.col("type") == "function_call (pre)")
+        .select("process_id", "function")
+    )
+    functions: dict[int, list[str]] = {}
+    for process_id, function in events.iter_rows():
+        functions.setdefault(process_id, []).append(function)
+    assert sorted(functions.values()) == [
+        ["symmod.child_only", "symmod.inner"],
+        ["symmod.outer", "symmod.inner", "symmod.inner"],
+    ]
+
+
+def test_wall_time_is_rebuilt_from_the_clock_anchors(tmp_path):
+    prefix = str(tmp_path / "run_mldaikon")
+    start_time = "2026-01-01_00-00-00"
+    anchors = {
+        1: (1_000, 1_700_000_000_000_000_000),
+        2: (5_000, 1_700_000_001_000_000_000),
+    }
+    for process_id, (monotonic_ns, wall_ns) in anchors.items():
+        with open(f"{prefix}_clock_{start_time}_{process_id}.log", "w") as f:
+            f.write(
+                json.dumps(
+                    {
+                        "process_id": process_id,
+                        "monotonic_ns": monotonic_ns,
+                        "wall_ns": wall_ns,
+                    }
+                )
+                + "\n"
+            )
+    # the events of a thread with the same timestamp are ordered by seq, whatever their order in the file
+    written = [
+        {"process_id": 1, "func_call_id": 1, "time": 3_000, "seq": 2},
+        {"process_id": 1, "func_call_id": 0, "time": 3_000, "seq": 1},
+        {"process_id": 2, "func_call_id": 0, "time": 2_000, "seq": 0},
+        {"process_id": 1, "func_call_id": 2, "time": 3_000, "seq": 3},
+    ]
+    paths = []
+    for process_id in anchors:
+        path = f"{prefix}_trace_API_{start_time}_{process_id}.log"
+        writer = NDJSONTraceWriter(path)
+        for event in written:
+            if event["process_id"] == process_id:
+                writer.write({"type": "function_call (pre)", "function_id": 0, **event})
+        writer.close()
+        paths.append(path)
+
+    events = read_trace_file(paths, wall_time=True).events
+    assert events.select("process_id", "seq").rows() == [(2, 0), (1, 1), (1, 2), (1, 3)]
+    wall_ns = [
+        anchors[process_id][1] + event_time - anchors[process_id][0]
+        for process_id, event_time in events.select("process_id", "time").iter_rows()
+    ]
+    assert events["wall_time"].dt.epoch("ns").to_list() == wall_ns
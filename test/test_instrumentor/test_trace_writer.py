@@ -0,0 +1,79 @@
+import json
+
+import pytest
+
+from mldaikon.instrumentor.trace_writer import (
+    ColumnarTraceWriter,
+    NDJSONTraceWriter,
+    flatten_trace,
+)
+
+
+def _event(t: int, **fields) -> dict:
+    return {
+        "type": "function_call (pre)",
+        "function_id": t % 3,
+        "time": t,
+        "meta_vars": {"step": t // 4},
+        **fields,
+    }
+
+
+def test_flatten_trace():
+    assert dict(flatten_trace({"a": 1, "meta_vars": {"step": 2, "x": {"y": 3}}})) == {
+        "a": 1,
+        "meta_vars.step": 2,
+        "meta_vars.x.y": 3,
+    }
+
+
+def test_ndjson_writer(tmp_path):
+    path = str(tmp_path / "trace.log")
+    writer = NDJSONTraceWriter(path)
+    for t in range(3):
+        writer.write(_event(t))
+    writer.close()
+    writer.close()
+
+    with open(path) as f:
+        assert [json.loads(line)["time"] for line in f] == [0, 1, 2]
+    assert writer.paths() == [path]
+    assert writer.num_bytes() == len(open(path).read())
+
+
+@pytest.mark.parametrize("fmt", ["arrow", "parquet"])
+def test_columnar_writer_round_trip(tmp_path, fmt):
+    pl = pytest.importorskip("polars")
+    pytest.importorskip("pyarrow")
+    writer = ColumnarTraceWriter(str(tmp_path / "trace"), fmt, 4)
+    for t in range(10):
+        # a column that only some events carry, and an int column that overflows to a float
+        fields = {"exception": "RuntimeError"} if t == 5 else {}
+        writer.write(_event(t, value=t if t < 7 else 0.5, **fields))
+    writer.close()
+
+    read = pl.read_ipc_stream if fmt == "arrow" else pl.read_parquet
+    events = pl.concat([read(path) for path in writer.paths()], how="diagonal_relaxed")
+    assert events["time"].to_list() == list(range(10))
+    assert events["meta_vars.step"].to_list() == [t // 4 for t in range(10)]
+    assert events["exception"].to_list() == [
+        "RuntimeError" if t == 5 else None for t in range(10)
+    ]
+    assert events["value"].to_list() == [t if t < 7 else 0.5 for t in range(10)]
+
+
+def test_columnar_writer_starts_a_new_part_when_the_schema_changes(tmp_path):
+    pytest.importorskip("pyarrow")
+    writer = ColumnarTraceWriter(str(tmp_path / "trace"), "parquet", 2)
+    for t in range(4):
+        writer.write(_event(t))
+    assert len(writer.paths()) == 1
+    writer.write(_event(4, tensors=["torch.float32[4]@cpu"]))
+    writer.write(_event(5))
+    writer.close()
+    assert len(writer.paths()) == 2
+
+
+def test_columnar_writer_rejects_unknown_formats(tmp_path):
+    with pytest.raises(ValueError):
+        ColumnarTraceWriter(str(tmp_path / "trace"), "csv", 2)
@@ -0,0 +1,116 @@
+import glob
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+from mldaikon.instrumentor.windows import TracingSchedule, TracingWindow, parse_windows
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+
+
+def test_parse_windows():
+    windows = parse_windows("10-12, 20, 30-")
+    assert [(w.first_step, w.last_step) for w in windows] == [
+        (10, 12),
+        (20, 20),
+        (30, None),
+    ]
+    assert parse_windows("") == []
+    with pytest.raises(ValueError):
+        parse_windows("a-b")
+
+
+def test_schedule_is_active_in_its_windows():
+    schedule = TracingSchedule(parse_windows("10-12"))
+    assert schedule.active(9) == (False, None)
+    assert schedule.active(10) == (True, None)
+    assert schedule.active(None) == (False, None)
+
+    schedule.add(TracingWindow(20, 20, ["torch.optim"]))
+    schedule.add(TracingWindow(apis=["torch.nn"]))
+    assert schedule.active(20) == (True, ("torch.nn", "torch.optim"))
+    # a window without APIs traces all of them
+    assert schedule.active(11) == (True, None)
+
+
+TRACED_MODULE = """
+class Optimizer:
+    def step(self):
+        pass
+
+
+def helper():
+    pass
+"""
+
+SCRIPT = """
+import os
+
+os.environ["MAIN_SCRIPT_NAME"] = "run"
+import winmod
+from mldaikon.instrumentor.tracer import Instrumentor, tracing_window
+
+Instrumentor(winmod).instrument()
+with tracing_window(apis=["winmod.Optimizer.step"]):
+    winmod.Optimizer().step()
+    winmod.helper()
+# every call is traced again after the block
+winmod.helper()
+"""
+
+
+def test_window_apis_match_qualified_names_and_are_restored(tmp_path):
+    pl = pytest.importorskip("polars")
+    from mldaikon.ml_daikon_trace import read_trace_file
+
+    (tmp_path / "winmod.py").write_text(textwrap.dedent(TRACED_MODULE))
+    (tmp_path / "run.py").write_text(textwrap.dedent(SCRIPT))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([PACKAGE_ROOT, str(tmp_path)]))
+    subprocess.run([sys.executable, "run.py"], cwd=tmp_path, env=env, check=True)
+
+    trace_files = glob.glob(str(tmp_path / "run_mldaikon_trace_API_*.log"))
+    events = read_trace_file(trace_files).events
+    calls = events.filter(pl.col("type") == "function_call (pre)")
+    assert calls["function"].to_list() == ["winmod.step", "winmod.helper"]
+
+
+SIGNAL_SCRIPT = """
+import os
+import signal
+
+os.environ["MAIN_SCRIPT_NAME"] = "run"
+import winmod
+from mldaikon.instrumentor.tracer import Instrumentor
+
+Instrumentor(winmod).instrument()
+with open("handler.txt", "w") as f:
+    f.write(str(signal.getsignal(signal.SIGUSR2) != signal.SIG_DFL))
+winmod.helper()
+if signal.getsignal(signal.SIGUSR2) != signal.SIG_DFL:
+    # turns tracing off
+    os.kill(os.getpid(), signal.SIGUSR2)
+    winmod.Optimizer().step()
+"""
+
+
+@pytest.mark.parametrize("window_signal", [None, "SIGUSR2"])
+def test_window_signal_handler_is_opt_in(tmp_path, window_signal):
+    pl = pytest.importorskip("polars")
+    from mldaikon.ml_daikon_trace import read_trace_file
+
+    (tmp_path / "winmod.py").write_text(textwrap.dedent(TRACED_MODULE))
+    (tmp_path / "run.py").write_text(textwrap.dedent(SIGNAL_SCRIPT))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([PACKAGE_ROOT, str(tmp_path)]))
+    env.pop("ML_DAIKON_TRACING_WINDOW_SIGNAL", None)
+    if window_signal is not None:
+        env["ML_DAIKON_TRACING_WINDOW_SIGNAL"] = window_signal
+    subprocess.run([sys.executable, "run.py"], cwd=tmp_path, env=env, check=True)
+
+    assert (tmp_path / "handler.txt").read_text() == str(window_signal is not None)
+    trace_files = glob.glob(str(tmp_path / "run_mldaikon_trace_API_*.log"))
+    events = read_trace_file(trace_files).events
+    calls = events.filter(pl.col("type") == "function_call (pre)")
+    assert calls["function"].to_list() == ["winmod.helper"]